@@ -0,0 +1,602 @@
+from typing import BinaryIO, Dict
+import discord
+import numpy as np
+import os
+import threading
+
+
+# librespot's pipe backend always writes signed 16 bit little endian stereo at 44.1 kHz
+LIBRESPOT_SAMPLE_RATE = 44100
+LIBRESPOT_CHANNELS = 2
+SAMPLE_WIDTH = 2
+FRAME_SIZE = LIBRESPOT_CHANNELS * SAMPLE_WIDTH
+LIBRESPOT_BYTES_PER_SECOND = LIBRESPOT_SAMPLE_RATE * FRAME_SIZE
+
+# Discord expects 20 ms frames of signed 16 bit little endian stereo at 48 kHz
+DISCORD_SAMPLE_RATE = 48000
+FRAME_DURATION = 0.02
+INPUT_FRAME_SAMPLES = int(LIBRESPOT_SAMPLE_RATE * FRAME_DURATION)
+OUTPUT_FRAME_SAMPLES = int(DISCORD_SAMPLE_RATE * FRAME_DURATION)
+INPUT_FRAME_BYTES = INPUT_FRAME_SAMPLES * FRAME_SIZE
+OUTPUT_FRAME_BYTES = OUTPUT_FRAME_SAMPLES * FRAME_SIZE
+
+# How many seconds of librespot audio to hold between librespot and the voice player
+BUFFER_SECONDS = float(os.getenv("MUSIC_BUFFER_SECONDS", "2"))
+# "native" to resample in process with NumPy, "ffmpeg" to resample in an ffmpeg subprocess, or "opus"
+# to resample and Opus encode in an ffmpeg subprocess so the voice player thread only sends packets
+AUDIO_BACKEND = os.getenv("MUSIC_AUDIO_BACKEND", "native")
+# The Opus bitrate in kbps ffmpeg encodes at when `AUDIO_BACKEND` is "opus"
+OPUS_BITRATE = int(os.getenv("MUSIC_OPUS_BITRATE", "128"))
+# The volume each guild starts at, in percent
+DEFAULT_VOLUME = int(os.getenv("MUSIC_DEFAULT_VOLUME", "100"))
+# The loudest `.volume` may go, in percent
+MAX_VOLUME = 200
+
+# How many bytes the reader thread asks librespot's pipe for at a time
+READ_CHUNK_SIZE = 8192
+
+
+class PCMRingBuffer:
+    """
+    A bounded ring buffer that sits between librespot's stdout and the voice player. A dedicated
+    thread drains librespot into the buffer so that what happens downstream never leaves audio
+    piling up in OS pipes.
+
+    While playing, a full buffer applies backpressure by pausing the reader until the player catches
+    up. While paused, the oldest audio is dropped instead so at most one buffer's worth is replayed
+    on resume. `flush` discards everything buffered, which is used when skipping tracks. Reads and
+    drops always cover whole stereo samples so the stream never falls out of alignment.
+
+    :param source: The pipe to read PCM audio from
+    :param capacity: The maximum number of bytes to buffer
+    """
+
+    def __init__(self, source: BinaryIO, capacity: int = int(BUFFER_SECONDS * LIBRESPOT_BYTES_PER_SECOND)) -> None:
+        self.capacity = max(FRAME_SIZE, capacity - capacity % FRAME_SIZE)
+        self.source = source
+        self._buffer = bytearray(self.capacity)
+        self._start = 0
+        self._size = 0
+        self._paused = False
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread: threading.Thread | None = None
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.dropped_bytes = 0
+        self.flushed_bytes = 0
+        self.underruns = 0
+        self.high_water = 0
+
+    def start(self):
+        """
+        Starts the thread that drains `source` into the buffer
+        """
+
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def _fill(self):
+        """
+        Runs on the reader thread until `source` reaches EOF or the buffer is closed
+        """
+
+        while not self._closed:
+            data = self.source.read1(READ_CHUNK_SIZE) if hasattr(self.source, "read1") else self.source.read(READ_CHUNK_SIZE)
+            if not data:
+                break
+            self._write(data)
+
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def _write(self, data: bytes):
+        with self._condition:
+            self.bytes_in += len(data)
+            view = memoryview(data)
+            while len(view) and not self._closed:
+                free = self.capacity - self._size
+                if free == 0:
+                    if self._paused:
+                        self._drop(len(view) + -len(view) % FRAME_SIZE)
+                        continue
+                    self._condition.wait()
+                    continue
+
+                count = min(free, len(view))
+                end = (self._start + self._size) % self.capacity
+                first = min(count, self.capacity - end)
+                self._buffer[end:end + first] = view[:first]
+                self._buffer[:count - first] = view[first:count]
+                self._size += count
+                self.high_water = max(self.high_water, self._size)
+                view = view[count:]
+                self._condition.notify_all()
+
+    def _available(self) -> int:
+        """
+        :returns: The number of buffered bytes that make up whole stereo samples
+        """
+
+        return self._size - self._size % FRAME_SIZE
+
+    def available(self) -> int:
+        """
+        :returns: The number of bytes that can currently be read without blocking
+        """
+
+        with self._condition:
+            return self._available()
+
+    def _discard(self, count: int) -> int:
+        """
+        Discards up to `count` of the oldest whole-sample bytes. Must be called while holding `_condition`
+
+        :returns: The number of bytes discarded
+        """
+
+        count = min(count, self._available())
+        self._start = (self._start + count) % self.capacity
+        self._size -= count
+        return count
+
+    def _drop(self, count: int):
+        self.dropped_bytes += self._discard(count)
+
+    def read(self, size: int = READ_CHUNK_SIZE) -> bytes:
+        """
+        Reads up to `size` bytes, blocking until some audio is available
+
+        :param size: The maximum number of bytes to read
+        :returns: The audio read, or `b""` once librespot has exited and the buffer is empty
+        """
+
+        size -= size % FRAME_SIZE
+        with self._condition:
+            if self._available() == 0 and not self._closed:
+                self.underruns += 1
+            while self._available() == 0 and not self._closed:
+                self._condition.wait()
+            if self._available() == 0 or size == 0:
+                return b""
+
+            count = min(size, self._available())
+            first = min(count, self.capacity - self._start)
+            data = bytes(self._buffer[self._start:self._start + first]) + bytes(self._buffer[:count - first])
+            self._start = (self._start + count) % self.capacity
+            self._size -= count
+            self.bytes_out += count
+            self._condition.notify_all()
+            return data
+
+    def pause(self):
+        """
+        Switches to dropping the oldest audio when full instead of applying backpressure
+        """
+
+        with self._condition:
+            self._paused = True
+            self._condition.notify_all()
+
+    def resume(self):
+        """
+        Switches back to applying backpressure when full
+        """
+
+        with self._condition:
+            self._paused = False
+            self._condition.notify_all()
+
+    def flush(self):
+        """
+        Discards all buffered audio, e.g. when the current track is skipped
+        """
+
+        with self._condition:
+            self.flushed_bytes += self._discard(self._size)
+            self._condition.notify_all()
+
+    def close(self):
+        """
+        Stops buffering and wakes up any blocked readers
+        """
+
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def metrics(self) -> Dict[str, float]:
+        """
+        :returns: A snapshot of how full the buffer is and how much audio has moved through it
+        """
+
+        with self._condition:
+            return {
+                "capacity_bytes": self.capacity,
+                "fill_bytes": self._size,
+                "fill_ratio": self._size / self.capacity,
+                "fill_seconds": self._size / LIBRESPOT_BYTES_PER_SECOND,
+                "high_water_bytes": self.high_water,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "dropped_bytes": self.dropped_bytes,
+                "flushed_bytes": self.flushed_bytes,
+                "underruns": self.underruns,
+                "paused": self._paused,
+            }
+
+
+class PCMSwitcher:
+    """
+    Presents the voice player with one continuous stream of audio while the librespot process behind
+    it is replaced. A buffer passed to `queue` takes over only once the current buffer has been closed
+    and fully drained, so the last sample of the old process is followed directly by the first sample
+    of the new one and no audio is dropped or padded at the handover.
+    """
+
+    def __init__(self) -> None:
+        self._current: PCMRingBuffer | None = None
+        self._pending: PCMRingBuffer | None = None
+        self._paused = False
+        self._lock = threading.Lock()
+        self.switches = 0
+
+    def attach(self, pcm: PCMRingBuffer):
+        """
+        Immediately makes `pcm` the buffer being played, discarding any queued handover
+
+        :param pcm: The buffer to play from
+        """
+
+        with self._lock:
+            self._current = pcm
+            self._pending = None
+            self._apply_state(pcm)
+
+    def queue(self, pcm: PCMRingBuffer):
+        """
+        Hands playback over to `pcm` as soon as the current buffer is closed and drained
+
+        :param pcm: The buffer to play from next
+        """
+
+        with self._lock:
+            if self._current is None:
+                self._current = pcm
+            else:
+                self._pending = pcm
+            self._apply_state(pcm)
+
+    def _apply_state(self, pcm: PCMRingBuffer):
+        if self._paused:
+            pcm.pause()
+        else:
+            pcm.resume()
+
+    def read(self, size: int = READ_CHUNK_SIZE) -> bytes:
+        """
+        Reads up to `size` bytes from the current buffer, moving on to the queued buffer when the
+        current one runs dry
+
+        :param size: The maximum number of bytes to read
+        :returns: The audio read, or `b""` once there is nothing left to play
+        """
+
+        while True:
+            with self._lock:
+                current = self._current
+            if current is None:
+                return b""
+
+            data = current.read(size)
+            if data:
+                return data
+
+            with self._lock:
+                if current is not self._current:
+                    # `attach` swapped the buffer while we were blocked on the old one
+                    continue
+                if self._pending is None:
+                    return b""
+                self._current, self._pending = self._pending, None
+                self.switches += 1
+
+    def pause(self):
+        """
+        Pauses the current buffer and any buffer queued after it
+        """
+
+        with self._lock:
+            self._paused = True
+            for pcm in (self._current, self._pending):
+                if pcm:
+                    pcm.pause()
+
+    def resume(self):
+        """
+        Resumes the current buffer and any buffer queued after it
+        """
+
+        with self._lock:
+            self._paused = False
+            for pcm in (self._current, self._pending):
+                if pcm:
+                    pcm.resume()
+
+    def flush(self):
+        """
+        Discards the audio held by the current buffer and any buffer queued after it
+        """
+
+        with self._lock:
+            for pcm in (self._current, self._pending):
+                if pcm:
+                    pcm.flush()
+
+    def metrics(self) -> Dict[str, float]:
+        """
+        :returns: The current buffer's metrics along with how many handovers have happened
+        """
+
+        with self._lock:
+            current = self._current
+            switches = self.switches
+        metrics = current.metrics() if current else {}
+        metrics["switches"] = switches
+        return metrics
+
+
+class Volume:
+    """
+    A gain stage applied to the audio on its way to Discord, so volume changes cost no request to
+    Spotify and are heard on the very next frame. Each change is ramped across one 20 ms frame rather
+    than applied as a step, which would click. Callers that pass audio in blocks of another size say
+    how many samples make up 20 ms, so the ramp lasts as long whatever the block size.
+
+    :param percent: The starting volume, where 100 leaves the audio untouched
+    """
+
+    def __init__(self, percent: int = DEFAULT_VOLUME) -> None:
+        self.percent = percent
+        self._gain = percent / 100
+        self._applied = self._gain
+        self._ramp_target = self._gain
+        self._ramp_left = 0
+
+    def set(self, percent: int):
+        """
+        :param percent: The new volume, between 0 and `MAX_VOLUME`
+        """
+
+        if not 0 <= percent <= MAX_VOLUME:
+            raise ValueError(f"percent must be between 0 and {MAX_VOLUME} inclusive")
+        self.percent = percent
+        self._gain = percent / 100
+
+    def is_unity(self) -> bool:
+        """
+        :returns: `True` if the audio passes through unchanged, so applying the gain can be skipped
+        """
+
+        return self._gain == 1.0 and self._applied == 1.0
+
+    def apply(self, samples: np.ndarray, ramp_samples: int | None = None):
+        """
+        Scales a block of audio in place, ramping from the gain the previous block ended on if it changed.
+        A ramp longer than the block carries on into the blocks after it
+
+        :param samples: A float32 array of shape `(samples, channels)`
+        :param ramp_samples: How many samples a ramp lasts. Defaults to the block, i.e. one frame
+        """
+
+        target = self._gain
+        start = self._applied
+        if start == target:
+            if target != 1.0:
+                samples *= target
+            return
+
+        if target != self._ramp_target or self._ramp_left == 0:
+            self._ramp_target = target
+            self._ramp_left = ramp_samples or len(samples)
+        count = min(len(samples), self._ramp_left)
+        ramp = np.linspace(start, target, self._ramp_left + 1, dtype=np.float32)[1:count + 1]
+        samples[:count] *= ramp[:, None]
+        samples[count:] *= target
+        self._ramp_left -= count
+        self._applied = target if self._ramp_left == 0 else float(ramp[-1])
+
+    def scale(self, data: bytes, ramp_samples: int | None = None) -> bytes:
+        """
+        :param data: `s16le` stereo audio
+        :param ramp_samples: How many samples a volume change is ramped over. Defaults to all of `data`
+        :returns: The audio with the gain applied
+        """
+
+        if self.is_unity():
+            return data
+        samples = np.frombuffer(data, dtype="<i2").reshape(-1, LIBRESPOT_CHANNELS).astype(np.float32)
+        self.apply(samples, ramp_samples)
+        return np.clip(np.rint(samples), -32768, 32767).astype("<i2").tobytes()
+
+
+class VolumeTransformer(discord.AudioSource):
+    """
+    Applies a `Volume` to any `s16le` audio source, for backends where the gain can't be folded into
+    resampling
+
+    :param source: The audio source to scale
+    :param volume: The gain to apply
+    """
+
+    def __init__(self, source: discord.AudioSource, volume: Volume) -> None:
+        self.source = source
+        self.volume = volume
+
+    def read(self) -> bytes:
+        frame = self.source.read()
+        return self.volume.scale(frame) if frame else frame
+
+    def is_opus(self) -> bool:
+        return False
+
+    def cleanup(self):
+        self.source.cleanup()
+
+
+class GainReader:
+    """
+    Applies a `Volume` to librespot's audio as it is read, for backends that hand the raw stream to
+    ffmpeg and never see the decoded samples again. Reads come in chunks of any size, so volume
+    changes are ramped over one 20 ms frame of samples like on the other backends
+
+    :param pcm: The buffer holding librespot's audio
+    :param volume: The gain to apply
+    """
+
+    def __init__(self, pcm: PCMRingBuffer | PCMSwitcher, volume: Volume) -> None:
+        self.pcm = pcm
+        self.volume = volume
+
+    def read(self, size: int = READ_CHUNK_SIZE) -> bytes:
+        data = self.pcm.read(size)
+        return self.volume.scale(data, INPUT_FRAME_SAMPLES) if data else data
+
+
+class PolyphaseResampler:
+    """
+    Resamples librespot's 44.1 kHz stereo to Discord's 48 kHz one 20 ms frame at a time. 48000/44100
+    reduces to 160/147, and 20 ms is exactly 882 input samples and 960 output samples, so every frame
+    starts at the same point in the polyphase cycle. The filter taps for a whole frame are therefore laid
+    out once as a banded matrix, and each frame is resampled with a handful of small matrix products.
+
+    :param taps_per_phase: The length of each polyphase branch of the low-pass filter
+    :param beta: The Kaiser window shape parameter used when designing the filter
+    :param block_size: How many output samples each band of the matrix covers
+    """
+
+    UP = 160
+    DOWN = 147
+
+    def __init__(self, taps_per_phase: int = 32, beta: float = 8.0, block_size: int = 120) -> None:
+        self.taps = taps_per_phase
+
+        # Windowed-sinc low-pass at the upsampled rate, cut off at the lower of the two Nyquist rates
+        length = taps_per_phase * self.UP
+        cutoff = 0.5 / max(self.UP, self.DOWN)
+        t = np.arange(length) - (length - 1) / 2
+        prototype = 2 * cutoff * np.sinc(2 * cutoff * t) * np.kaiser(length, beta) * self.UP
+
+        # Output sample m reads input sample (m * DOWN) // UP and the `taps - 1` before it, weighted by
+        # the filter branch for phase (m * DOWN) % UP. Inputs are offset by the history kept from the
+        # previous frame
+        positions = np.arange(OUTPUT_FRAME_SAMPLES) * self.DOWN
+        phases = positions % self.UP
+        bases = positions // self.UP
+        branch = np.arange(taps_per_phase)
+        indices = bases[:, None] - branch[None, :] + (taps_per_phase - 1)
+        coefficients = prototype[phases[:, None] + branch[None, :] * self.UP]
+
+        # Each block of outputs only touches a narrow span of inputs, so keep just that band
+        self._blocks = []
+        for start in range(0, OUTPUT_FRAME_SAMPLES, block_size):
+            stop = min(start + block_size, OUTPUT_FRAME_SAMPLES)
+            low = int(indices[start:stop].min())
+            high = int(indices[start:stop].max()) + 1
+            band = np.zeros((stop - start, high - low), dtype=np.float32)
+            rows = np.repeat(np.arange(stop - start), taps_per_phase)
+            np.add.at(band, (rows, indices[start:stop].ravel() - low), coefficients[start:stop].ravel())
+            self._blocks.append((start, stop, low, high, band))
+
+        self._window = np.zeros((taps_per_phase - 1 + INPUT_FRAME_SAMPLES, LIBRESPOT_CHANNELS), dtype=np.float32)
+        self._output = np.empty((OUTPUT_FRAME_SAMPLES, LIBRESPOT_CHANNELS), dtype=np.float32)
+
+    def process(self, frame: bytes, volume: Volume | None = None) -> bytes:
+        """
+        Resamples one 20 ms frame
+
+        :param frame: 3528 bytes of `s16le 44100` stereo audio
+        :param volume: A gain to apply while the samples are still floating point
+        :returns: 3840 bytes of `s16le 48000` stereo audio
+        """
+
+        history = self.taps - 1
+        self._window[:history] = self._window[-history:]
+        self._window[history:] = np.frombuffer(frame, dtype="<i2").reshape(-1, LIBRESPOT_CHANNELS)
+
+        for start, stop, low, high, band in self._blocks:
+            np.matmul(band, self._window[low:high], out=self._output[start:stop])
+        if volume is not None:
+            volume.apply(self._output)
+        return np.clip(np.rint(self._output), -32768, 32767).astype("<i2").tobytes()
+
+    def reset(self):
+        """
+        Forgets the tail of the previous frame, e.g. after the buffer was flushed
+        """
+
+        self._window[:] = 0
+
+
+class LibrespotPCMSource(discord.AudioSource):
+    """
+    Feeds librespot's audio straight to the voice client without an ffmpeg process. Each `read`
+    takes 20 ms of 44.1 kHz audio from the ring buffer and resamples it to a 3840 byte 48 kHz frame.
+
+    :param pcm: The buffer holding librespot's audio
+    :param volume: The gain to apply, if any
+    """
+
+    def __init__(self, pcm: PCMRingBuffer | PCMSwitcher, volume: Volume | None = None) -> None:
+        self.pcm = pcm
+        self.volume = volume
+        self.resampler = PolyphaseResampler()
+
+    def read(self) -> bytes:
+        frame = bytearray()
+        while len(frame) < INPUT_FRAME_BYTES:
+            data = self.pcm.read(INPUT_FRAME_BYTES - len(frame))
+            if not data:
+                break
+            frame += data
+
+        if not frame:
+            return b""
+        if len(frame) < INPUT_FRAME_BYTES:
+            frame += bytes(INPUT_FRAME_BYTES - len(frame))
+        return self.resampler.process(bytes(frame), self.volume)
+
+    def is_opus(self) -> bool:
+        return False
+
+
+def create_music_source(pcm: PCMRingBuffer | PCMSwitcher, volume: Volume | None = None, backend: str = AUDIO_BACKEND) -> discord.AudioSource:
+    """
+    Builds the audio source that plays librespot's audio
+
+    :param pcm: The buffer holding librespot's audio
+    :param volume: The gain to apply to the audio, if any
+    :param backend: One of the `AUDIO_BACKEND` choices
+    :returns: An audio source to pass to `VoiceClient.play`
+    """
+
+    if backend == "opus":
+        # Ogg pages are flushed every 20 ms so packets reach the player as soon as they are encoded
+        return discord.FFmpegOpusAudio(
+            pipe=True,
+            source=GainReader(pcm, volume) if volume is not None else pcm,
+            bitrate=OPUS_BITRATE,
+            before_options="-f s16le -ar 44100 -ac 2",
+            options="-page_duration 20000",
+        )
+    if backend == "ffmpeg":
+        source = discord.FFmpegPCMAudio(
+            pipe=True, 
+            source=pcm, 
+            before_options="-f s16le -ar 44100 -ac 2",
+            options="-f s16le -ar 48000 -ac 2",     
+        )
+        return VolumeTransformer(source, volume) if volume is not None else source
+    return LibrespotPCMSource(pcm, volume)
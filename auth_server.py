@@ -1,177 +1,628 @@
-from flask import Flask, request
-import os
+from typing import Awaitable, Callable, Dict, List, Tuple
+from aiohttp import web
+import aiohttp
+import asyncio
 import base64
-import requests
+import hashlib
+import heapq
 import json
-import threading
+import os
+import sqlite3
 import time
 
-app = Flask(__name__)
 
+# Where the auth server listens
+AUTH_SERVER_HOST = os.getenv("AUTH_SERVER_HOST", "0.0.0.0")
+AUTH_SERVER_PORT = int(os.getenv("AUTH_SERVER_PORT", "3000"))
+# Spotify's endpoint for exchanging login codes and refresh tokens for access tokens
+SPOTIFY_TOKEN_URL = os.getenv("SPOTIFY_TOKEN_URL", "https://accounts.spotify.com/api/token")
+# How long to trust an access token when Spotify does not say when it expires
+DEFAULT_TOKEN_LIFETIME = 3600
+# A refresh asked for this many seconds after the same refresh token was last used gets that refresh's
+# tokens instead of asking Spotify again
+REFRESH_GRACE_PERIOD = float(os.getenv("AUTH_REFRESH_GRACE_PERIOD", "10"))
+# Refresh access tokens this many seconds before they expire
+REFRESH_LEAD_TIME = float(os.getenv("AUTH_REFRESH_LEAD_TIME", "300"))
+# A failed scheduled refresh is retried after this many seconds, doubling on each failure up to the maximum
+REFRESH_RETRY_DELAY = float(os.getenv("AUTH_REFRESH_RETRY_DELAY", "5"))
+REFRESH_MAX_RETRY_DELAY = float(os.getenv("AUTH_REFRESH_MAX_RETRY_DELAY", "300"))
+# Where to save tokens so they survive restarts. Leave unset to only keep them in memory
+TOKEN_STORE_PATH = os.getenv("AUTH_TOKEN_STORE_PATH")
+# The Fernet key saved tokens are encrypted with. Generate one with `Fernet.generate_key()`
+TOKEN_STORE_KEY = os.getenv("AUTH_TOKEN_STORE_KEY")
+# The key the logged in account is saved and scheduled under
+ACCOUNT = "spotify"
+# How often the token stream sends a comment so idle connections are not dropped by proxies
+TOKEN_STREAM_KEEPALIVE = 15
+
+# One pooled keep-alive session for every call to Spotify's token endpoint
+_session: aiohttp.ClientSession | None = None
+
+
+class Tokens:
+    """
+    The tokens of the logged in account. Never modified once created, so a request can read the
+    current tokens without taking the store's lock
 
-def refresh_token_helper(refresh_token: str):
+    :param access_token: The Spotify access token, or `None` if nobody is logged in
+    :param refresh_token: The Spotify refresh token
+    :param expires_at: The `time.time()` at which the access token expires
     """
-    Performs the actual task of refreshing an expired access token as required in `clean_old_token` 
-    and calls to the `refresh-token` endpoint. 
 
-    :param refresh_token: The refresh_token to send to Spotify in order to get a new access token 
+    __slots__ = ("access_token", "refresh_token", "expires_at")
+
+    def __init__(self, access_token: str | None = None, refresh_token: str | None = None, expires_at: float = 0.0) -> None:
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.expires_at = expires_at
+
+
+class TokenStore:
     """
+    Holds the logged in account's tokens in memory. Changes are made under a lock and swap in a new
+    `Tokens` at once, so readers always see a matching access token, refresh token and expiry.
 
-    body = f"grant_type=refresh_token&client_id={os.getenv('SPOTIFY_CLIENT_ID')}&refresh_token={refresh_token}"
+    If `path` and `key` are given, every change is also written through to a SQLite file, encrypted
+    with Fernet, so a restarted server picks up where it left off instead of waiting for a new login.
+    Each change replaces the account's row in a single transaction, so a crash leaves either the old
+    or the new tokens on disk, never a mix. The file is read by `load` when the server starts.
+
+    Tokens found in the `SPOTIFY_ACCESS_TOKEN` and `SPOTIFY_REFRESH_TOKEN` environment variables are
+    used when nothing was saved, so an account can be handed to the server without logging in.
+
+    :param path: The SQLite file to persist tokens to, or `None` to only keep them in memory
+    :param key: The Fernet key to encrypt the file with, as made by `Fernet.generate_key()`
+    """
+
+    def __init__(self, path: str | None = TOKEN_STORE_PATH, key: str | None = TOKEN_STORE_KEY) -> None:
+        self.tokens = Tokens()
+        self.lock = asyncio.Lock()
+        self.listeners: List[Callable[[Tokens], None]] = []
+        self.path = path
+        self.key = key
+        self._db: sqlite3.Connection | None = None
+        self._fernet = None
+        access_token = os.getenv("SPOTIFY_ACCESS_TOKEN")
+        refresh_token = os.getenv("SPOTIFY_REFRESH_TOKEN")
+        if access_token or refresh_token:
+            self.tokens = Tokens(access_token, refresh_token, time.time() + DEFAULT_TOKEN_LIFETIME if access_token else 0.0)
+
+    @property
+    def persistent(self) -> bool:
+        return bool(self.path and self.key)
+
+    def _open(self):
+        # Only needed when tokens are persisted, so the server runs without it otherwise
+        from cryptography.fernet import Fernet
+
+        self._fernet = Fernet(self.key)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS tokens (account TEXT PRIMARY KEY, data BLOB NOT NULL, updated_at REAL NOT NULL)")
+        self._db.commit()
+
+    def _read(self) -> Tokens | None:
+        if self._db is None:
+            self._open()
+        row = self._db.execute("SELECT data FROM tokens WHERE account = ?", (ACCOUNT,)).fetchone()
+        if row is None:
+            return None
+        body = json.loads(self._fernet.decrypt(row[0]))
+        return Tokens(body["access_token"], body["refresh_token"], body["expires_at"])
+
+    def _write(self, tokens: Tokens):
+        if self._db is None:
+            self._open()
+        with self._db:
+            if tokens.access_token is None and tokens.refresh_token is None:
+                self._db.execute("DELETE FROM tokens WHERE account = ?", (ACCOUNT,))
+                return
+            data = self._fernet.encrypt(json.dumps({
+                "access_token": tokens.access_token,
+                "refresh_token": tokens.refresh_token,
+                "expires_at": tokens.expires_at,
+            }).encode("utf-8"))
+            self._db.execute("INSERT OR REPLACE INTO tokens (account, data, updated_at) VALUES (?, ?, ?)", (ACCOUNT, data, time.time()))
+
+    async def load(self) -> Tokens:
+        """
+        Restores the tokens saved by a previous run, if any
+
+        :returns: The current tokens
+        """
+
+        if self.path and not self.key:
+            print("AUTH_TOKEN_STORE_PATH is set without AUTH_TOKEN_STORE_KEY, so tokens will not be saved")
+        if not self.persistent:
+            return self.tokens
+
+        async with self.lock:
+            try:
+                saved = await asyncio.to_thread(self._read)
+            except Exception as e:
+                print(f"Loading saved tokens failed: {e}")
+                return self.tokens
+            if saved is None:
+                return self.tokens
+            self.tokens = saved
+            tokens = self.tokens
+        print("Restored saved tokens")
+        self._notify(tokens)
+        return tokens
+
+    async def _save(self, tokens: Tokens):
+        """
+        Writes `tokens` through to disk. Called while holding `lock` so writes land in order
+        """
+
+        if not self.persistent:
+            return
+        try:
+            await asyncio.to_thread(self._write, tokens)
+        except Exception as e:
+            print(f"Saving tokens failed: {e}")
+
+    async def update(self, access_token: str, refresh_token: str | None = None, expires_in: float | None = None) -> Tokens:
+        """
+        :param access_token: The new access token
+        :param refresh_token: The new refresh token. Spotify does not always send one, so the current one is kept if `None`
+        :param expires_in: How many seconds the access token is valid for
+        :returns: The new tokens
+        """
+
+        async with self.lock:
+            self.tokens = Tokens(
+                access_token,
+                refresh_token or self.tokens.refresh_token,
+                time.time() + (expires_in if expires_in is not None else DEFAULT_TOKEN_LIFETIME),
+            )
+            tokens = self.tokens
+            await self._save(tokens)
+        self._notify(tokens)
+        return tokens
+
+    async def clear(self) -> bool:
+        """
+        Forgets the tokens, logging the account out
+
+        :returns: `True` if there was an access token to forget
+        """
+
+        async with self.lock:
+            had_token = self.tokens.access_token is not None
+            self.tokens = Tokens()
+            await self._save(self.tokens)
+        self._notify(self.tokens)
+        return had_token
+
+    def _notify(self, tokens: Tokens):
+        for listener in list(self.listeners):
+            try:
+                listener(tokens)
+            except Exception as e:
+                print(f"Token listener failed: {e}")
+
+
+store = TokenStore()
+
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    :returns: The shared `aiohttp` session, creating it the first time it is needed
+    """
+
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+    return _session
+
+
+async def close_session(app: web.Application):
+    if _session is not None and not _session.closed:
+        await _session.close()
+
+
+def _spotify_auth_headers() -> Dict[str, str]:
     encoded_auth = base64.b64encode(bytes(f"{os.getenv('SPOTIFY_CLIENT_ID')}:{os.getenv('SPOTIFY_CLIENT_SECRET')}", "utf-8"))
-    headers = {
+    return {
         "Authorization": f"Basic {encoded_auth.decode('utf-8')}",
         "Content-Type": "application/x-www-form-urlencoded"
     }
-    response = requests.post(f"https://accounts.spotify.com/api/token", headers=headers, data=body)
-    
-    if 300 > response.status_code >= 200:
-        body = json.loads(response.text)
-        os.environ["SPOTIFY_ACCESS_TOKEN"] = body["access_token"]
-        return {"access_token": body["access_token"]}, 200
-    
-    print(f"refresh_token failed with code {response.status_code} and text {response.text}")
-    return {}
 
 
-def clean_old_token(wait: int = 3590) -> bool:
+# Refreshes in flight, keyed by the refresh token they use, so concurrent callers share one
+_refreshes: Dict[str, asyncio.Task] = {}
+# The `time.monotonic()` and result of the last successful refresh with each refresh token
+_recent_refreshes: Dict[str, Tuple[float, Tokens]] = {}
+
+
+async def _refresh(refresh_token: str) -> Tokens | None:
+    body = f"grant_type=refresh_token&client_id={os.getenv('SPOTIFY_CLIENT_ID')}&refresh_token={refresh_token}"
+    try:
+        async with get_session().post(SPOTIFY_TOKEN_URL, headers=_spotify_auth_headers(), data=body) as response:
+            status, text = response.status, await response.text()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        # Nobody may be awaiting the shared task any more, so failures are returned instead of raised
+        print(f"refresh_token failed to reach Spotify: {e!r}")
+        return None
+
+    if 300 > status >= 200:
+        body = json.loads(text)
+        tokens = await store.update(body["access_token"], body.get("refresh_token") or refresh_token, body.get("expires_in"))
+        _recent_refreshes[refresh_token] = (time.monotonic(), tokens)
+        return tokens
+
+    print(f"refresh_token failed with code {status} and text {text}")
+    return None
+
+
+async def refresh_token_helper(refresh_token: str) -> Tokens | None:
     """
-    Attempts to replace outdated access token after `wait` seconds. `wait` is usually defined by the 
-    `expires_in` key in the authorization response from Spotify. By default, this is set 
-    to just under 1 hour
+    Performs the actual task of refreshing an expired access token as required by `refresh_scheduler`
+    and calls to the `refresh-token` endpoint.
 
-    :param wait: The number of seconds to wait before replacing an outdated key
-    :returns: `True` if the old token was successfully replaced. `False` otherwise
+    Refreshes are coalesced: callers that ask while a refresh with the same refresh token is in flight
+    wait for it and share its result, and callers within `REFRESH_GRACE_PERIOD` of it get its tokens
+    without asking Spotify again. `/access-token` keeps serving the previous token until the refresh
+    succeeds, and after a failed refresh until that token expires
+
+    :param refresh_token: The refresh_token to send to Spotify in order to get a new access token
+    :returns: The new tokens, or `None` if Spotify refused to refresh
     """
 
-    time.sleep(wait)
-    if os.getenv("SPOTIFY_REFRESH_TOKEN") is None:
-        return False
+    now = time.monotonic()
+    for used, (refreshed_at, _) in list(_recent_refreshes.items()):
+        if now - refreshed_at >= REFRESH_GRACE_PERIOD:
+            del _recent_refreshes[used]
+    if refresh_token in _recent_refreshes:
+        return _recent_refreshes[refresh_token][1]
+
+    task = _refreshes.get(refresh_token)
+    if task is None:
+        task = _refreshes[refresh_token] = asyncio.create_task(_refresh(refresh_token))
+        task.add_done_callback(lambda _: _refreshes.pop(refresh_token, None))
+    # One caller giving up must not cancel the refresh for everyone else waiting on it
+    return await asyncio.shield(task)
+
+
+class RefreshScheduler:
+    """
+    Refreshes every account's access token `lead_time` seconds before it expires, all from one task.
+    Refresh times are kept in a heap, so the task only ever sleeps until the earliest one, however
+    many accounts there are. Scheduling an account again replaces its previous time, and a failed
+    refresh is retried with exponential backoff until it succeeds or the account is cancelled. A
+    refresh that hands back tokens expiring no later than the ones it replaced, such as tokens
+    reused from a refresh moments earlier, counts as a failure, so short-lived tokens can't make
+    the task refresh in a tight loop.
+
+    :param refresh: Refreshes an account's tokens, returning `None` on failure
+    :param lead_time: How many seconds before expiry to refresh
+    """
+
+    def __init__(self, refresh: Callable[[str], Awaitable[Tokens | None]], lead_time: float = REFRESH_LEAD_TIME) -> None:
+        self.refresh = refresh
+        self.lead_time = lead_time
+        self._due: Dict[str, float] = {}
+        self._heap: List[Tuple[float, str]] = []
+        self._failures: Dict[str, int] = {}
+        self._expires: Dict[str, float] = {}
+        self._accounts = set()
+        self._task: asyncio.Task | None = None
+        self._wake = asyncio.Event()
+
+    def schedule(self, key: str, expires_at: float):
+        """
+        :param key: The account to refresh
+        :param expires_at: The `time.time()` at which the account's access token expires
+        """
+
+        self._accounts.add(key)
+        self._failures.pop(key, None)
+        self._expires[key] = expires_at
+        # Tokens that live shorter than the lead time are refreshed halfway through instead of right away
+        self._push(key, max(expires_at - self.lead_time, (time.time() + expires_at) / 2))
+
+    def cancel(self, key: str):
+        """
+        Stops refreshing an account, e.g. after it logs out
+        """
+
+        self._accounts.discard(key)
+        self._due.pop(key, None)
+        self._failures.pop(key, None)
+        self._expires.pop(key, None)
+
+    def _push(self, key: str, due: float):
+        self._due[key] = due
+        heapq.heappush(self._heap, (due, key))
+        self._wake.set()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            # Entries replaced by a later `schedule` or `cancel` are skipped when they come up
+            while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+
+            self._wake.clear()
+            if not self._heap:
+                await self._wake.wait()
+                continue
+
+            due, key = self._heap[0]
+            if due > time.time():
+                try:
+                    await asyncio.wait_for(self._wake.wait(), due - time.time())
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._heap)
+            del self._due[key]
+            try:
+                tokens = await self.refresh(key)
+            except Exception as e:
+                print(f"Refreshing {key} failed: {e}")
+                tokens = None
+
+            if key not in self._accounts or key in self._due:
+                # Cancelled or scheduled again while refreshing
+                continue
+            if tokens is not None and tokens.expires_at > self._expires.get(key, float("-inf")):
+                self.schedule(key, tokens.expires_at)
+            else:
+                failures = self._failures[key] = self._failures.get(key, 0) + 1
+                delay = min(REFRESH_RETRY_DELAY * 2 ** (failures - 1), REFRESH_MAX_RETRY_DELAY)
+                print(f"Refreshing {key} failed {failures} times. Retrying in {delay:g} seconds")
+                self._push(key, time.time() + delay)
+
+
+async def _refresh_account(key: str) -> Tokens | None:
+    if store.tokens.refresh_token is None:
+        return None
+    return await refresh_token_helper(store.tokens.refresh_token)
+
+
+def _schedule_refresh(tokens: Tokens):
+    if tokens.refresh_token is None:
+        refresh_scheduler.cancel(ACCOUNT)
+    else:
+        refresh_scheduler.schedule(ACCOUNT, tokens.expires_at)
+
+
+refresh_scheduler = RefreshScheduler(_refresh_account)
+store.listeners.append(_schedule_refresh)
+
+
+async def load_tokens(app: web.Application):
+    await store.load()
+
+
+async def start_refresh_scheduler(app: web.Application):
+    refresh_scheduler.start()
+    _schedule_refresh(store.tokens)
 
-    response = refresh_token_helper(os.getenv("SPOTIFY_REFRESH_TOKEN"))
-    if len(response) > 1 and 300 > response[1] >= 200:
-        return True
 
-    return False
+async def stop_refresh_scheduler(app: web.Application):
+    refresh_scheduler.stop()
 
 
-@app.route("/callback", methods=["GET"])
-def callback():
+async def callback(request: web.Request) -> web.Response:
     """
-    Handles communication from Spotify's auth server that a user has requested to login to 
-    our client. Verifies that the user has a valid security token obtained from the client, 
-    then forwards the request to Spotify to get an access token 
+    Handles communication from Spotify's auth server that a user has requested to login to
+    our client. Verifies that the user has a valid security token obtained from the client,
+    then forwards the request to Spotify to get an access token
 
-    # Required Query Args: 
-    * `code` - A login code provided to the user by Spotify indicating that they logged 
+    # Required Query Args:
+    * `code` - A login code provided to the user by Spotify indicating that they logged
                in successfully so far
-    * `state` - A token obtained from the spotify client that indicates this is a valid 
+    * `state` - A token obtained from the spotify client that indicates this is a valid
                 request, and not someone random hitting the server
 
-    # Returns 
-    If all goes well, will return a "Login Successful" plain text message 
+    # Returns
+    If all goes well, will return a "Login Successful" plain text message
 
-    # Errors 
-    * 500 - If the server does not have a security token set in the environment 
+    # Errors
+    * 500 - If the server does not have a security token set in the environment
     * 401 - If the `state` arg does not match the expected value
     * 400 - If either `state` or `code` are missing, or if Spotify responds in an unexpected way
     """
 
-    code = request.args.get("code")
-    state = request.args.get("state")
+    code = request.query.get("code")
+    state = request.query.get("state")
 
     if os.getenv("AUTH_SERVER_SECURITY") is None:
-        return {"error": "Problem fetching state"}, 500
+        return web.json_response({"error": "Problem fetching state"}, status=500)
 
     if state != os.getenv("AUTH_SERVER_SECURITY"):
-        return {"error": "Received bad state"}, 401
+        return web.json_response({"error": "Received bad state"}, status=401)
 
     if state is None:
-        return {"error": "Missing 'state' query parameter"}, 400
+        return web.json_response({"error": "Missing 'state' query parameter"}, status=400)
     if code is None:
-        return {"error": "Missing 'code' query parameter"}, 400
+        return web.json_response({"error": "Missing 'code' query parameter"}, status=400)
 
     auth_form = f"code={code}&redirect_uri={os.getenv('AUTH_SERVER')}/callback&grant_type=authorization_code"
-    encoded_auth = base64.b64encode(bytes(f"{os.getenv('SPOTIFY_CLIENT_ID')}:{os.getenv('SPOTIFY_CLIENT_SECRET')}", "utf-8"))
-    headers = {
-        "Authorization": f"Basic {encoded_auth.decode('utf-8')}",
-        "Content-Type": "application/x-www-form-urlencoded"
+    async with get_session().post(SPOTIFY_TOKEN_URL, headers=_spotify_auth_headers(), data=auth_form) as response:
+        status, text = response.status, await response.text()
+
+    if status == 200:
+        body = json.loads(text)
+        print(f"Logged in. The access token expires in {body.get('expires_in')} seconds")
+        await store.update(body["access_token"], body["refresh_token"], body.get("expires_in"))
+        return web.Response(text="Login Successful")
+    else:
+        return web.Response(text=text, status=400)
+
+
+def _token_body(tokens: Tokens) -> Dict:
+    return {
+        "access_token": tokens.access_token,
+        "refresh_token": tokens.refresh_token,
+        "expires_at": tokens.expires_at if tokens.access_token else None,
     }
 
-    response = requests.post("https://accounts.spotify.com/api/token", headers=headers, data=auth_form)
-    if response.status_code == 200:
-        body = json.loads(response.text)
-        print(body)
-        os.environ["SPOTIFY_ACCESS_TOKEN"] = body["access_token"]
-        os.environ["SPOTIFY_REFRESH_TOKEN"] = body["refresh_token"]
-        clean_thread = threading.Thread(target=clean_old_token, args=(body["expires_in"] - 10,))
-        clean_thread.start()
-        return "Login Successful", 200
-    else:
-        return response.text, 400
 
+def _token_etag(tokens: Tokens) -> str:
+    """
+    :returns: An ETag that changes whenever the tokens do, without giving the access token away
+    """
+
+    digest = hashlib.sha256(f"{tokens.access_token}:{tokens.refresh_token}:{tokens.expires_at}".encode("utf-8"))
+    return f'"{digest.hexdigest()[:32]}"'
 
-@app.route("/access-token/<state>", methods=["GET", "DELETE"])
-def access_token(state: str):
+
+async def access_token(request: web.Request) -> web.Response:
     """
-    First verifies that the request is coming from a valid client by checking the `state` argument. 
-    Then responds with json containing {"access_token": "abcd", "refresh_token": "efgh"}
+    First verifies that the request is coming from a valid client by checking the `state` argument.
+    Then responds with json containing {"access_token": "abcd", "refresh_token": "efgh", "expires_at": 1700000000.0}
+
+    The response can be cached until `Cache-Control: max-age` runs out, which is when `refresh_scheduler`
+    replaces the token. Sending the `ETag` back in `If-None-Match` gets a 304 if the tokens haven't changed
 
     # Required Positional Args
     * state - A token that indicates the request is coming from a valid client
 
-    # Returns 
-    If all goes well, responds with a json object containing the keys "access_token" and "refresh_token"
+    # Returns
+    If all goes well, responds with a json object containing the keys "access_token", "refresh_token"
+    and "expires_at", the unix time at which the access token expires
 
-    # Errors 
+    # Errors
     * 500 - If no security token has been set in the environment
     * 401 - If `state` does not match the security token in the environment
     * 404 - There is no spotify access token (likely indicating the user is logged out)
     """
     if os.getenv("AUTH_SERVER_SECURITY") is None:
-        return {"error": "Problem fetching state"}, 500
+        return web.json_response({"error": "Problem fetching state"}, status=500)
 
-    if state != os.getenv("AUTH_SERVER_SECURITY"):
-        return {"error": "Received bad state"}, 401
+    if request.match_info["state"] != os.getenv("AUTH_SERVER_SECURITY"):
+        return web.json_response({"error": "Received bad state"}, status=401)
 
     if request.method == "GET":
-        return {
-            "access_token": os.getenv("SPOTIFY_ACCESS_TOKEN"), 
-            "refresh_token": os.getenv("SPOTIFY_REFRESH_TOKEN"),
-        }, 200
-    
-    elif request.method == "DELETE": 
-        status = 204
-        if os.getenv("SPOTIFY_ACCESS_TOKEN") is not None:
-            del os.environ["SPOTIFY_ACCESS_TOKEN"]
-        else: 
-            status = 404
+        tokens = store.tokens
+        max_age = max(0, int(tokens.expires_at - time.time() - refresh_scheduler.lead_time)) if tokens.access_token else 0
+        headers = {"ETag": _token_etag(tokens), "Cache-Control": f"private, max-age={max_age}"}
+        if request.headers.get("If-None-Match") == headers["ETag"]:
+            return web.Response(status=304, headers=headers)
+        return web.json_response(_token_body(tokens), headers=headers)
+
+    status = 204 if await store.clear() else 404
+    return web.json_response({"status": status}, status=status)
+
+
+# One queue per client following `/access-token/{state}/events`. Each holds at most the latest tokens
+_token_subscribers = set()
+
+
+def _push_tokens(tokens: Tokens | None):
+    """
+    Hands new tokens to every client following the token stream. `None` closes the streams
+    """
+
+    for queue in _token_subscribers:
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(tokens)
+
+
+def _token_event(tokens: Tokens) -> bytes:
+    return f"event: tokens\nid: {_token_etag(tokens)}\ndata: {json.dumps(_token_body(tokens))}\n\n".encode("utf-8")
+
+
+async def access_token_events(request: web.Request) -> web.StreamResponse:
+    """
+    Streams the tokens as server-sent events. The current tokens are sent as soon as the client
+    connects, and new ones the moment they change, so clients never have to poll `/access-token`.
+    Each event's data is the same json `/access-token` responds with. A logout is sent as tokens
+    with a null "access_token"
+
+    # Required Positional Args
+    * state - A token that indicates the request is coming from a valid client
+
+    # Errors
+    * 500 - If no security token has been set in the environment
+    * 401 - If `state` does not match the security token in the environment
+    """
+    if os.getenv("AUTH_SERVER_SECURITY") is None:
+        return web.json_response({"error": "Problem fetching state"}, status=500)
+
+    if request.match_info["state"] != os.getenv("AUTH_SERVER_SECURITY"):
+        return web.json_response({"error": "Received bad state"}, status=401)
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await response.prepare(request)
+    queue = asyncio.Queue(maxsize=1)
+    _token_subscribers.add(queue)
+    try:
+        await response.write(_token_event(store.tokens))
+        while True:
+            try:
+                tokens = await asyncio.wait_for(queue.get(), TOKEN_STREAM_KEEPALIVE)
+            except asyncio.TimeoutError:
+                await response.write(b": keepalive\n\n")
+                continue
+            if tokens is None:
+                break
+            await response.write(_token_event(tokens))
+    except ConnectionResetError:
+        pass
+    finally:
+        _token_subscribers.discard(queue)
+    return response
+
+
+store.listeners.append(_push_tokens)
 
-        if os.getenv("SPOTIFY_REFRESH_TOKEN") is not None:
-            del os.environ["SPOTIFY_REFRESH_TOKEN"]
 
-        return {"status": status}, status
+async def close_token_streams(app: web.Application):
+    _push_tokens(None)
 
 
-@app.route("/refresh-token", methods=["POST"])
-def refresh_token(): 
-    if not request.args.get("state"):
-        return {"error": "Missing state argument"}, 400
+async def refresh_token(request: web.Request) -> web.Response:
+    if not request.query.get("state"):
+        return web.json_response({"error": "Missing state argument"}, status=400)
 
-    if not request.args.get("refresh_token"):
-        return {"error": "Missing refresh_token argument"}, 400
+    if not request.query.get("refresh_token"):
+        return web.json_response({"error": "Missing refresh_token argument"}, status=400)
 
-    state = request.args.get("state")
-    refresh_token = request.args.get("refresh_token")
+    state = request.query.get("state")
+    refresh_token = request.query.get("refresh_token")
 
     if os.getenv("AUTH_SERVER_SECURITY") is None:
-        return {"error": "Problem fetching state"}, 500
+        return web.json_response({"error": "Problem fetching state"}, status=500)
 
     if state != os.getenv("AUTH_SERVER_SECURITY"):
-        return {"error": "Received bad state"}, 401
+        return web.json_response({"error": "Received bad state"}, status=401)
+
+    tokens = await refresh_token_helper(refresh_token)
+    if tokens is None:
+        return web.json_response({"error": "Spotify refused to refresh the token"}, status=502)
+    # The same body as `/access-token`, so the bot caches the refreshed token until it really expires
+    return web.json_response(_token_body(tokens))
+
+
+def create_app() -> web.Application:
+    app = web.Application()
+    app.router.add_get("/callback", callback)
+    app.router.add_get("/access-token/{state}", access_token)
+    app.router.add_delete("/access-token/{state}", access_token)
+    app.router.add_get("/access-token/{state}/events", access_token_events)
+    app.router.add_post("/refresh-token", refresh_token)
+    app.on_startup.append(load_tokens)
+    app.on_startup.append(start_refresh_scheduler)
+    app.on_shutdown.append(close_token_streams)
+    app.on_cleanup.append(stop_refresh_scheduler)
+    app.on_cleanup.append(close_session)
+    return app
 
-    return refresh_token_helper(refresh_token)
-        
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=3000, debug=False)
+    web.run_app(create_app(), host=AUTH_SERVER_HOST, port=AUTH_SERVER_PORT, access_log=None)
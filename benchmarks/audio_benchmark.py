@@ -0,0 +1,107 @@
+"""
+Measures how much CPU it takes to turn librespot's `s16le 44100` audio into Discord's `s16le 48000`
+frames, comparing the in-process NumPy resampler against the ffmpeg subprocess it replaces. The
+"volume" row is the native path with the `.volume` gain stage applied and changed once a second.
+
+Run from the repository root with `python -m benchmarks.audio_benchmark`
+"""
+
+from typing import Dict
+import argparse
+import resource
+import shutil
+import subprocess
+import threading
+import time
+import numpy as np
+import audio
+
+
+def synthetic_audio(seconds: float) -> bytes:
+    """
+    :param seconds: How much audio to generate
+    :returns: A stereo sweep in librespot's output format
+    """
+
+    t = np.arange(int(seconds * audio.LIBRESPOT_SAMPLE_RATE)) / audio.LIBRESPOT_SAMPLE_RATE
+    tone = (np.sin(2 * np.pi * (220 + 400 * t) * t) * 12000).astype("<i2")
+    return np.stack((tone, tone[::-1]), axis=1).tobytes()
+
+
+def children_cpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def bench_native(pcm: bytes, volume: audio.Volume | None = None) -> Dict[str, float]:
+    resampler = audio.PolyphaseResampler()
+    frames = [pcm[i:i + audio.INPUT_FRAME_BYTES] for i in range(0, len(pcm) - audio.INPUT_FRAME_BYTES + 1, audio.INPUT_FRAME_BYTES)]
+
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    for index, frame in enumerate(frames):
+        if volume is not None and index % 50 == 0:
+            # Change the volume once a second so the ramp is exercised too
+            volume.set(50 if volume.percent != 50 else 80)
+        resampler.process(frame, volume)
+    return {
+        "bot_cpu": time.process_time() - cpu,
+        "child_cpu": 0.0,
+        "wall": time.perf_counter() - wall,
+    }
+
+
+def bench_ffmpeg(pcm: bytes) -> Dict[str, float] | None:
+    if shutil.which("ffmpeg") is None:
+        return None
+
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    child = children_cpu()
+    process = subprocess.Popen(
+        ["ffmpeg", "-loglevel", "quiet", "-f", "s16le", "-ar", "44100", "-ac", "2", "-i", "pipe:0", "-f", "s16le", "-ar", "48000", "-ac", "2", "pipe:1"],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+    )
+
+    def feed():
+        for i in range(0, len(pcm), 8192):
+            process.stdin.write(pcm[i:i + 8192])
+        process.stdin.close()
+
+    writer = threading.Thread(target=feed)
+    writer.start()
+    while process.stdout.read(audio.OUTPUT_FRAME_BYTES):
+        pass
+    writer.join()
+    process.wait()
+    return {
+        "bot_cpu": time.process_time() - cpu,
+        "child_cpu": children_cpu() - child,
+        "wall": time.perf_counter() - wall,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=60, help="How many seconds of audio to resample")
+    args = parser.parse_args()
+
+    pcm = synthetic_audio(args.seconds)
+    print(f"Resampling {args.seconds:g} seconds of audio\n")
+    print(f"{'path':<8} {'bot cpu':>10} {'child cpu':>10} {'wall':>10} {'cpu per audio second':>22}")
+    benches = (
+        ("native", bench_native),
+        ("volume", lambda pcm: bench_native(pcm, audio.Volume())),
+        ("ffmpeg", bench_ffmpeg),
+    )
+    for name, bench in benches:
+        result = bench(pcm)
+        if result is None:
+            print(f"{name:<8} skipped, ffmpeg is not installed")
+            continue
+        total = result["bot_cpu"] + result["child_cpu"]
+        print(f"{name:<8} {result['bot_cpu']:>9.3f}s {result['child_cpu']:>9.3f}s {result['wall']:>9.3f}s {total / args.seconds * 1000:>19.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Load tests the auth server's `/access-token` endpoint, which the bot asks for tokens whenever its
+cached access token runs out.
+
+"aiohttp" is `auth_server.py` as it runs in its container. "flask" is the server it replaced: the same
+endpoint on Flask's development server, reading tokens from `os.environ`, kept here as a baseline.
+Each server runs in its own process while this one keeps `--connections` requests in flight for
+`--seconds` and reports requests per second along with p50 and p99 latency.
+
+Run from the repository root with `python -m benchmarks.auth_server_benchmark`
+"""
+
+from typing import Dict, List
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+import aiohttp
+
+
+STATE = "benchmark-security"
+
+
+def flask_baseline(port: int):
+    """
+    Serves `/access-token` the way the Flask auth server did
+    """
+
+    from flask import Flask
+
+    app = Flask(__name__)
+
+    @app.route("/access-token/<state>", methods=["GET"])
+    def access_token(state: str):
+        if os.getenv("AUTH_SERVER_SECURITY") is None:
+            return {"error": "Problem fetching state"}, 500
+        if state != os.getenv("AUTH_SERVER_SECURITY"):
+            return {"error": "Received bad state"}, 401
+        return {
+            "access_token": os.getenv("SPOTIFY_ACCESS_TOKEN"),
+            "refresh_token": os.getenv("SPOTIFY_REFRESH_TOKEN"),
+        }, 200
+
+    app.run(host="127.0.0.1", port=port, debug=False)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(kind: str, port: int) -> subprocess.Popen | None:
+    """
+    :returns: The server process, or `None` if the server can't run here
+    """
+
+    if kind == "flask":
+        try:
+            import flask  # noqa: F401
+        except ImportError:
+            return None
+        command = [sys.executable, "-m", "benchmarks.auth_server_benchmark", "--serve-flask", str(port)]
+    else:
+        command = [sys.executable, "auth_server.py"]
+
+    env = {
+        **os.environ,
+        "AUTH_SERVER_HOST": "127.0.0.1",
+        "AUTH_SERVER_PORT": str(port),
+        "AUTH_SERVER_SECURITY": STATE,
+        "SPOTIFY_ACCESS_TOKEN": "benchmark-access-token",
+        "SPOTIFY_REFRESH_TOKEN": "benchmark-refresh-token",
+    }
+    return subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def wait_until_serving(session: aiohttp.ClientSession, url: str, timeout: float = 10) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(url) as response:
+                if response.status == 200:
+                    return True
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.1)
+    return False
+
+
+async def client(session: aiohttp.ClientSession, url: str, stop_at: float, latencies: List[float], errors: List[int]):
+    while time.perf_counter() < stop_at:
+        start = time.perf_counter()
+        try:
+            async with session.get(url) as response:
+                await response.read()
+                ok = response.status == 200
+        except aiohttp.ClientError:
+            ok = False
+        latencies.append(time.perf_counter() - start)
+        if not ok:
+            errors[0] += 1
+
+
+async def load(port: int, connections: int, seconds: float) -> Dict[str, float] | None:
+    url = f"http://127.0.0.1:{port}/access-token/{STATE}"
+    latencies: List[float] = []
+    errors = [0]
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=connections)) as session:
+        if not await wait_until_serving(session, url):
+            return None
+        start = time.perf_counter()
+        await asyncio.gather(*(client(session, url, start + seconds, latencies, errors) for _ in range(connections)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "rps": len(latencies) / elapsed,
+        "p50": latencies[len(latencies) // 2],
+        "p99": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+        "errors": errors[0],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=5, help="How long to load each server for")
+    parser.add_argument("--connections", type=int, default=32, help="How many requests to keep in flight")
+    parser.add_argument("--serve-flask", type=int, metavar="PORT", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_flask:
+        flask_baseline(args.serve_flask)
+        return
+
+    print(f"{args.connections} connections for {args.seconds:g} seconds\n")
+    print(f"{'server':<8} {'requests':>9} {'req/s':>9} {'p50':>9} {'p99':>9} {'errors':>7}")
+    for kind in ("flask", "aiohttp"):
+        port = free_port()
+        server = start_server(kind, port)
+        if server is None:
+            print(f"{kind:<8} skipped, Flask is not installed")
+            continue
+        try:
+            result = asyncio.run(load(port, args.connections, args.seconds))
+        finally:
+            server.terminate()
+            server.wait()
+        if result is None:
+            print(f"{kind:<8} skipped, the server did not start")
+            continue
+        print(
+            f"{kind:<8} {result['requests']:>9} {result['rps']:>9.0f} {result['p50'] * 1000:>7.2f}ms "
+            f"{result['p99'] * 1000:>7.2f}ms {result['errors']:>7}"
+        )
+
+
+if __name__ == "__main__":
+    main()
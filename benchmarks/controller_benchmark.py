@@ -0,0 +1,203 @@
+"""
+Measures what the bot's playback commands cost against the Spotify Web API, using the local stand-in
+from `benchmarks.fake_spotify` instead of a real account.
+
+Each flow makes the same `spotify_controller` calls as the matching command in `cogs/music.py`:
+
+* play: `.play <query>`, which gets the access token the way joining the voice channel does, searches,
+  queues the first result, transfers playback and resumes it. Starting librespot and connecting to
+  voice only happen the first time, so they are left out
+* skip: `.skip`, which skips to the next track
+* pause: `.pause`, which checks whether anything is playing and pauses it. Playback is resumed
+  between runs, outside the measurement, so every run has something to pause
+
+Every guild runs its flows one after another. With `--guilds` above 1 the guilds run at once, like
+several servers using the bot together. They share one Spotify account just like the bot's guilds do,
+so they take playback from each other and flows that depend on playback state do less work.
+
+For each flow the benchmark reports how many HTTP round trips one run made, the p50 and p99 time a
+user waits for it, how many runs completed per second, and how many runs failed because Spotify
+answered with an error the command would have reported to the user. Requests made by the background playback
+poller are counted separately since no command is waiting on them.
+
+Run from the repository root with `python -m benchmarks.controller_benchmark`
+"""
+
+from typing import Awaitable, Callable, Dict, List
+import argparse
+import asyncio
+import contextlib
+import contextvars
+import io
+import os
+import time
+import aiohttp
+from benchmarks.fake_spotify import FakeSpotify, add_fault_arguments, faults_from_arguments
+
+
+# The requests made by the flow currently running in a task, so concurrent flows are counted apart
+current_round_trips: contextvars.ContextVar[List[int] | None] = contextvars.ContextVar("current_round_trips", default=None)
+
+
+async def count_round_trip(session, context, params):
+    round_trips = current_round_trips.get()
+    if round_trips is not None:
+        round_trips[0] += 1
+
+
+async def play_flow(controller, guild_id: int, index: int, warm: bool) -> bool:
+    tokens = await controller.get_access_token()
+    if not tokens or (not tokens.get("access_token") and not tokens.get("refresh_token")):
+        return False
+
+    query = f"benchmark song {guild_id}" if warm else f"benchmark song {guild_id} {index}"
+    results = await controller.search(f'"{query}"')
+    if results is None or not results["tracks"]["items"]:
+        return False
+    track = controller.track_cache.remember(results["tracks"]["items"][0])
+    if await controller.add_to_queue(guild_id, track.uri) is None:
+        return False
+    await controller.switch_to_device(guild_id)
+    if not await controller.is_playing(guild_id):
+        await controller.play(guild_id)
+    return True
+
+
+async def skip_flow(controller, guild_id: int, index: int, warm: bool) -> bool:
+    await controller.skip(guild_id, "next")
+    return True
+
+
+async def pause_flow(controller, guild_id: int, index: int, warm: bool) -> bool:
+    if await controller.is_playing(guild_id):
+        await controller.pause(guild_id)
+    return True
+
+
+async def resume(controller, guild_id: int):
+    await controller.switch_to_device(guild_id)
+    await controller.play(guild_id)
+
+
+FLOWS = (
+    ("play", play_flow, None),
+    ("skip", skip_flow, None),
+    ("pause", pause_flow, resume),
+)
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+async def run_guild(controller, flow: Callable[..., Awaitable[bool]], setup: Callable[..., Awaitable] | None, guild_id: int,
+                    iterations: int, warm: bool, latencies: List[float], round_trips: List[int], failures: List[int]) -> float:
+    """
+    Runs a flow `iterations` times. A run that fails is counted in `failures` and the guild carries on
+
+    :returns: How long the guild spent running the flow, leaving out the setup between runs
+    """
+
+    busy = 0.0
+    for index in range(iterations):
+        if setup is not None:
+            await setup(controller, guild_id)
+
+        counter = [0]
+        token = current_round_trips.set(counter)
+        start = time.perf_counter()
+        try:
+            ok = await flow(controller, guild_id, index, warm)
+        finally:
+            latencies.append(time.perf_counter() - start)
+            current_round_trips.reset(token)
+        busy += latencies[-1]
+        round_trips.append(counter[0])
+        if not ok:
+            failures[0] += 1
+    return busy
+
+
+async def bench(args: argparse.Namespace) -> List[Dict[str, float]]:
+    fake = FakeSpotify(faults_from_arguments(args))
+    runner = await fake.start()
+    port = runner.addresses[0][1]
+
+    # The controller reads where Spotify is when it is imported
+    os.environ["SPOTIFY_API_PREFIX"] = f"http://127.0.0.1:{port}/v1"
+    os.environ["AUTH_SERVER"] = f"http://127.0.0.1:{port}"
+    os.environ["AUTH_SERVER_SECURITY"] = fake.state
+    os.environ.setdefault("BOT_NAME", "Benchmark Bot")
+    import spotify_controller as controller
+
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(count_round_trip)
+    controller._session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=60),
+        timeout=aiohttp.ClientTimeout(total=10),
+        trace_configs=[trace],
+    )
+
+    guilds = list(range(1, min(args.guilds, controller.workers.max_workers) + 1))
+    for guild_id in guilds:
+        fake.add_device(controller.workers.acquire(guild_id).device_name)
+    controller.playback.start()
+    # Fetching the first token happens once per bot run, so it is left out of every flow
+    await controller.get_access_token()
+
+    results = []
+    try:
+        for name, flow, setup in FLOWS:
+            latencies: List[float] = []
+            round_trips: List[int] = []
+            failures = [0]
+            fake.reset_counters()
+            polls = controller.playback.polls
+            with contextlib.redirect_stdout(io.StringIO()):
+                busy = await asyncio.gather(*(
+                    run_guild(controller, flow, setup, guild_id, args.iterations, args.warm, latencies, round_trips, failures)
+                    for guild_id in guilds
+                ))
+
+            results.append({
+                "flow": name,
+                "runs": len(latencies),
+                "round_trips": sum(round_trips) / len(round_trips),
+                "p50": percentile(latencies, 0.5),
+                "p99": percentile(latencies, 0.99),
+                "throughput": len(latencies) / max(busy),
+                "failed": failures[0],
+                "errors": sum(count for status, count in fake.statuses.items() if status >= 400),
+                "polls": controller.playback.polls - polls,
+            })
+    finally:
+        controller.playback.stop()
+        for guild_id in guilds:
+            controller.workers.release(guild_id)
+        await controller.close_session()
+        await runner.cleanup()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=50, help="How many times each guild runs each flow")
+    parser.add_argument("--guilds", type=int, default=1, help="How many guilds run flows at once, at most LIBRESPOT_MAX_WORKERS")
+    parser.add_argument("--warm", action="store_true", help="Repeat the same search in every play run so the search cache answers it")
+    add_fault_arguments(parser)
+    parser.set_defaults(latency=0.03)
+    args = parser.parse_args()
+
+    results = asyncio.run(bench(args))
+    print(f"{args.guilds} guilds, {args.iterations} runs each, {args.latency * 1000:g}ms latency\n")
+    print(f"{'flow':<6} {'runs':>5} {'trips/run':>10} {'p50':>9} {'p99':>9} {'runs/s':>8} {'failed':>7} {'errors':>7} {'polls':>6}")
+    for result in results:
+        print(
+            f"{result['flow']:<6} {result['runs']:>5} {result['round_trips']:>10.2f} {result['p50'] * 1000:>7.1f}ms "
+            f"{result['p99'] * 1000:>7.1f}ms {result['throughput']:>8.1f} {result['failed']:>7} {result['errors']:>7} {result['polls']:>6}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,398 @@
+"""
+A local stand-in for the Spotify Web API and the bot's auth server, so `spotify_controller` can be
+measured and exercised without a Premium account.
+
+It serves the parts of both APIs the controller uses: `/v1/search`, `/v1/tracks/{id}`, `/v1/me/player`,
+its `play`, `pause`, `next`, `previous`, `seek` and `volume` actions, `/v1/me/player/devices`,
+`/v1/me/player/queue`, and the auth server's `/access-token/{state}` and `/refresh-token`. Player state
+is kept in memory and only the bot's own devices exist.
+
+Every response can be delayed, and requests can be failed on purpose with an expired token (401), a
+rate limit (429 with `Retry-After`) or a server error (500). Every request is counted by route so
+benchmarks can report how many round trips a command costs.
+
+Run from the repository root with `python -m benchmarks.fake_spotify`, then start the bot with
+`SPOTIFY_API_PREFIX=http://127.0.0.1:8888/v1` and `AUTH_SERVER=http://127.0.0.1:8888`
+"""
+
+from typing import Dict, List
+import argparse
+import asyncio
+import collections
+import random
+import time
+import uuid
+from aiohttp import web
+
+
+class Faults:
+    """
+    What the fake server does to each Spotify request. Auth server requests are only ever delayed
+
+    :param latency: Seconds to wait before every response
+    :param jitter: Up to this many extra seconds are added to `latency` at random
+    :param unauthorized_rate: The fraction of requests rejected as if the access token had expired
+    :param rate_limit_rate: The fraction of requests rejected with a 429
+    :param error_rate: The fraction of requests failed with a 500
+    :param retry_after: The `Retry-After` sent with a 429, in seconds
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, unauthorized_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0, error_rate: float = 0.0, retry_after: float = 1.0) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.unauthorized_rate = unauthorized_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+
+    def delay(self) -> float:
+        return self.latency + random.uniform(0, self.jitter)
+
+
+class FakeSpotify:
+    """
+    The fake Spotify account and auth server behind `app`
+
+    :param faults: What to do to each request
+    :param device_names: Names of the Spotify Connect devices to report, usually one per librespot worker
+    :param state: The security token the auth server expects, like `AUTH_SERVER_SECURITY`
+    :param track_count: How many tracks exist to be searched for and queued
+    """
+
+    def __init__(self, faults: Faults | None = None, device_names: List[str] | None = None,
+                 state: str = "fake-security", track_count: int = 500) -> None:
+        self.faults = faults or Faults()
+        self.state = state
+        self.access_token = self._new_token()
+        self.refresh_token = self._new_token()
+        self.devices: Dict[str, Dict] = {}
+        for name in device_names or []:
+            self.add_device(name)
+        self.tracks = [self._track(index) for index in range(track_count)]
+        self.queue: collections.deque = collections.deque()
+        self.history: List[Dict] = []
+        self.item: Dict | None = None
+        self.active_device: str | None = None
+        self.playing = False
+        self.progress_ms = 0
+        self.updated_at = time.monotonic()
+        self.volume_percent = 100
+
+        self.requests: collections.Counter = collections.Counter()
+        self.statuses: collections.Counter = collections.Counter()
+
+    @staticmethod
+    def _new_token() -> str:
+        return uuid.uuid4().hex
+
+    @staticmethod
+    def _track(index: int) -> Dict:
+        id = f"{index:022d}"
+        return {
+            "id": id,
+            "uri": f"spotify:track:{id}",
+            "name": f"Song {index}",
+            "type": "track",
+            "duration_ms": 180000 + index * 1000 % 60000,
+            "artists": [{"name": f"Artist {index % 37}"}],
+            "album": {"name": f"Album {index % 53}", "images": [{"url": f"https://example.com/{id}.jpg"}]},
+        }
+
+    def add_device(self, name: str) -> Dict:
+        id = uuid.uuid5(uuid.NAMESPACE_OID, name).hex
+        self.devices[id] = {"id": id, "name": name, "type": "Speaker", "is_active": False, "volume_percent": 100}
+        return self.devices[id]
+
+    def remove_device(self, id: str):
+        """
+        Drops a device the way Spotify does once its librespot exits, stopping playback if it was active
+        """
+
+        self.devices.pop(id, None)
+        if self.active_device == id:
+            self._progress()
+            self.active_device = None
+            self.playing = False
+
+    def expire_token(self):
+        """
+        Rotates the access token, so every request with the old one is rejected until the bot refreshes
+        """
+
+        self.access_token = self._new_token()
+
+    def round_trips(self) -> int:
+        return sum(self.requests.values())
+
+    def reset_counters(self):
+        self.requests.clear()
+        self.statuses.clear()
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self._middleware])
+        app.router.add_get("/access-token/{state}", self.get_access_token)
+        app.router.add_delete("/access-token/{state}", self.delete_access_token)
+        app.router.add_post("/refresh-token", self.post_refresh_token)
+        app.router.add_get("/v1/search", self.search)
+        app.router.add_get("/v1/tracks/{id}", self.get_track)
+        app.router.add_get("/v1/me/player", self.get_player)
+        app.router.add_put("/v1/me/player", self.transfer)
+        app.router.add_put("/v1/me/player/play", self.play)
+        app.router.add_put("/v1/me/player/pause", self.pause)
+        app.router.add_post("/v1/me/player/next", self.next)
+        app.router.add_post("/v1/me/player/previous", self.previous)
+        app.router.add_put("/v1/me/player/seek", self.seek)
+        app.router.add_put("/v1/me/player/volume", self.volume)
+        app.router.add_get("/v1/me/player/devices", self.get_devices)
+        app.router.add_get("/v1/me/player/queue", self.get_queue)
+        app.router.add_post("/v1/me/player/queue", self.add_to_queue)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> web.AppRunner:
+        """
+        Serves the app in the running event loop. Port 0 picks a free port
+
+        :returns: The runner, whose `addresses` hold the bound port. Call its `cleanup` to stop serving
+        """
+
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler) -> web.StreamResponse:
+        route = f"{request.method} {request.match_info.route.resource.canonical if request.match_info.route.resource else request.path}"
+        self.requests[route] += 1
+
+        # Half the delay is spent reaching the server and half getting back, so a request changes the
+        # player state partway through its round trip like it does on Spotify
+        delay = self.faults.delay()
+        if delay:
+            await asyncio.sleep(delay / 2)
+
+        response = await self._spotify_fault(request) if request.path.startswith("/v1/") else None
+        if response is None:
+            response = await handler(request)
+        if delay:
+            await asyncio.sleep(delay / 2)
+        self.statuses[response.status] += 1
+        return response
+
+    async def _spotify_fault(self, request: web.Request) -> web.Response | None:
+        """
+        :returns: The error to answer a Spotify request with, or `None` to serve it normally
+        """
+
+        if request.headers.get("Authorization") != f"Bearer {self.access_token}":
+            return self._error(401, "The access token expired")
+        roll = random.random()
+        if roll < self.faults.unauthorized_rate:
+            self.expire_token()
+            return self._error(401, "The access token expired")
+        roll -= self.faults.unauthorized_rate
+        if roll < self.faults.rate_limit_rate:
+            response = self._error(429, "API rate limit exceeded")
+            response.headers["Retry-After"] = f"{self.faults.retry_after:g}"
+            return response
+        roll -= self.faults.rate_limit_rate
+        if roll < self.faults.error_rate:
+            return self._error(500, "Server error")
+        return None
+
+    @staticmethod
+    def _error(status: int, message: str) -> web.Response:
+        return web.json_response({"error": {"status": status, "message": message}}, status=status)
+
+    def _device(self, request: web.Request) -> Dict | None:
+        """
+        :returns: The device a player request targets, defaulting to the active one
+        """
+
+        return self.devices.get(request.query.get("device_id") or self.active_device)
+
+    def _progress(self) -> int:
+        if self.playing and self.item is not None:
+            elapsed = int((time.monotonic() - self.updated_at) * 1000)
+            self.progress_ms = min(self.progress_ms + elapsed, self.item["duration_ms"])
+        self.updated_at = time.monotonic()
+        return self.progress_ms
+
+    # ======== Auth server ========
+
+    async def get_access_token(self, request: web.Request) -> web.Response:
+        if request.match_info["state"] != self.state:
+            return web.json_response({"error": "Received bad state"}, status=401)
+        return web.json_response({"access_token": self.access_token, "refresh_token": self.refresh_token, "expires_in": 3600})
+
+    async def delete_access_token(self, request: web.Request) -> web.Response:
+        if request.match_info["state"] != self.state:
+            return web.json_response({"error": "Received bad state"}, status=401)
+        return web.json_response({"status": 204}, status=204)
+
+    async def post_refresh_token(self, request: web.Request) -> web.Response:
+        if request.query.get("state") != self.state:
+            return web.json_response({"error": "Received bad state"}, status=401)
+        if request.query.get("refresh_token") != self.refresh_token:
+            return web.json_response({"error": "invalid_grant"}, status=400)
+        self.expire_token()
+        return web.json_response({"access_token": self.access_token, "refresh_token": self.refresh_token, "expires_at": time.time() + 3600})
+
+    # ======== Spotify Web API ========
+
+    async def search(self, request: web.Request) -> web.Response:
+        query = request.query.get("q", "")
+        limit = int(request.query.get("limit", "20"))
+        offset = int(request.query.get("offset", "0"))
+        # Every query finds tracks, starting at a position derived from the query so different
+        # queries get different results
+        start = sum(query.encode()) % len(self.tracks)
+        items = [self.tracks[(start + offset + index) % len(self.tracks)] for index in range(limit)]
+        body = {}
+        for type in request.query.get("type", "track").split(","):
+            if type == "track":
+                body["tracks"] = {"items": items, "limit": limit, "offset": offset, "total": len(self.tracks)}
+            else:
+                body[f"{type}s"] = {"items": [], "limit": limit, "offset": offset, "total": 0}
+        return web.json_response(body)
+
+    async def get_track(self, request: web.Request) -> web.Response:
+        for track in self.tracks:
+            if track["id"] == request.match_info["id"]:
+                return web.json_response(track)
+        return self._error(404, "Non existing id")
+
+    async def get_player(self, request: web.Request) -> web.Response:
+        if self.active_device is None:
+            return web.Response(status=204)
+        return web.json_response({
+            "device": self.devices[self.active_device],
+            "is_playing": self.playing,
+            "progress_ms": self._progress(),
+            "item": self.item,
+            "currently_playing_type": "track",
+        })
+
+    async def transfer(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        device = self.devices.get((body.get("device_ids") or [None])[0])
+        if device is None:
+            return self._error(404, "Device not found")
+        for other in self.devices.values():
+            other["is_active"] = other is device
+        self._progress()
+        self.active_device = device["id"]
+        self.playing = body.get("play", self.playing)
+        return web.Response(status=204)
+
+    async def play(self, request: web.Request) -> web.Response:
+        device = self._device(request)
+        if device is None:
+            return self._error(404, "Device not found")
+        self._progress()
+        self.active_device = device["id"]
+        if self.item is None and self.queue:
+            self.item = self.queue.popleft()
+        self.playing = True
+        return web.Response(status=204)
+
+    async def pause(self, request: web.Request) -> web.Response:
+        if self._device(request) is None:
+            return self._error(404, "Device not found")
+        self._progress()
+        self.playing = False
+        return web.Response(status=204)
+
+    async def next(self, request: web.Request) -> web.Response:
+        if self._device(request) is None:
+            return self._error(404, "Device not found")
+        if self.item is not None:
+            self.history.append(self.item)
+        self.item = self.queue.popleft() if self.queue else None
+        self.progress_ms = 0
+        self.updated_at = time.monotonic()
+        return web.Response(status=204)
+
+    async def previous(self, request: web.Request) -> web.Response:
+        if self._device(request) is None:
+            return self._error(404, "Device not found")
+        if self.history:
+            if self.item is not None:
+                self.queue.appendleft(self.item)
+            self.item = self.history.pop()
+        self.progress_ms = 0
+        self.updated_at = time.monotonic()
+        return web.Response(status=204)
+
+    async def seek(self, request: web.Request) -> web.Response:
+        if self._device(request) is None:
+            return self._error(404, "Device not found")
+        self.progress_ms = int(request.query.get("position_ms", "0"))
+        self.updated_at = time.monotonic()
+        return web.Response(status=204)
+
+    async def volume(self, request: web.Request) -> web.Response:
+        device = self._device(request)
+        if device is None:
+            return self._error(404, "Device not found")
+        device["volume_percent"] = int(request.query.get("volume_percent", "100"))
+        return web.Response(status=204)
+
+    async def get_devices(self, request: web.Request) -> web.Response:
+        return web.json_response({"devices": list(self.devices.values())})
+
+    async def get_queue(self, request: web.Request) -> web.Response:
+        return web.json_response({"currently_playing": self.item, "queue": list(self.queue)[:20]})
+
+    async def add_to_queue(self, request: web.Request) -> web.Response:
+        if self._device(request) is None:
+            return self._error(404, "Device not found")
+        uri = request.query.get("uri", "")
+        for track in self.tracks:
+            if track["uri"] == uri:
+                self.queue.append(track)
+                return web.Response(status=204)
+        return self._error(400, "Invalid track uri")
+
+
+def add_fault_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to delay every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Up to this many extra seconds of delay")
+    parser.add_argument("--unauthorized-rate", type=float, default=0.0, help="Fraction of requests that expire the access token")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of requests answered with a 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with a 500")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="The Retry-After sent with a 429, in seconds")
+
+
+def faults_from_arguments(args: argparse.Namespace) -> Faults:
+    return Faults(args.latency, args.jitter, args.unauthorized_rate, args.rate_limit_rate, args.error_rate, args.retry_after)
+
+
+async def serve(fake: FakeSpotify, host: str, port: int):
+    runner = await fake.start(host, port)
+    print(f"Serving fake Spotify on http://{host}:{port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8888)
+    parser.add_argument("--state", default="fake-security", help="The AUTH_SERVER_SECURITY the bot will send")
+    parser.add_argument("--device", action="append", default=[], help="A device name to report, usually BOT_NAME. May be repeated")
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+
+    fake = FakeSpotify(faults_from_arguments(args), args.device, args.state)
+    try:
+        asyncio.run(serve(fake, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Compares the two ways the bot can get Opus packets to Discord while several guilds stream at once.
+
+"pcm" is the native backend: the voice player thread resamples each frame with NumPy and then Opus
+encodes it with libopus, all inside the bot process. "opus" is the `MUSIC_AUDIO_BACKEND=opus` backend:
+ffmpeg resamples and encodes in its own process and the player thread only reads finished packets.
+
+Each stream runs on its own thread paced like discord.py's player, while the event loop measures how
+late a 10 ms sleep wakes up. Event loop lag is what the bot's commands and heartbeats feel.
+
+Run from the repository root with `python -m benchmarks.opus_benchmark`
+"""
+
+from typing import Callable, Dict, List, Tuple
+import argparse
+import asyncio
+import io
+import resource
+import shutil
+import statistics
+import threading
+import time
+import discord
+import audio
+from benchmarks.audio_benchmark import synthetic_audio
+
+
+# How often the event loop probe wakes up
+PROBE_INTERVAL = 0.01
+
+
+def children_cpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def pcm_stream(pcm: bytes) -> Tuple[Callable[[], bytes], Callable[[], None]] | None:
+    """
+    :returns: A function producing the next Opus packet with the native backend and a function
+              cleaning it up, or `None` if libopus isn't available
+    """
+
+    if not discord.opus.is_loaded():
+        try:
+            discord.opus._load_default()
+        except Exception:
+            return None
+        if not discord.opus.is_loaded():
+            return None
+
+    source = audio.create_music_source(io.BytesIO(pcm), backend="native")
+    encoder = discord.opus.Encoder()
+
+    def read() -> bytes:
+        frame = source.read()
+        return encoder.encode(frame, encoder.SAMPLES_PER_FRAME) if frame else b""
+    return read, source.cleanup
+
+
+def opus_stream(pcm: bytes) -> Tuple[Callable[[], bytes], Callable[[], None]] | None:
+    """
+    :returns: A function producing the next Opus packet with the opus backend and a function
+              cleaning it up, or `None` if ffmpeg isn't installed
+    """
+
+    if shutil.which("ffmpeg") is None:
+        return None
+
+    source = audio.create_music_source(io.BytesIO(pcm), backend="opus")
+    return source.read, source.cleanup
+
+
+def play(read: Callable[[], bytes], speed: float, packets: List[int]):
+    """
+    Reads packets the way discord.py's `AudioPlayer` does, one every 20 ms divided by `speed`
+    """
+
+    delay = audio.FRAME_DURATION / speed
+    next_frame = time.perf_counter()
+    while read():
+        packets[0] += 1
+        next_frame += delay
+        time.sleep(max(0.0, next_frame - time.perf_counter()))
+
+
+async def probe_lag(running: Callable[[], bool]) -> List[float]:
+    lags = []
+    loop = asyncio.get_running_loop()
+    while running():
+        start = loop.time()
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(loop.time() - start - PROBE_INTERVAL)
+    return lags
+
+
+async def bench(stream: Callable, pcm: bytes, streams: int, speed: float) -> Dict[str, float] | None:
+    readers = [stream(pcm) for _ in range(streams)]
+    if any(reader is None for reader in readers):
+        for reader in readers:
+            if reader is not None:
+                reader[1]()
+        return None
+
+    packets = [0]
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    child = children_cpu()
+    threads = [threading.Thread(target=play, args=(read, speed, packets)) for read, _ in readers]
+    for thread in threads:
+        thread.start()
+    lags = await probe_lag(lambda: any(thread.is_alive() for thread in threads))
+    for thread in threads:
+        thread.join()
+    for _, cleanup in readers:
+        cleanup()
+
+    lags.sort()
+    return {
+        "bot_cpu": time.process_time() - cpu,
+        "child_cpu": children_cpu() - child,
+        "wall": time.perf_counter() - wall,
+        "packets": packets[0],
+        "lag_mean": statistics.fmean(lags) if lags else 0.0,
+        "lag_p99": lags[int(len(lags) * 0.99)] if lags else 0.0,
+        "lag_max": lags[-1] if lags else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=30, help="How many seconds of audio each stream plays")
+    parser.add_argument("--streams", type=int, default=4, help="How many guilds stream at once")
+    parser.add_argument("--speed", type=float, default=1, help="How many times faster than real time to run")
+    args = parser.parse_args()
+
+    pcm = synthetic_audio(args.seconds)
+    print(f"{args.streams} streams of {args.seconds:g} seconds at {args.speed:g}x real time\n")
+    print(f"{'mode':<6} {'bot cpu':>9} {'child cpu':>10} {'cpu/stream/s':>13} {'lag mean':>9} {'lag p99':>9} {'lag max':>9}")
+    for name, stream in (("pcm", pcm_stream), ("opus", opus_stream)):
+        result = asyncio.run(bench(stream, pcm, args.streams, args.speed))
+        if result is None:
+            reason = "libopus is not installed" if name == "pcm" else "ffmpeg is not installed"
+            print(f"{name:<6} skipped, {reason}")
+            continue
+        per_stream = (result["bot_cpu"] + result["child_cpu"]) / args.streams / args.seconds * 1000
+        print(
+            f"{name:<6} {result['bot_cpu']:>8.3f}s {result['child_cpu']:>9.3f}s {per_stream:>11.2f}ms "
+            f"{result['lag_mean'] * 1000:>7.2f}ms {result['lag_p99'] * 1000:>7.2f}ms {result['lag_max'] * 1000:>7.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+Drives `spotify_controller.rollover_librespot` against the Spotify stand-in from `benchmarks.fake_spotify`
+and checks that the voice player loses no audio across it.
+
+The controller starts fake librespot processes instead of real ones. Each registers its device name
+with the fake Spotify when it starts and drops the device again when it is stopped, and writes the
+song into its pipe as a numbered ramp of stereo samples, but only while Spotify has it as the active,
+playing device. The song's position is shared between the processes the way Spotify keeps it across
+a transfer, so the audio only continues if playback really was handed to the replacement.
+
+Partway through the song the worker is rolled over. The harness checks that the replacement registered
+a device of its own, that Spotify ends up playing on it, that the old device is gone, and that every
+sample read by the player follows the one before it with no gaps, repeats or padded frames.
+
+Run from the repository root with `python -m benchmarks.rollover_harness`
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import threading
+import time
+import numpy as np
+import audio
+from benchmarks.fake_spotify import FakeSpotify, add_fault_arguments, faults_from_arguments
+
+
+GUILD_ID = 1
+
+
+def ramp(start: int, count: int) -> bytes:
+    """
+    :returns: `count` stereo samples numbered from `start`, wrapped to fit in 16 bits
+    """
+
+    values = ((np.arange(start, start + count) % 65536) - 32768).astype("<i2")
+    return np.stack((values, values), axis=1).tobytes()
+
+
+class Song:
+    """
+    The playback position Spotify keeps for the account, shared by every fake librespot
+    """
+
+    def __init__(self, samples: int, speed: float) -> None:
+        self.samples = samples
+        self.speed = speed
+        self.position = 0
+        self.lock = threading.Lock()
+
+    @property
+    def finished(self) -> bool:
+        return self.position >= self.samples
+
+
+class FakeLibrespot:
+    """
+    Stands in for `librespot_supervisor.LibrespotProcess`, registering a device on the fake Spotify
+    instead of running librespot
+    """
+
+    def __init__(self, fake: FakeSpotify, song: Song, device_name: str) -> None:
+        self.fake = fake
+        self.song = song
+        self.device_name = device_name
+        self.device_id: str | None = None
+        self.pcm: audio.PCMRingBuffer | None = None
+        self._stopped = threading.Event()
+        self._writer: threading.Thread | None = None
+
+    def start(self):
+        read_fd, write_fd = os.pipe()
+        self.pcm = audio.PCMRingBuffer(os.fdopen(read_fd, "rb"))
+        self.pcm.start()
+        self.device_id = self.fake.add_device(self.device_name)["id"]
+        self._writer = threading.Thread(target=self._write, args=(write_fd,), daemon=True)
+        self._writer.start()
+
+    def _write(self, write_fd: int):
+        with os.fdopen(write_fd, "wb", buffering=0) as pipe:
+            while not self._stopped.is_set():
+                with self.song.lock:
+                    # Only the device Spotify is playing on gets audio, and only one device is active
+                    active = self.fake.active_device == self.device_id and self.fake.playing
+                    count = min(audio.INPUT_FRAME_SAMPLES, self.song.samples - self.song.position)
+                    if active and count > 0:
+                        pipe.write(ramp(self.song.position, count))
+                        self.song.position += count
+                time.sleep(audio.FRAME_DURATION / self.song.speed)
+
+    async def wait_ready(self, timeout: float) -> bool:
+        return self._writer is not None and not self._stopped.is_set()
+
+    def poll(self) -> int | None:
+        return 0 if self._stopped.is_set() else None
+
+    def terminate(self):
+        self._stopped.set()
+        if self.device_id is not None:
+            self.fake.remove_device(self.device_id)
+        if self.pcm:
+            self.pcm.close()
+
+
+def play(feed: audio.PCMSwitcher, received: bytearray, counts: dict):
+    """
+    Reads the feed 20 ms at a time the way the voice player does, until it runs dry
+    """
+
+    while True:
+        frame = bytearray()
+        while len(frame) < audio.INPUT_FRAME_BYTES:
+            data = feed.read(audio.INPUT_FRAME_BYTES - len(frame))
+            if not data:
+                break
+            frame += data
+        if not frame:
+            return
+        counts["frames"] += 1
+        if len(frame) < audio.INPUT_FRAME_BYTES:
+            counts["padded"] += 1
+        received.extend(frame)
+
+
+async def rollover(args: argparse.Namespace) -> bool:
+    fake = FakeSpotify(faults_from_arguments(args))
+    runner = await fake.start()
+    port = runner.addresses[0][1]
+
+    # The controller reads where Spotify is when it is imported
+    os.environ["SPOTIFY_API_PREFIX"] = f"http://127.0.0.1:{port}/v1"
+    os.environ["AUTH_SERVER"] = f"http://127.0.0.1:{port}"
+    os.environ["AUTH_SERVER_SECURITY"] = fake.state
+    os.environ.setdefault("BOT_NAME", "Benchmark Bot")
+    import spotify_controller as controller
+
+    samples = int(args.seconds * audio.LIBRESPOT_SAMPLE_RATE)
+    song = Song(samples - samples % audio.INPUT_FRAME_SAMPLES, args.speed)
+    controller._new_librespot = lambda worker, access_token, device_name=None: FakeLibrespot(
+        fake, song, device_name or worker.device_name
+    )
+
+    received = bytearray()
+    counts = {"frames": 0, "padded": 0}
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            await controller.start_librespot(GUILD_ID)
+            worker = controller.workers.get(GUILD_ID)
+            # The harness rolls the worker over itself rather than waiting out the refresh interval
+            worker.refresh_task.cancel()
+            if not await controller.wait_for_librespot(GUILD_ID):
+                print("FAIL: the first fake librespot never showed up as a device")
+                return False
+            await controller.switch_to_device(GUILD_ID)
+
+            player = threading.Thread(target=play, args=(worker.pcm_feed, received, counts))
+            player.start()
+
+            while song.position < song.samples // 2:
+                await asyncio.sleep(0.01)
+            old_device = worker.device_id
+            start = time.perf_counter()
+            handed_over = await controller.rollover_librespot(worker)
+            elapsed = time.perf_counter() - start
+            new_device = worker.device_id
+
+            deadline = time.monotonic() + args.seconds / args.speed * 2 + 10
+            while len(received) < song.samples * audio.FRAME_SIZE and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+            active_device = fake.active_device
+            old_listed = old_device in fake.devices
+            worker.stop()
+            await asyncio.to_thread(player.join)
+    finally:
+        controller.playback.stop()
+        controller.workers.release(GUILD_ID)
+        await controller.close_session()
+        await runner.cleanup()
+
+    numbers = np.frombuffer(bytes(received), dtype="<i2").reshape(-1, 2)[:, 0].astype(np.int64) + 32768
+    steps = np.diff(numbers) % 65536
+    expected_frames = song.samples // audio.INPUT_FRAME_SAMPLES
+
+    print(f"handover:        {'done' if handed_over else 'failed'} in {elapsed * 1000:.1f}ms")
+    print(f"old device:      {old_device} ({'still listed' if old_listed else 'removed'})")
+    print(f"new device:      {new_device}")
+    print(f"active device:   {active_device}")
+    print(f"frames played:   {counts['frames']} of {expected_frames}")
+    print(f"padded frames:   {counts['padded']}")
+    print(f"sample gaps:     {int(np.count_nonzero(steps != 1))}")
+    print(f"handovers:       {worker.pcm_feed.switches}")
+
+    checks = {
+        "the rollover did not hand playback over": handed_over,
+        "the replacement reused the old device": new_device is not None and new_device != old_device,
+        "Spotify is not playing on the replacement": active_device == new_device,
+        "the old device is still registered": not old_listed,
+        "audio was lost across the rollover": counts["frames"] == expected_frames and counts["padded"] == 0
+                                              and not np.any(steps != 1),
+    }
+    failures = [message for message, ok in checks.items() if not ok]
+    for message in failures:
+        print(f"FAIL: {message}")
+    if not failures:
+        print("PASS: playback moved to the replacement device with no frames dropped")
+    return not failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=10, help="How long the song being played is")
+    parser.add_argument("--speed", type=float, default=10, help="How many times faster than real time to run")
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+
+    raise SystemExit(0 if asyncio.run(rollover(args)) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Runs the music cog's `.skip` against the Spotify stand-in from `benchmarks.fake_spotify` and checks that
+the voice player hears the new song from its first sample.
+
+A fake librespot, started by the controller as in `benchmarks.rollover_harness`, writes whichever song
+the fake Spotify is playing in real time, a little ahead of the player like librespot keeps the
+buffer topped up. Every sample is tagged with the song it belongs to and the 20 ms frame of that song
+it came from. `.skip` is run partway through the first song, and the harness checks that the first
+audio of the next song the player reads is its first frame and that no frame of it is missing.
+
+Run from the repository root with `python -m benchmarks.skip_harness`
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import threading
+import time
+import types
+import numpy as np
+import audio
+from benchmarks.fake_spotify import FakeSpotify, add_fault_arguments, faults_from_arguments
+from benchmarks.rollover_harness import FakeLibrespot
+
+
+GUILD_ID = 1
+
+
+def tagged_frame(song: int, frame: int) -> bytes:
+    """
+    :returns: One frame of stereo samples carrying the song number on the left and the frame number on the right
+    """
+
+    samples = np.empty((audio.INPUT_FRAME_SAMPLES, 2), dtype="<i2")
+    samples[:, 0] = song
+    samples[:, 1] = frame % 32768
+    return samples.tobytes()
+
+
+class PlayingLibrespot(FakeLibrespot):
+    """
+    A fake librespot that writes whatever song the fake Spotify is playing on its device, starting each
+    song from its first frame
+    """
+
+    def _write(self, write_fd: int):
+        song, frame = None, 0
+        next_write = time.monotonic()
+        with os.fdopen(write_fd, "wb", buffering=0) as pipe:
+            while not self._stopped.is_set():
+                item = self.fake.item
+                if self.fake.active_device == self.device_id and self.fake.playing and item is not None:
+                    number = int(item["id"])
+                    if number != song:
+                        song, frame = number, 0
+                    pipe.write(tagged_frame(song, frame))
+                    frame += 1
+                next_write += audio.FRAME_DURATION
+                time.sleep(max(0.0, next_write - time.monotonic()))
+
+
+def play(feed: audio.PCMSwitcher, received: bytearray, stop: threading.Event):
+    """
+    Reads the feed 20 ms at a time in real time, the way the voice player does
+    """
+
+    next_read = time.monotonic()
+    while not stop.is_set():
+        received.extend(feed.read(audio.INPUT_FRAME_BYTES))
+        next_read += audio.FRAME_DURATION
+        time.sleep(max(0.0, next_read - time.monotonic()))
+
+
+async def skip(args: argparse.Namespace) -> bool:
+    fake = FakeSpotify(faults_from_arguments(args))
+    runner = await fake.start()
+    port = runner.addresses[0][1]
+
+    # The controller reads where Spotify is when it is imported
+    os.environ["SPOTIFY_API_PREFIX"] = f"http://127.0.0.1:{port}/v1"
+    os.environ["AUTH_SERVER"] = f"http://127.0.0.1:{port}"
+    os.environ["AUTH_SERVER_SECURITY"] = fake.state
+    os.environ.setdefault("BOT_NAME", "Benchmark Bot")
+    import spotify_controller as controller
+    from cogs.music import Music
+
+    controller._new_librespot = lambda worker, access_token, device_name=None: PlayingLibrespot(
+        fake, None, device_name or worker.device_name
+    )
+    fake.item = fake.tracks[1]
+    fake.queue.append(fake.tracks[2])
+
+    music = Music(None)
+    replies = []
+
+    async def reply(message):
+        replies.append(message)
+
+    ctx = types.SimpleNamespace(guild=types.SimpleNamespace(id=GUILD_ID, voice_client=object()), reply=reply)
+
+    received = bytearray()
+    stop = threading.Event()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            await controller.start_librespot(GUILD_ID)
+            worker = controller.workers.get(GUILD_ID)
+            worker.refresh_task.cancel()
+            if not await controller.wait_for_librespot(GUILD_ID):
+                print("FAIL: the fake librespot never showed up as a device")
+                return False
+            await controller.switch_to_device(GUILD_ID)
+
+            # librespot stays a little ahead of the player, so some of the first song is always buffered
+            await asyncio.sleep(args.lead)
+            player = threading.Thread(target=play, args=(worker.pcm_feed, received, stop))
+            player.start()
+
+            await asyncio.sleep(args.seconds)
+            skipped_at = len(received)
+            start = time.perf_counter()
+            await music.skip_command.callback(music, ctx)
+            elapsed = time.perf_counter() - start
+            await asyncio.sleep(args.seconds)
+            stop.set()
+            await asyncio.to_thread(player.join)
+    finally:
+        music.enqueue_tasks.clear()
+        controller.playback.listeners.remove(music.on_playback_state)
+        controller.stop_all_librespot()
+        await controller.close_session()
+        await runner.cleanup()
+
+    samples = np.frombuffer(bytes(received), dtype="<i2").reshape(-1, 2)
+    songs, frames = samples[:, 0], samples[:, 1]
+    first, second = int(fake.tracks[1]["id"]), int(fake.tracks[2]["id"])
+    new = np.flatnonzero(songs == second)
+    old_after_skip = int(np.count_nonzero(songs[skipped_at // audio.FRAME_SIZE:] == first))
+
+    if len(new) == 0:
+        print("FAIL: the next song never played")
+        return False
+    new_frames = frames[new]
+    first_frame = int(new_frames[0])
+    missing = int(np.count_nonzero(np.diff(new_frames) > 1))
+
+    print(f"skip took:                 {elapsed * 1000:.1f}ms")
+    print(f"old song heard after skip: {old_after_skip / audio.LIBRESPOT_SAMPLE_RATE * 1000:.1f}ms")
+    print(f"new song starts at frame:  {first_frame}")
+    print(f"new song frames missing:   {missing}")
+    print(f"reply:                     {replies[-1] if replies else None}")
+
+    ok = first_frame == 0 and missing == 0
+    print("PASS: the next song played from its start" if ok else "FAIL: the start of the next song was thrown away")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=1, help="How long to play before and after the skip")
+    parser.add_argument("--lead", type=float, default=0.2, help="How far ahead of the player librespot runs, in seconds")
+    add_fault_arguments(parser)
+    parser.set_defaults(latency=0.1)
+    args = parser.parse_args()
+
+    raise SystemExit(0 if asyncio.run(skip(args)) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+import discord
+from discord.ext import commands
+from aiohttp import web
+import asyncio
+import os
+import spotify_controller
+import voice_stats
+
+
+# The port to serve Prometheus metrics on. Leave unset to not serve metrics
+METRICS_PORT = os.getenv("METRICS_PORT")
+# The address to serve Prometheus metrics on
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+
+
+class Metrics(commands.Cog):
+    def __init__(self, bot):
+        """
+        Initializes the Metrics cog with the bot instance.
+
+        Parameters:
+        - bot (commands.Bot): The bot instance to associate with this cog.
+        """
+        self.bot = bot
+        self.runner = None
+
+    async def cog_load(self):
+        """
+        Starts serving `/metrics` in the Prometheus text format if `METRICS_PORT` is set.
+        """
+        if not METRICS_PORT:
+            return
+
+        app = web.Application()
+        app.router.add_get("/metrics", self.metrics_handler)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, METRICS_HOST, int(METRICS_PORT)).start()
+        print(f"Serving metrics on {METRICS_HOST}:{METRICS_PORT}")
+
+    async def cog_unload(self):
+        """
+        Stops serving metrics.
+        """
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def metrics_handler(self, request):
+        """
+        Responds with every guild's voice stats along with the cache counters.
+
+        Parameters:
+        - request (web.Request): The scrape request.
+        """
+        text = voice_stats.render_prometheus() + await self.render_cache_metrics()
+        return web.Response(text=text, content_type="text/plain", charset="utf-8")
+
+    async def render_cache_metrics(self):
+        """
+        Renders the librespot audio cache, search cache and track cache counters in the Prometheus
+        text format.
+
+        Returns:
+        - str: The metrics text.
+        """
+        librespot = spotify_controller.librespot_cache.stats()
+        files, size = await asyncio.to_thread(spotify_controller.librespot_cache.usage)
+        search = spotify_controller.search_cache.stats()
+        tracks = spotify_controller.track_cache.stats()
+
+        metrics = (
+            ("librespot_cache_hits_total", "counter", "Audio files librespot played from its cache", librespot["hits"]),
+            ("librespot_cache_misses_total", "counter", "Audio files librespot had to download", librespot["misses"]),
+            ("librespot_cache_evicted_files_total", "counter", "Audio files evicted from the cache by the bot", librespot["evicted_files"]),
+            ("librespot_cache_files", "gauge", "Audio files in the cache", files),
+            ("librespot_cache_bytes", "gauge", "Bytes used by the audio cache", size),
+            ("librespot_cache_limit_bytes", "gauge", "The most bytes the audio cache may use", librespot["limit_bytes"]),
+            ("search_cache_hits_total", "counter", "Searches answered from memory", search["hits"]),
+            ("search_cache_negative_hits_total", "counter", "Searches answered from a cached empty result", search["negative_hits"]),
+            ("search_cache_disk_hits_total", "counter", "Searches answered from the on-disk cache", search["disk_hits"]),
+            ("search_cache_misses_total", "counter", "Searches that had to ask Spotify", search["misses"]),
+            ("search_cache_size", "gauge", "Searches held in memory", search["size"]),
+            ("track_cache_hits_total", "counter", "Song details answered from memory", tracks["hits"]),
+            ("track_cache_disk_hits_total", "counter", "Song details answered from the on-disk cache", tracks["disk_hits"]),
+            ("track_cache_misses_total", "counter", "Song details that had to be fetched from Spotify", tracks["misses"]),
+            ("track_cache_size", "gauge", "Songs held in memory", tracks["size"]),
+        )
+        lines = []
+        for name, kind, help, value in metrics:
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+    # ======== Commands ========
+
+    @commands.command(name="voicestats", help="Shows how smoothly audio is being sent in this server.")
+    async def voice_stats_command(self, ctx):
+        """
+        **Usage:** `.voicestats`
+
+        **Description:**
+        Shows frame timing for music and soundboard audio in this server: how long each frame took to
+        produce, how regularly frames were sent, and how often audio ran late, dropped out or stalled.
+        Slow reads point at librespot or ffmpeg, while late frames with fast reads point at the bot itself.
+        """
+        stats = voice_stats.guild_stats(ctx.guild.id)
+        if not stats:
+            await ctx.reply("No audio has played in this server yet.")
+            return
+
+        embed = discord.Embed(title="Voice Stats", color=discord.Color.blurple())
+        for kind, kind_stats in sorted(stats.items()):
+            summary = kind_stats.summary()
+            embed.add_field(
+                name=kind.capitalize(),
+                value=(
+                    f"Frames: {summary['frames']}\n"
+                    f"Late: {summary['late_frames']}, dropped: {summary['dropped_frames']}\n"
+                    f"Underruns: {summary['underruns']}\n"
+                    f"Stalls: {summary['stalls']} (longest {summary['longest_stall_ms']:.1f}ms)\n"
+                    f"Read time: p50 {summary['read_p50_ms']:.2f}ms, p99 {summary['read_p99_ms']:.2f}ms, max {summary['read_max_ms']:.2f}ms\n"
+                    f"Frame interval: p50 {summary['interval_p50_ms']:.1f}ms, p99 {summary['interval_p99_ms']:.1f}ms"
+                ),
+                inline=False,
+            )
+
+        await ctx.reply(embed=embed)
+
+    @commands.command(name="cachestats", help="Shows how well the bot's caches are working.")
+    async def cache_stats_command(self, ctx):
+        """
+        **Usage:** `.cachestats`
+
+        **Description:**
+        Shows how often songs were played from librespot's audio cache instead of being downloaded,
+        how much disk space the cache uses, and how often searches and song details were answered
+        without asking Spotify.
+        """
+        cache = spotify_controller.librespot_cache
+        embed = discord.Embed(title="Cache Stats", color=discord.Color.blurple())
+
+        if cache.enabled:
+            stats = cache.stats()
+            files, size = await asyncio.to_thread(cache.usage)
+            embed.add_field(
+                name="Audio",
+                value=(
+                    f"Hits: {stats['hits']}, misses: {stats['misses']} ({stats['hit_ratio']:.0%} hit rate)\n"
+                    f"{files} files using {size / 1024 ** 2:.0f} of {stats['limit_bytes'] / 1024 ** 2:.0f} MiB\n"
+                    f"Evicted: {stats['evicted_files']} files"
+                ),
+                inline=False,
+            )
+        else:
+            embed.add_field(name="Audio", value="Caching is disabled. Set `LIBRESPOT_CACHE_DIR` to enable it.", inline=False)
+
+        search = spotify_controller.search_cache.stats()
+        embed.add_field(
+            name="Searches",
+            value=f"Hits: {search['hits'] + search['negative_hits'] + search['disk_hits']}, misses: {search['misses']}, cached: {search['size']}",
+            inline=False,
+        )
+        tracks = spotify_controller.track_cache.stats()
+        embed.add_field(
+            name="Song details",
+            value=f"Hits: {tracks['hits'] + tracks['disk_hits']}, misses: {tracks['misses']}, cached: {tracks['size']}",
+            inline=False,
+        )
+
+        await ctx.reply(embed=embed)
+
+
+async def setup(bot):
+    """
+    Sets up the Metrics cog by adding it to the bot client.
+
+    Parameters:
+    - bot (commands.Bot): The bot instance to add the cog to.
+    """
+    await bot.add_cog(Metrics(bot))
@@ -1,12 +1,24 @@
+import asyncio
 import json
 import discord
 from discord.ext import commands
 import os
 import urllib.parse
-import requests
-import urllib.parse
+from cachetools import TTLCache
 import spotify_controller
-import time
+import audio
+import voice_stats
+from song_queue import GuildQueue
+
+
+# The most songs listed in a queue or history embed. Discord allows 25 fields per embed
+EMBED_SONG_LIMIT = 20
+# What `.search` looks for, all in one request
+SEARCH_TYPES = ("track", "album", "playlist", "artist")
+# How many results of each type `.search` offers. A Discord menu holds at most 25 options
+SEARCH_RESULT_LIMIT = min(int(os.getenv("SEARCH_RESULT_LIMIT", "5")), 25 // len(SEARCH_TYPES))
+# How long a user can pick from their last search before having to search again
+SEARCH_RESULT_TTL = float(os.getenv("SEARCH_RESULT_TTL", "300"))
 
 
 def humanize_duration(seconds: int) -> str:
@@ -56,50 +68,102 @@ class Music(commands.Cog):
         - bot (commands.Bot): The bot instance to which the cog will be added.
         """
         self.bot = bot
+        self.enqueue_tasks = set()
+        self.queues = {}
+        self.channels = {}
+        self.search_results = TTLCache(maxsize=1024, ttl=SEARCH_RESULT_TTL)
+        spotify_controller.playback.listeners.append(self.on_playback_state)
+
+    async def cog_unload(self):
+        """
+        Closes the shared Spotify HTTP session when the cog is unloaded.
+        """
+        for task in self.enqueue_tasks:
+            task.cancel()
+        spotify_controller.playback.listeners.remove(self.on_playback_state)
+        spotify_controller.stop_all_librespot()
+        await spotify_controller.close_session()
 
     # ======== Data Processing ========
 
+    def song_queue(self, guild_id):
+        """
+        Returns a guild's queue and history, creating them the first time the guild plays something.
+
+        Parameters:
+        - guild_id (int): The guild to look up.
+
+        Returns:
+        - GuildQueue: The guild's queue.
+        """
+        queue = self.queues.get(guild_id)
+        if queue is None:
+            queue = self.queues[guild_id] = GuildQueue()
+        return queue
+
+    def on_playback_state(self, state):
+        """
+        Moves the queue of the guild that is playing along with what Spotify reports, so songs that
+        ended or were skipped elsewhere leave the queue without anyone asking.
+
+        Parameters:
+        - state (PlaybackState): The playback state Spotify just reported.
+        """
+        guild_id = spotify_controller.guild_for_device(state.device_id)
+        if guild_id is None or guild_id not in self.queues or not state.track:
+            return
+
+        queue = self.queues[guild_id]
+        previous = queue.current
+        queue.sync(spotify_controller.track_cache.remember(state.track))
+        channel = self.channels.get(guild_id)
+        if queue.current is not previous and channel is not None:
+            task = asyncio.create_task(self.send_now_playing(channel, queue.current))
+            self.enqueue_tasks.add(task)
+            task.add_done_callback(self.enqueue_tasks.discard)
+
     async def join_voice_channel(self, ctx):
         """
         Ensures the bot joins the same voice channel as the user who invoked the command.
 
         Parameters:
         - ctx (commands.Context): The context of the command invocation.
-        """
 
-        tokens = spotify_controller.get_access_token() 
+        Returns:
+        - bool: Whether the bot is in the user's voice channel with librespot running. The user has
+          already been told why when this is False.
+        """
 
-        # We have an access token, but it has expired, so refresh it
-        if tokens and "access_token" in tokens and tokens["access_token"] not in ("", None) and not spotify_controller.is_valid_token(tokens["access_token"]):
-            # There is no refresh token either, so the user must relog
-            if tokens["refresh_token"] in (None, ""):
-                print(f"No valid access token or refresh token found")
-                await ctx.reply("You are logged out. Try running `.login`")
-                return 
+        tokens = await spotify_controller.get_access_token() 
 
-            spotify_controller.refresh_token(tokens["refresh_token"])
+        # An expired access token is refreshed by the first Spotify request that gets rejected with it, 
+        # so it only matters here if there is nothing to refresh it with
+        if not tokens or (tokens.get("access_token") in ("", None) and tokens.get("refresh_token") in ("", None)):
+            print(f"No valid access token or refresh token found")
+            await ctx.reply("You are logged out. Try running `.login`")
+            return False
 
-        if spotify_controller.librespot is None:
-            spotify_controller.start_librespot()
-            wait_max = 10  # seconds
-            wait = 0
-            period = 1
-            while spotify_controller.get_bot_device_id() is None and wait < wait_max:
-                time.sleep(period)
-                wait += period
+        if spotify_controller.get_worker(ctx.guild.id) is None:
+            try:
+                await spotify_controller.start_librespot(ctx.guild.id)
+            except spotify_controller.PoolFullError:
+                await ctx.reply("Every music player is busy in another server right now. Try again later.")
+                return False
 
-            if spotify_controller.get_bot_device_id() is None: 
+            if not await spotify_controller.wait_for_librespot(ctx.guild.id):
                 print("Timeout attempting to start librespot.")
                 await ctx.reply("Timeout attempting to start librespot. You may need to log in first: `.login`")
-                return
+                return False
 
         if ctx.author.voice and ctx.author.voice.channel:
             if ctx.guild.voice_client is None:
                 await ctx.author.voice.channel.connect()
             else:
                 await ctx.guild.voice_client.move_to(ctx.author.voice.channel)
-        else:
-            await ctx.reply("You need to be in a voice channel to use this command.")
+            return True
+
+        await ctx.reply("You need to be in a voice channel to use this command.")
+        return False
 
     async def add_to_queue(self, ctx, query):
         """
@@ -108,36 +172,198 @@ class Music(commands.Cog):
         Parameters:
         - ctx (commands.Context): The context of the command invocation.
         - query (str): The song name or YouTube link to search for.
+
+        Returns:
+        - bool: False if the bot couldn't join the voice channel, so there is nothing to play.
         """
-        await self.join_voice_channel(ctx)
-        search_results = spotify_controller.search(f'"{query}"')
-        track_uri = search_results["tracks"]["items"][0]["uri"]
-        print("adding to queue", spotify_controller.add_to_queue(track_uri))
-        spotify_controller.switch_to_device()
-        if not spotify_controller.is_playing():
-            spotify_controller.play()
+        if not await self.join_voice_channel(ctx):
+            return False
+        self.channels[ctx.guild.id] = ctx.channel
+
+        link = spotify_controller.parse_spotify_link(query)
+        if link is not None and link[0] != "track":
+            await self.add_collection_to_queue(ctx, *link)
+            return True
 
-        # if self.currently_playing is not None:
-        #     await self.send_now_playing(ctx, info)
+        if link is not None:
+            track = await spotify_controller.get_track(link[1])
+            if track is None:
+                await ctx.reply("Couldn't find that song on Spotify.")
+                return True
+        else:
+            search_results = await spotify_controller.search(f'"{query}"')
+            if search_results is None:
+                await ctx.reply("Spotify didn't answer the search. Try again in a moment.")
+                return True
+            if not search_results["tracks"]["items"]:
+                await ctx.reply(f"Couldn't find anything for {query}.")
+                return True
+            track = spotify_controller.track_cache.remember(search_results["tracks"]["items"][0])
+
+        await self.queue_track(ctx, track)
+        return True
 
-    async def send_now_playing(self, ctx, info):
+    async def queue_track(self, ctx, track):
         """
-        Sends an embedded message with the current song's details, including title, duration, and thumbnail.
+        Queues a single song on Spotify and in the guild's queue, then makes sure it plays.
 
         Parameters:
         - ctx (commands.Context): The context of the command invocation.
-        - info (dict): Information about the song currently playing.
+        - track (Track): The song to queue.
         """
-        embed = discord.Embed(
-            title=info["title"], url=info["webpage_url"], color=discord.Color.blurple()
+        if await spotify_controller.add_to_queue(ctx.guild.id, track.uri) is None:
+            await ctx.reply("Spotify didn't accept the song. Try again in a moment.")
+            return
+        self.song_queue(ctx.guild.id).push(track)
+        await spotify_controller.switch_to_device(ctx.guild.id)
+        if not await spotify_controller.is_playing(ctx.guild.id):
+            await spotify_controller.play(ctx.guild.id)
+
+    async def play_search_result(self, ctx, result):
+        """
+        Queues something picked from `.search` using the URI saved with the search results, so
+        nothing has to be searched for again.
+
+        Parameters:
+        - ctx (commands.Context): The context of the `.search` invocation.
+        - result (dict): The picked result, as built by `search_options`.
+        """
+        if not await self.join_voice_channel(ctx):
+            return
+        self.channels[ctx.guild.id] = ctx.channel
+
+        kind, id = result["uri"].split(":")[1:]
+        if kind != "track":
+            await self.add_collection_to_queue(ctx, kind, id)
+        else:
+            track = await spotify_controller.get_track(id)
+            if track is None:
+                await ctx.reply("Couldn't find that song on Spotify.")
+                return
+            await self.queue_track(ctx, track)
+
+        voice_client = ctx.guild.voice_client
+        if voice_client and not voice_client.is_playing():
+            await self.play_next(ctx)
+
+    def search_options(self, body):
+        """
+        Flattens a multi-type Spotify search into the results offered by `.search`.
+
+        Parameters:
+        - body (dict): Spotify's json search results.
+
+        Returns:
+        - list[dict]: Each result's "uri", "label" and "description", tracks first.
+        """
+        options = []
+        for kind in SEARCH_TYPES:
+            # Spotify sometimes returns null in place of playlists it won't show
+            for item in filter(None, body.get(f"{kind}s", {}).get("items", [])):
+                if kind == "track":
+                    description = f"Song by {', '.join(artist['name'] for artist in item.get('artists', []))}"
+                elif kind == "album":
+                    description = f"Album by {', '.join(artist['name'] for artist in item.get('artists', []))}"
+                elif kind == "playlist":
+                    description = f"Playlist by {(item.get('owner') or {}).get('display_name') or 'Spotify'}"
+                else:
+                    description = "Artist"
+                options.append({"uri": item["uri"], "label": item["name"][:100] or "Untitled", "description": description[:100]})
+        return options
+
+    async def add_collection_to_queue(self, ctx, kind, id):
+        """
+        Queues every track of a playlist, album or artist. Playback starts as soon as the first track
+        is queued while the rest are added in the background.
+
+        Parameters:
+        - ctx (commands.Context): The context of the command invocation.
+        - kind (str): One of "playlist", "album" or "artist".
+        - id (str): The Spotify id of the playlist, album or artist.
+        """
+        first_queued = asyncio.Event()
+        queue = self.song_queue(ctx.guild.id)
+        task = asyncio.create_task(
+            spotify_controller.enqueue_collection(
+                ctx.guild.id, kind, id, first_queued,
+                on_queued=lambda track: queue.push(spotify_controller.track_cache.remember(track)),
+            )
         )
-        embed.set_thumbnail(url=info["thumbnail"])
-        embed.add_field(
-            name="Duration",
-            value=humanize_duration(info["duration"]),
-            inline=False,
+        self.enqueue_tasks.add(task)
+        task.add_done_callback(self.enqueue_tasks.discard)
+
+        await first_queued.wait()
+        if task.done() and (task.cancelled() or task.exception() or task.result() == 0):
+            await ctx.reply(f"Couldn't queue anything from that {kind}.")
+            return
+
+        await spotify_controller.switch_to_device(ctx.guild.id)
+        if not await spotify_controller.is_playing(ctx.guild.id):
+            await spotify_controller.play(ctx.guild.id)
+
+        async def report():
+            try:
+                queued = await task
+            except Exception as e:
+                print(f"Queueing {kind} {id} failed: {e}")
+                await ctx.reply(f"Stopped queueing the {kind} partway through.")
+                return
+            await ctx.reply(f"Queued {queued} song{'s' if queued != 1 else ''} from the {kind}.")
+
+        report_task = asyncio.create_task(report())
+        self.enqueue_tasks.add(report_task)
+        report_task.add_done_callback(self.enqueue_tasks.discard)
+
+    def now_playing_embed(self, track, position_ms=None):
+        """
+        Builds an embed with a song's details, including title, artists, duration, and album art.
+
+        Parameters:
+        - track (Track): The song to describe.
+        - position_ms (int | None): How far into the song playback is, if known.
+
+        Returns:
+        - discord.Embed: The embed describing the song.
+        """
+        embed = discord.Embed(
+            title=track.title,
+            url=f"https://open.spotify.com/{'/'.join(track.uri.split(':')[1:])}",
+            color=discord.Color.blurple(),
         )
-        await ctx.reply(embed=embed)
+        if track.image_url:
+            embed.set_thumbnail(url=track.image_url)
+        if track.artists:
+            embed.add_field(name="Artists", value=track.artists, inline=False)
+        duration = humanize_duration(track.duration_ms // 1000) or "0 seconds"
+        if position_ms is not None:
+            duration = f"{humanize_duration(position_ms // 1000) or '0 seconds'} of {duration}"
+        embed.add_field(name="Duration", value=duration, inline=False)
+        return embed
+
+    async def send_now_playing(self, channel, track):
+        """
+        Sends an embedded message with the current song's details.
+
+        Parameters:
+        - channel (discord.abc.Messageable): Where to send the message.
+        - track (Track): The song currently playing.
+        """
+        await channel.send(embed=self.now_playing_embed(track))
+
+    def pcm_buffer(self, guild_id):
+        """
+        Returns the buffer holding a guild's librespot audio, if librespot is running for it.
+
+        Parameters:
+        - guild_id (int): The guild to look up.
+
+        Returns:
+        - PCMSwitcher | None: The buffer the guild's voice player reads from.
+        """
+        worker = spotify_controller.get_worker(guild_id)
+        if worker is None:
+            return None
+        return worker.pcm_feed
 
     async def play_next(self, ctx):
         """
@@ -149,15 +375,19 @@ class Music(commands.Cog):
         """
 
         voice_client = ctx.guild.voice_client
-        source = discord.FFmpegPCMAudio(
-            pipe=True, 
-            source=spotify_controller.librespot.stdout, 
-            before_options="-f s16le -ar 44100 -ac 2",
-            options="-f s16le -ar 48000 -ac 2",     
+        worker = spotify_controller.get_worker(ctx.guild.id)
+        if voice_client is None or worker is None:
+            # librespot was stopped or never started, so there is no audio to play
+            return
+        pcm = worker.pcm_feed
+        source = voice_stats.instrument(
+            audio.create_music_source(pcm, worker.volume),
+            ctx.guild.id,
+            "music",
+            underruns=lambda: pcm.metrics().get("underruns", 0),
         )
 
         voice_client.play(source)
-        # await self.send_now_playing(ctx, info)
 
     # ======== Commands ========
 
@@ -172,7 +402,7 @@ class Music(commands.Cog):
         **Description:**
         Removes all access tokens and requires a relog 
         """
-        success = spotify_controller.logout()
+        success = await spotify_controller.logout()
         if success:
             await ctx.reply("Successfully logged out.")
         else:
@@ -181,7 +411,9 @@ class Music(commands.Cog):
         if ctx.guild.voice_client and ctx.guild.voice_client.is_connected():
             await ctx.guild.voice_client.disconnect()
 
-        spotify_controller.stop_librespot()
+        spotify_controller.stop_all_librespot()
+        self.queues.clear()
+        self.channels.clear()
 
 
     @commands.command(name="login", help="Login to a Spotify Premium account to play music.")
@@ -220,7 +452,7 @@ class Music(commands.Cog):
         **Usage:** `.play <query>`
 
         **Parameters:**
-        - `<query>` - The name of (or link to) a YouTube video.
+        - `<query>` - The name of a song, or a Spotify link to a song, playlist, album or artist.
 
         **Example:**
         - `.play Never Gonna Give You Up` → "Joins the voice channel the user is in and begins playing Never Gonna Give You Up."
@@ -228,11 +460,43 @@ class Music(commands.Cog):
         **Description:**
         Adds a song to the queue and plays it if nothing is playing.
         """
-        await self.add_to_queue(ctx, query)
+        if not await self.add_to_queue(ctx, query):
+            return
         voice_client = ctx.guild.voice_client
         if voice_client and not voice_client.is_playing():
             await self.play_next(ctx)
 
+    @commands.command(
+        name="search", help="Searches Spotify for songs, albums, playlists and artists to pick from."
+    )
+    async def search_command(self, ctx, *, query):
+        """
+        **Usage:** `.search <query>`
+
+        **Parameters:**
+        - `<query>` - What to search Spotify for.
+
+        **Example:**
+        - `.search Daft Punk` → "Shows a menu of matching songs, albums, playlists and artists. Picking one plays it."
+
+        **Description:**
+        Searches Spotify for songs, albums, playlists and artists all at once and shows the top results
+        in a menu. Picking a result queues it straight away. Results can be picked for a few minutes
+        before you have to search again.
+        """
+        body = await spotify_controller.search(query, type=",".join(SEARCH_TYPES), limit=SEARCH_RESULT_LIMIT)
+        if body is None:
+            await ctx.reply("Spotify didn't answer the search. Try again in a moment.")
+            return
+
+        options = self.search_options(body)
+        if not options:
+            await ctx.reply(f"Couldn't find anything for {query}.")
+            return
+
+        self.search_results[ctx.author.id] = options
+        await ctx.reply(f"Results for {query}:", view=SearchResultView(self, ctx, options))
+
     @commands.command(
         name="stop", help="Stops the current song and clears the song queue."
     )
@@ -245,17 +509,18 @@ class Music(commands.Cog):
         """
 
         voice_client = ctx.guild.voice_client
-        if voice_client:
-            if voice_client.is_playing():
-                voice_client.stop()
-                await voice_client.disconnect()
-                return
-            else:
-                await voice_client.disconnect()
-            await ctx.reply("Disconnecting.")
-            spotify_controller.stop_librespot()
+        if voice_client is None:
+            await ctx.reply("I am not playing any songs right now.")
+            return
 
-        await ctx.reply("I am not playing any songs right now.")
+        if voice_client.is_playing():
+            voice_client.stop()
+        await voice_client.disconnect()
+        # Free the guild's librespot worker right away instead of waiting for the idle reaper
+        spotify_controller.stop_librespot(ctx.guild.id)
+        self.queues.pop(ctx.guild.id, None)
+        self.channels.pop(ctx.guild.id, None)
+        await ctx.reply("Disconnecting.")
 
     @commands.command(
         name="skip", help="Skips the current song and plays the next one in the queue."
@@ -269,7 +534,12 @@ class Music(commands.Cog):
         """
         voice_client = ctx.guild.voice_client
         if voice_client is not None:
-            spotify_controller.skip("next")
+            # Flush before asking Spotify, since librespot starts writing the next song as soon as it skips
+            if self.pcm_buffer(ctx.guild.id):
+                self.pcm_buffer(ctx.guild.id).flush()
+            await spotify_controller.skip(ctx.guild.id, "next")
+            queue = self.song_queue(ctx.guild.id)
+            queue.advance()
             await ctx.reply("Skipping to the next song")
         else:
             await ctx.reply("I am not playing any songs right now.")
@@ -285,8 +555,11 @@ class Music(commands.Cog):
         Goes back to the previous song in history if available. If no history exists, informs the user.
         """
         voice_client = ctx.guild.voice_client
-        if voice_client and voice_client.is_playing() and not voice_client.is_paused():
-            spotify_controller.skip("previous")
+        if voice_client and await spotify_controller.is_playing(ctx.guild.id):
+            if self.pcm_buffer(ctx.guild.id):
+                self.pcm_buffer(ctx.guild.id).flush()
+            await spotify_controller.skip(ctx.guild.id, "previous")
+            self.song_queue(ctx.guild.id).back()
             await ctx.reply("Returning to previous song")
         else:
             await ctx.reply("I am not playing any songs right now.")
@@ -302,9 +575,11 @@ class Music(commands.Cog):
         voice_client = ctx.guild.voice_client
         if voice_client and voice_client.is_playing() and not voice_client.is_paused():
             voice_client.pause()
+        if self.pcm_buffer(ctx.guild.id):
+            self.pcm_buffer(ctx.guild.id).pause()
 
-        if spotify_controller.is_playing():
-            spotify_controller.pause()
+        if await spotify_controller.is_playing(ctx.guild.id):
+            await spotify_controller.pause(ctx.guild.id)
             await ctx.reply("Pausing playback")
         else:
             await ctx.reply("Already paused. You may have meant to use `.resume`")
@@ -319,16 +594,49 @@ class Music(commands.Cog):
         **Description:**
         Resumes the playback of the current song if it's paused. If no song is paused, informs the user.
         """
-        if not spotify_controller.is_playing():
+        if not await spotify_controller.is_playing(ctx.guild.id):
             voice_client = ctx.guild.voice_client
             if voice_client and voice_client.is_paused(): 
                 voice_client.resume()
+            if self.pcm_buffer(ctx.guild.id):
+                self.pcm_buffer(ctx.guild.id).resume()
 
-            spotify_controller.play()
+            await spotify_controller.play(ctx.guild.id)
             await ctx.reply("Resuming playback")
         else:
             await ctx.reply("Already playing. You may have meant to use `.pause`")
 
+    @commands.command(name="volume", help="Shows or changes the playback volume.")
+    async def volume_command(self, ctx, percent: int = None):
+        """
+        **Usage:** `.volume [percent]`
+
+        **Parameters:**
+        - `[percent]` - The new volume, from 0 to 200. Leave it out to see the current volume.
+
+        **Example:**
+        - `.volume 50` → "Plays music at half the volume."
+
+        **Description:**
+        Changes how loud the bot plays music in this server. The change is applied to the bot's own
+        audio, so it is heard right away and doesn't change the volume on the Spotify account.
+        """
+        worker = spotify_controller.get_worker(ctx.guild.id)
+        if worker is None:
+            await ctx.reply("I am not playing any songs right now.")
+            return
+
+        if percent is None:
+            await ctx.reply(f"The volume is {worker.volume.percent}%.")
+            return
+
+        try:
+            worker.volume.set(percent)
+        except ValueError:
+            await ctx.reply(f"The volume must be between 0 and {audio.MAX_VOLUME}.")
+            return
+        await ctx.reply(f"Set the volume to {percent}%.")
+
     @commands.command(name="rewind", help="Rewinds the current song to the start.")
     async def rewind_command(self, ctx):
         """
@@ -338,10 +646,11 @@ class Music(commands.Cog):
         Rewinds the current song to the start and plays it again. If no song is playing, informs the user.
         """
         voice_client = ctx.guild.voice_client
-        if voice_client and voice_client.is_playing() and not voice_client.is_paused():
-            voice_client.pause()
-            self.song_queue.insert(0, self.currently_playing)
-            await self.play_next(ctx)
+        if voice_client and await spotify_controller.is_playing(ctx.guild.id):
+            if self.pcm_buffer(ctx.guild.id):
+                self.pcm_buffer(ctx.guild.id).flush()
+            await spotify_controller.seek(ctx.guild.id, 0)
+            await ctx.reply("Rewinding to the start of the song")
         else:
             await ctx.reply("I am not playing any songs right now.")
 
@@ -351,10 +660,12 @@ class Music(commands.Cog):
         **Usage:** `.clear`
 
         **Description:**
-        Clears the song queue if there are any songs in the queue.
+        Clears the song queue if there are any songs in the queue. Spotify offers no way to remove
+        queued songs, so any that still come up afterwards show up as the current song instead.
         """
-        if len(self.song_queue) != 0:
-            self.song_queue.clear()
+        queue = self.song_queue(ctx.guild.id)
+        if len(queue) != 0:
+            queue.clear()
             await ctx.reply("Cleared the queue.")
         else:
             await ctx.reply("Nothing in the queue to clear.")
@@ -367,12 +678,31 @@ class Music(commands.Cog):
         **Description:**
         Clears the song history if there are any songs in history.
         """
-        if len(self.song_history) != 0:
-            self.song_history.clear()
+        queue = self.song_queue(ctx.guild.id)
+        if len(queue.history) != 0:
+            queue.clear_history()
             await ctx.reply("Cleared the history.")
         else:
             await ctx.reply("Nothing in the history to clear.")
 
+    @commands.command(
+        name="nowplaying", aliases=["np"], help="Displays the song that is currently playing."
+    )
+    async def now_playing_command(self, ctx):
+        """
+        **Usage:** `.nowplaying`
+
+        **Description:**
+        Displays the song that is currently playing and how far into it playback is.
+        """
+        state = await spotify_controller.get_playback()
+        if state is None or not state.track or spotify_controller.guild_for_device(state.device_id) != ctx.guild.id:
+            await ctx.reply("I am not playing any songs right now.")
+            return
+
+        track = spotify_controller.track_cache.remember(state.track)
+        await ctx.reply(embed=self.now_playing_embed(track, state.position_ms()))
+
     @commands.command(
         name="queue", help="Displays the list of songs currently in the queue."
     )
@@ -383,14 +713,19 @@ class Music(commands.Cog):
         **Description:**
         Displays the list of songs currently in the queue.
         """
+        queue = self.song_queue(ctx.guild.id)
         embed = discord.Embed(
             title="Song Queue",
             description="Here is the list of songs in the queue:",
             color=discord.Color.blurple(),
         )
 
-        for index, song in enumerate(self.song_queue, start=1):
-            embed.add_field(name=f"Song {index}", value=song["title"], inline=False)
+        if queue.current is not None:
+            embed.add_field(name="Now Playing", value=queue.current.title, inline=False)
+        for index, song in enumerate(queue.peek(EMBED_SONG_LIMIT), start=1):
+            embed.add_field(name=f"Song {index}", value=f"{song.title} - {song.artists}" if song.artists else song.title, inline=False)
+        if len(queue) > EMBED_SONG_LIMIT:
+            embed.set_footer(text=f"And {len(queue) - EMBED_SONG_LIMIT} more")
 
         await ctx.send(embed=embed)
 
@@ -410,12 +745,74 @@ class Music(commands.Cog):
             color=discord.Color.blurple(),
         )
 
-        for index, song in enumerate(self.song_history, start=1):
-            embed.add_field(name=f"Song {index}", value=song["title"], inline=False)
+        history = self.song_queue(ctx.guild.id).history
+        for index, song in enumerate(list(history)[-EMBED_SONG_LIMIT:], start=1):
+            embed.add_field(name=f"Song {index}", value=f"{song.title} - {song.artists}" if song.artists else song.title, inline=False)
 
         await ctx.send(embed=embed)
 
 
+class SearchResultView(discord.ui.View):
+    """
+    Holds the menu of results from a `.search`. Only the user who searched can pick from it.
+
+    Parameters:
+    - music (Music): The cog holding the cached search results.
+    - ctx (commands.Context): The context of the `.search` invocation.
+    - options (list[dict]): The results to offer.
+    """
+
+    def __init__(self, music, ctx, options):
+        super().__init__(timeout=SEARCH_RESULT_TTL)
+        self.ctx = ctx
+        self.add_item(SearchResultSelect(music, ctx, options))
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        if interaction.user.id != self.ctx.author.id:
+            await interaction.response.send_message("Run `.search` to pick your own result.", ephemeral=True)
+            return False
+        return True
+
+
+class SearchResultSelect(discord.ui.Select):
+    """
+    A menu of search results. Picking one queues it from the results cached for the user.
+
+    Parameters:
+    - music (Music): The cog holding the cached search results.
+    - ctx (commands.Context): The context of the `.search` invocation.
+    - options (list[dict]): The results to offer.
+    """
+
+    def __init__(self, music, ctx, options):
+        super().__init__(
+            placeholder="Pick something to play",
+            options=[
+                discord.SelectOption(label=option["label"], description=option["description"], value=str(index))
+                for index, option in enumerate(options)
+            ],
+        )
+        self.music = music
+        self.ctx = ctx
+
+    async def callback(self, interaction: discord.Interaction):
+        """
+        Queues the picked result.
+
+        Parameters:
+        - interaction (discord.Interaction): The interaction from picking a result.
+        """
+        options = self.music.search_results.get(self.ctx.author.id)
+        index = int(self.values[0])
+        if options is None or index >= len(options) or options[index]["label"] != self.options[index].label:
+            await interaction.response.send_message("These results have expired. Run `.search` again.", ephemeral=True)
+            return
+
+        result = options[index]
+        await interaction.response.send_message(f"Playing {result['label']}")
+        await self.music.play_search_result(self.ctx, result)
+
+
 async def setup(bot):
     """
     Sets up the Music cog by adding it to the bot client.
@@ -5,6 +5,7 @@ import json
 from discord.ext import commands
 import os
 import subprocess
+import voice_stats
 
 
 class Sound:
@@ -330,9 +331,13 @@ class PlaySoundButton(discord.ui.Button):
                 print(f"Error in after_playing: {e}")
 
         voice_client.play(
-            discord.FFmpegPCMAudio(
-                sound.file,
-                options="-af loudnorm=I=-14:TP=-2:LRA=11",
+            voice_stats.instrument(
+                discord.FFmpegPCMAudio(
+                    sound.file,
+                    options="-af loudnorm=I=-14:TP=-2:LRA=11",
+                ),
+                self.ctx.guild.id,
+                "soundboard",
             ),
             after=after_playing,
         )
@@ -10,7 +10,7 @@
     flake-utils.lib.eachDefaultSystem (system:
       let 
         pkgs = import nixpkgs { inherit system; };
-        python-pkgs = with pkgs.python312Packages; [ discordpy python-dotenv yt-dlp google-api-python-client ];
+        python-pkgs = with pkgs.python312Packages; [ discordpy python-dotenv yt-dlp google-api-python-client numpy cachetools ];
       in {
         devShell = pkgs.mkShell {
           packages = with pkgs; [ python312 ] ++ python-pkgs;
@@ -0,0 +1,169 @@
+from typing import Dict, List, Tuple
+import os
+import re
+import threading
+
+
+# Where librespot caches downloaded audio. Leave unset to download every track every time
+CACHE_DIR = os.getenv("LIBRESPOT_CACHE_DIR")
+# The most disk space the audio cache may use, e.g. "2G" or "500M"
+CACHE_SIZE_LIMIT = os.getenv("LIBRESPOT_CACHE_SIZE_LIMIT", "2G")
+# librespot only logs whether a file came from the cache at debug level, so that one module is raised to debug
+CACHE_LOG_FILTER = os.getenv("LIBRESPOT_CACHE_LOG_FILTER", "info,librespot_audio::fetch=debug")
+# librespot logs these when it opens an audio file
+HIT_PATTERN = re.compile(r"already in cache")
+MISS_PATTERN = re.compile(r"Downloading file")
+
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_size(size: str) -> int:
+    """
+    :param size: A size the way librespot's `--cache-size-limit` takes it, e.g. "2G", "500M" or "1048576"
+    :returns: The size in bytes
+    """
+
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*", size, re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Invalid size {size!r}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+class LibrespotCache:
+    """
+    Manages the on-disk audio cache shared by every librespot worker, so a track played again in any
+    guild starts from disk instead of being downloaded again at 320 kbps. librespot evicts the least
+    recently used files itself once `size_limit` is reached. `prune` applies the same policy from our
+    side, which matters when the limit is lowered between restarts. Each worker gets its own system
+    cache for credentials and volume so workers never write the same files.
+
+    Hits and misses are counted from librespot's log, which `observe` is fed line by line.
+
+    :param path: The directory to cache audio in, or `None` to disable caching
+    :param size_limit: The most disk space the audio cache may use, e.g. "2G"
+    """
+
+    def __init__(self, path: str | None = CACHE_DIR, size_limit: str = CACHE_SIZE_LIMIT) -> None:
+        self.path = path
+        self.size_limit = size_limit
+        self.limit_bytes = parse_size(size_limit)
+        self.hits = 0
+        self.misses = 0
+        self.evicted_files = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    @property
+    def audio_dir(self) -> str:
+        return os.path.join(self.path, "audio")
+
+    def args(self, slot: int) -> List[str]:
+        """
+        :param slot: The worker's slot, used to keep each worker's system cache apart
+        :returns: The command line arguments that point librespot at the cache
+        """
+
+        if not self.enabled:
+            return []
+        return [
+            "--cache", self.audio_dir,
+            "--system-cache", os.path.join(self.path, "system", str(slot)),
+            "--cache-size-limit", self.size_limit,
+        ]
+
+    def env(self) -> Dict[str, str]:
+        """
+        :returns: The environment to launch librespot with, logging cache hits if caching is enabled
+        """
+
+        env = dict(os.environ)
+        if self.enabled and "RUST_LOG" not in env:
+            env["RUST_LOG"] = CACHE_LOG_FILTER
+        return env
+
+    def observe(self, line: str):
+        """
+        Counts a cache hit or miss if the librespot log line reports one. Called from librespot's log thread
+        """
+
+        if HIT_PATTERN.search(line):
+            with self._lock:
+                self.hits += 1
+        elif MISS_PATTERN.search(line):
+            with self._lock:
+                self.misses += 1
+
+    def _files(self) -> List[Tuple[float, int, str]]:
+        """
+        :returns: `(last access time, size, path)` for every cached audio file
+        """
+
+        files = []
+        for root, _, names in os.walk(self.audio_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((max(stat.st_atime, stat.st_mtime), stat.st_size, path))
+        return files
+
+    def usage(self) -> Tuple[int, int]:
+        """
+        Walks the cache directory, so call it off the event loop
+
+        :returns: The number of cached audio files and their total size in bytes
+        """
+
+        if not self.enabled:
+            return 0, 0
+        files = self._files()
+        return len(files), sum(size for _, size, _ in files)
+
+    def prune(self) -> int:
+        """
+        Deletes the least recently used audio files until the cache fits in `limit_bytes`. Walks and
+        deletes files, so call it off the event loop
+
+        :returns: The number of files deleted
+        """
+
+        if not self.enabled:
+            return 0
+        files = sorted(self._files())
+        total = sum(size for _, size, _ in files)
+        deleted = 0
+        for _, size, path in files:
+            if total <= self.limit_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            deleted += 1
+
+        with self._lock:
+            self.evicted_files += deleted
+        if deleted:
+            print(f"Evicted {deleted} files from the librespot cache")
+        return deleted
+
+    def stats(self) -> Dict[str, float]:
+        """
+        :returns: Hit and miss counters along with the hit ratio and size limit
+        """
+
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evicted_files": self.evicted_files,
+                "limit_bytes": self.limit_bytes,
+            }
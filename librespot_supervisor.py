@@ -0,0 +1,304 @@
+from typing import Callable, Dict, List
+import asyncio
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from audio import PCMRingBuffer, PCMSwitcher, Volume
+
+
+# librespot logs this once its session with Spotify is established and its Connect device is announced
+READY_PATTERN = os.getenv("LIBRESPOT_READY_PATTERN", r"Authenticated as")
+# How long to wait for librespot to become ready before giving up
+READY_TIMEOUT = float(os.getenv("LIBRESPOT_READY_TIMEOUT", "10"))
+
+
+class LibrespotProcess:
+    """
+    Supervises a single librespot subprocess. librespot's log output is watched on a background
+    thread so that callers can await `wait_ready` instead of polling Spotify for the device.
+
+    :param args: The command line used to launch librespot
+    :param ready_pattern: A regex that matches the log line librespot prints once it is ready
+    :param env: The environment to launch librespot with. Defaults to our own
+    :param on_log: Called with every line librespot logs, from the log watching thread
+    """
+
+    def __init__(self, args: List[str], ready_pattern: str = READY_PATTERN, env: Dict[str, str] | None = None,
+                 on_log: Callable[[str], None] | None = None) -> None:
+        self.args = args
+        self.ready_pattern = re.compile(ready_pattern)
+        self.env = env
+        self.on_log = on_log
+        self.process: subprocess.Popen | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._ready: asyncio.Future | None = None
+        self.pcm: PCMRingBuffer | None = None
+
+    @property
+    def stdout(self):
+        """
+        The pipe librespot writes raw `s16le 44100` PCM audio to. Read audio from `pcm` instead,
+        which drains this pipe on its own thread
+        """
+
+        return self.process.stdout if self.process else None
+
+    def start(self):
+        """
+        Launches librespot and starts watching its log output. Must be called from the event loop
+        that will later await `wait_ready`
+        """
+
+        self._loop = asyncio.get_running_loop()
+        self._ready = self._loop.create_future()
+        self.process = subprocess.Popen(self.args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=self.env)
+        self.pcm = PCMRingBuffer(self.process.stdout)
+        self.pcm.start()
+        threading.Thread(target=self._watch_logs, args=(self.process,), daemon=True).start()
+
+    def _watch_logs(self, process: subprocess.Popen):
+        """
+        Runs on a background thread for the lifetime of the process. Forwards librespot's log lines to
+        our own stderr, resolves the ready future on the first line matching `ready_pattern`, and fails
+        it if librespot exits before that happens. The pipe is always drained so librespot never blocks
+        on logging
+        """
+
+        for raw_line in iter(process.stderr.readline, b""):
+            line = raw_line.decode(errors="replace").rstrip()
+            sys.stderr.write(f"[librespot] {line}\n")
+            if self.on_log is not None:
+                self.on_log(line)
+            if self.ready_pattern.search(line):
+                self._loop.call_soon_threadsafe(self._resolve, True)
+
+        process.wait()
+        self._loop.call_soon_threadsafe(self._resolve, False)
+
+    def _resolve(self, ready: bool):
+        if self._ready is not None and not self._ready.done():
+            self._ready.set_result(ready)
+
+    def is_ready(self) -> bool:
+        """
+        :returns: `True` if librespot has reported that it is ready
+        """
+
+        return self._ready is not None and self._ready.done() and self._ready.result()
+
+    async def wait_ready(self, timeout: float = READY_TIMEOUT) -> bool:
+        """
+        Waits until librespot reports that it is ready, without blocking the event loop
+
+        :param timeout: The maximum number of seconds to wait
+        :returns: `True` if librespot became ready. `False` if it timed out or exited first
+        """
+
+        if self._ready is None:
+            return False
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(self._ready), timeout)
+        except asyncio.TimeoutError:
+            print(f"librespot was not ready after {timeout} seconds")
+            return False
+
+    def poll(self) -> int | None:
+        """
+        :returns: librespot's exit code, or `None` if it is still running
+        """
+
+        return self.process.poll() if self.process else None
+
+    def terminate(self):
+        """
+        Stops librespot. Anything still awaiting `wait_ready` is told that it never became ready
+        """
+
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+        if self.pcm:
+            self.pcm.close()
+        self._resolve(False)
+
+
+# The most librespot processes the bot will run at once
+MAX_WORKERS = int(os.getenv("LIBRESPOT_MAX_WORKERS", "4"))
+# Workers that have neither been used nor played audio for this many seconds are stopped
+IDLE_TIMEOUT = float(os.getenv("LIBRESPOT_IDLE_TIMEOUT", "900"))
+# How often to look for idle workers
+REAP_INTERVAL = 60
+
+
+class LibrespotWorker:
+    """
+    Everything belonging to one guild's librespot: the running process, the Spotify Connect device
+    it registers, and the audio feed and volume that guild's voice player uses. The feed stays the
+    same object across librespot restarts so the voice player never has to be rebuilt.
+
+    :param key: What the worker is keyed by in the pool, usually a guild id
+    :param slot: The worker's slot number, used to give each worker a distinct device name
+    """
+
+    def __init__(self, key: int, slot: int) -> None:
+        self.key = key
+        self.slot = slot
+        self.process: LibrespotProcess | None = None
+        self.pcm_feed = PCMSwitcher()
+        self.volume = Volume()
+        self.device_id: str | None = None
+        self.generation = 0
+        self.refresh_task: asyncio.Task | None = None
+        self.last_used = time.monotonic()
+        self._last_bytes_out = 0
+
+    @property
+    def device_name(self) -> str:
+        """
+        The Spotify Connect device name of the worker's current librespot
+        """
+
+        return self.device_name_for(self.generation)
+
+    def device_name_for(self, generation: int) -> str:
+        """
+        librespot derives its device id from its name, so the replacement started by a rollover needs a
+        different name than the process it replaces to register as a separate device. The name
+        alternates between two spellings from one generation to the next. The first slot keeps the
+        plain bot name
+
+        :param generation: How many times the worker's librespot has been replaced since it started
+        """
+
+        name = os.getenv("BOT_NAME")
+        name = name if self.slot == 1 else f"{name} {self.slot}"
+        return name if generation % 2 == 0 else f"{name} \u00b7"
+
+    def touch(self):
+        """
+        Marks the worker as recently used so it is not reaped
+        """
+
+        self.last_used = time.monotonic()
+
+    def idle_seconds(self) -> float:
+        """
+        :returns: How long it has been since the worker was used or its voice player read any audio
+        """
+
+        bytes_out = self.pcm_feed.metrics().get("bytes_out", 0)
+        if bytes_out != self._last_bytes_out:
+            self._last_bytes_out = bytes_out
+            self.touch()
+        return time.monotonic() - self.last_used
+
+    def stop(self):
+        """
+        Stops the worker's librespot and its refresh task
+        """
+
+        self.device_id = None
+        self.generation = 0
+        if self.refresh_task is not None and self.refresh_task is not asyncio.current_task():
+            self.refresh_task.cancel()
+        self.refresh_task = None
+        if self.process:
+            self.process.terminate()
+            self.process = None
+
+
+class PoolFullError(Exception):
+    """
+    Raised when a new worker is needed but `max_workers` are already running
+    """
+
+
+class LibrespotPool:
+    """
+    Runs one `LibrespotWorker` per key so that several guilds can stream at the same time without
+    sharing a process or an audio pipe. Workers that sit idle for `idle_timeout` seconds are stopped
+    and their slot is freed for another guild.
+
+    :param max_workers: The most workers that may run at once
+    :param idle_timeout: How many idle seconds before a worker is stopped
+    """
+
+    def __init__(self, max_workers: int = MAX_WORKERS, idle_timeout: float = IDLE_TIMEOUT) -> None:
+        self.max_workers = max_workers
+        self.idle_timeout = idle_timeout
+        self.workers: Dict[int, LibrespotWorker] = {}
+        self._reaper: asyncio.Task | None = None
+
+    def get(self, key: int) -> LibrespotWorker | None:
+        """
+        :returns: The worker for `key` if it exists, marking it as used
+        """
+
+        worker = self.workers.get(key)
+        if worker:
+            worker.touch()
+        return worker
+
+    def acquire(self, key: int) -> LibrespotWorker:
+        """
+        Returns the worker for `key`, creating it if needed. Idle workers are reaped first if the pool is full
+
+        :param key: The key to look up, usually a guild id
+        :raises PoolFullError: If every slot is taken by a worker that is still in use
+        """
+
+        worker = self.get(key)
+        if worker:
+            return worker
+
+        if len(self.workers) >= self.max_workers:
+            self.reap()
+        if len(self.workers) >= self.max_workers:
+            raise PoolFullError(f"All {self.max_workers} librespot workers are in use")
+
+        taken = {worker.slot for worker in self.workers.values()}
+        slot = next(slot for slot in range(1, self.max_workers + 1) if slot not in taken)
+        worker = LibrespotWorker(key, slot)
+        self.workers[key] = worker
+
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.create_task(self._reap_forever())
+        return worker
+
+    def release(self, key: int):
+        """
+        Stops and removes the worker for `key` if there is one
+        """
+
+        worker = self.workers.pop(key, None)
+        if worker:
+            worker.stop()
+
+    def reap(self):
+        """
+        Stops every worker that has been idle for longer than `idle_timeout`
+        """
+
+        for key, worker in list(self.workers.items()):
+            if worker.idle_seconds() > self.idle_timeout:
+                print(f"Stopping librespot worker for {key} after {self.idle_timeout:g} idle seconds")
+                self.release(key)
+
+    def release_all(self):
+        """
+        Stops every worker, e.g. on logout or when the music cog is unloaded
+        """
+
+        for key in list(self.workers):
+            self.release(key)
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+
+    async def _reap_forever(self):
+        while self.workers:
+            await asyncio.sleep(REAP_INTERVAL)
+            self.reap()
@@ -0,0 +1,212 @@
+from typing import Awaitable, Callable, Dict, List
+import asyncio
+import math
+import os
+import time
+
+
+# How often to poll Spotify's player while someone is using music commands
+ACTIVE_POLL_INTERVAL = float(os.getenv("PLAYBACK_ACTIVE_POLL_INTERVAL", "2"))
+# How often to poll Spotify's player when nobody has used a music command for a while
+IDLE_POLL_INTERVAL = float(os.getenv("PLAYBACK_IDLE_POLL_INTERVAL", "20"))
+# How long polling stays fast after a music command
+ACTIVE_WINDOW = float(os.getenv("PLAYBACK_ACTIVE_WINDOW", "60"))
+# How long to wait after a command changes playback before checking what Spotify made of it
+SETTLE_DELAY = 0.5
+
+
+class PlaybackState:
+    """
+    A snapshot of Spotify's player, as returned by `/me/player`
+
+    :param track: The playing track object, or `None` if nothing is loaded
+    :param progress_ms: How far into the track playback was when the snapshot was taken
+    :param is_playing: Whether Spotify is playing rather than paused
+    :param device_id: The id of the Spotify Connect device that is playing
+    """
+
+    __slots__ = ("track", "progress_ms", "is_playing", "device_id", "fetched_at")
+
+    def __init__(self, track: Dict | None = None, progress_ms: int = 0, is_playing: bool = False,
+                 device_id: str | None = None, fetched_at: float | None = None) -> None:
+        self.track = track
+        self.progress_ms = progress_ms
+        self.is_playing = is_playing
+        self.device_id = device_id
+        self.fetched_at = time.monotonic() if fetched_at is None else fetched_at
+
+    @classmethod
+    def from_spotify(cls, body: Dict) -> "PlaybackState":
+        """
+        :param body: Spotify's `/me/player` response
+        """
+
+        return cls(
+            track=body.get("item"),
+            progress_ms=body.get("progress_ms") or 0,
+            is_playing=bool(body.get("is_playing")),
+            device_id=(body.get("device") or {}).get("id"),
+        )
+
+    def position_ms(self) -> int:
+        """
+        :returns: The current position in the track, extrapolated from the snapshot if playing
+        """
+
+        if not self.is_playing:
+            return self.progress_ms
+        return self.progress_ms + int((time.monotonic() - self.fetched_at) * 1000)
+
+    def remaining_seconds(self) -> float:
+        """
+        :returns: How long until the track ends if it keeps playing, or infinity if that isn't known
+        """
+
+        if not self.is_playing or not self.track or not self.track.get("duration_ms"):
+            return math.inf
+        return max(0.0, (self.track["duration_ms"] - self.position_ms()) / 1000)
+
+    def replace(self, **changes) -> "PlaybackState":
+        """
+        :returns: A copy with `changes` applied, keeping the extrapolated position
+        """
+
+        fields = {
+            "track": self.track,
+            "progress_ms": self.position_ms(),
+            "is_playing": self.is_playing,
+            "device_id": self.device_id,
+        }
+        fields.update(changes)
+        return PlaybackState(**fields)
+
+
+class PlaybackPoller:
+    """
+    Keeps a cached `PlaybackState` fresh by polling Spotify's player on one background task, so
+    commands can read playback state without a request of their own. Polling speeds up for a while
+    after each command and whenever a track is about to end, and slows down when nothing is happening.
+
+    Commands that change playback call `invalidate` with what they expect the new state to be. The
+    cache is updated right away and Spotify is polled shortly after to confirm.
+
+    :param fetch: Fetches `/me/player`, returning the json body, `{}` if nothing is playing, or `None` on failure
+    :param active: Polling stops once this returns `False`, e.g. when no librespot is running anymore
+    """
+
+    def __init__(self, fetch: Callable[[], Awaitable[Dict | None]], active: Callable[[], bool] | None = None) -> None:
+        self.fetch = fetch
+        self.active = active
+        self.state: PlaybackState | None = None
+        self.listeners: List[Callable[[PlaybackState], None]] = []
+        self.polls = 0
+        self._task: asyncio.Task | None = None
+        self._inflight: asyncio.Task | None = None
+        self._wake: asyncio.Event | None = None
+        self._poll_at = 0.0
+        self._active_until = 0.0
+
+    def start(self):
+        """
+        Starts polling if it isn't already running
+        """
+
+        if self._task is None or self._task.done():
+            self._wake = asyncio.Event()
+            self._poll_at = 0.0
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        """
+        Stops polling and forgets the cached state
+        """
+
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.state = None
+
+    async def get(self) -> PlaybackState | None:
+        """
+        :returns: The cached state, fetching it first if there is none yet or nothing is keeping it fresh
+        """
+
+        self.poke(ACTIVE_POLL_INTERVAL)
+        if self.state is None or self._task is None or self._task.done():
+            await self.refresh()
+        return self.state
+
+    def poke(self, delay: float = 0.0):
+        """
+        Marks playback as being interacted with so polling speeds up
+
+        :param delay: Poll again this many seconds from now at the latest
+        """
+
+        now = time.monotonic()
+        self._active_until = now + ACTIVE_WINDOW
+        if self._poll_at > now + delay:
+            self._poll_at = now + delay
+            if self._wake is not None:
+                self._wake.set()
+
+    def invalidate(self, **expected):
+        """
+        Called after a command changes playback. Applies the expected changes to the cached state and
+        polls Spotify again shortly to confirm them
+
+        :param expected: `PlaybackState` fields the command should have changed, e.g. `is_playing=False`
+        """
+
+        if self.state is not None and expected:
+            self.state = self.state.replace(**expected)
+        self.poke(SETTLE_DELAY)
+
+    async def refresh(self) -> PlaybackState | None:
+        """
+        Polls Spotify now. Concurrent callers share one request
+        """
+
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.create_task(self._poll())
+        await asyncio.shield(self._inflight)
+        return self.state
+
+    async def _poll(self):
+        body = await self.fetch()
+        self.polls += 1
+        if body is None:
+            return
+
+        self.state = PlaybackState.from_spotify(body)
+        for listener in list(self.listeners):
+            try:
+                listener(self.state)
+            except Exception as e:
+                print(f"Playback listener failed: {e}")
+
+    def _interval(self) -> float:
+        now = time.monotonic()
+        interval = ACTIVE_POLL_INTERVAL if now < self._active_until else IDLE_POLL_INTERVAL
+        if self.state is not None:
+            # Check again right after the track should end so the next one shows up promptly
+            interval = min(interval, max(ACTIVE_POLL_INTERVAL, self.state.remaining_seconds() + SETTLE_DELAY))
+        return interval
+
+    async def _run(self):
+        while self.active is None or self.active():
+            now = time.monotonic()
+            if now >= self._poll_at:
+                self._poll_at = math.inf
+                try:
+                    await self.refresh()
+                except Exception as e:
+                    print(f"Polling playback state failed: {e}")
+                self._poll_at = min(self._poll_at, time.monotonic() + self._interval())
+                continue
+
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), self._poll_at - now)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,102 @@
+from typing import List, Tuple
+import asyncio
+import contextlib
+import heapq
+import itertools
+import os
+
+
+# Requests a user is waiting on right now, like pause or skip
+INTERACTIVE = 0
+# Background work that can wait, like filling the queue from a playlist
+BULK = 1
+
+# The most Spotify requests allowed in flight at once
+MAX_CONCURRENCY = int(os.getenv("SPOTIFY_MAX_CONCURRENCY", "8"))
+
+
+class RequestScheduler:
+    """
+    Decides when each Spotify request may be sent. At most `max_concurrency` requests are in flight,
+    waiting requests are admitted in priority order so interactive commands jump ahead of bulk work,
+    and after a 429 nothing is admitted until Spotify's `Retry-After` has passed.
+
+    :param max_concurrency: The most requests allowed in flight at once
+    """
+
+    def __init__(self, max_concurrency: int = MAX_CONCURRENCY) -> None:
+        self.max_concurrency = max_concurrency
+        self._active = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+        self._blocked_until = 0.0
+        self._timer: asyncio.TimerHandle | None = None
+
+        self.rate_limited_count = 0
+        self.admitted = [0, 0]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: int = INTERACTIVE):
+        """
+        Waits for permission to send a request and holds it for the duration of the `async with` block
+
+        :param priority: `INTERACTIVE` or `BULK`
+        """
+
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, priority: int = INTERACTIVE):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # We may have been admitted right before being cancelled, so hand the slot back
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        self.admitted[min(priority, BULK)] += 1
+
+    def release(self):
+        self._active -= 1
+        self._dispatch()
+
+    def rate_limited(self, retry_after: float):
+        """
+        Holds back every waiting request until `retry_after` seconds from now
+
+        :param retry_after: The number of seconds from Spotify's `Retry-After` header
+        """
+
+        loop = asyncio.get_running_loop()
+        self._blocked_until = max(self._blocked_until, loop.time() + retry_after)
+        self.rate_limited_count += 1
+
+    def _dispatch(self):
+        """
+        Admits as many waiting requests as there are free slots, highest priority first. While rate
+        limited, schedules itself to run again once the limit lifts
+        """
+
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if now < self._blocked_until:
+            if self._timer is None:
+                self._timer = loop.call_at(self._blocked_until, self._unblock)
+            return
+
+        while self._active < self.max_concurrency and self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self._active += 1
+            future.set_result(None)
+
+    def _unblock(self):
+        self._timer = None
+        self._dispatch()
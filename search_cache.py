@@ -0,0 +1,143 @@
+from typing import Dict, Tuple
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from cachetools import TLRUCache
+
+
+# How many searches to keep in memory
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "1024"))
+# How long a search result is reused before asking Spotify again
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "86400"))
+# How long a search that found nothing is remembered
+SEARCH_CACHE_NEGATIVE_TTL = float(os.getenv("SEARCH_CACHE_NEGATIVE_TTL", "600"))
+# Where to persist search results between restarts. Leave unset to only cache in memory
+SEARCH_CACHE_PATH = os.getenv("SEARCH_CACHE_PATH")
+
+
+def normalize_query(query: str) -> str:
+    """
+    Folds a search query so that trivially different spellings of the same request share a cache entry
+
+    :param query: The query as typed by the user
+    :returns: The query in lower case with surrounding quotes and repeated whitespace removed
+    """
+
+    return " ".join(query.strip().strip('"').split()).casefold()
+
+
+def is_empty(body: Dict) -> bool:
+    """
+    :param body: The json body Spotify returned for a search
+    :returns: `True` if none of the result sections contain any items
+    """
+
+    return all(not section.get("items") for section in body.values() if isinstance(section, dict))
+
+
+class SearchCache:
+    """
+    A bounded LRU cache with expiry for Spotify search results, keyed by the normalized query along
+    with the search type, market and limit. Searches that found nothing are remembered for a shorter
+    time so typos don't keep hitting Spotify either. If `path` is given, results are also written to
+    a SQLite file so the cache survives restarts.
+
+    :param maxsize: How many searches to keep in memory
+    :param ttl: How many seconds a result stays fresh
+    :param negative_ttl: How many seconds an empty result stays fresh
+    :param path: The SQLite file to persist results to, or `None` to only cache in memory
+    """
+
+    def __init__(self, maxsize: int = SEARCH_CACHE_SIZE, ttl: float = SEARCH_CACHE_TTL,
+                 negative_ttl: float = SEARCH_CACHE_NEGATIVE_TTL, path: str | None = SEARCH_CACHE_PATH) -> None:
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # Entries are `(body, expires_at, empty)` so each one carries its own expiry
+        self._memory: TLRUCache = TLRUCache(maxsize, ttu=lambda key, value, now: value[1], timer=time.time)
+
+        self._db: sqlite3.Connection | None = None
+        self._db_lock = threading.Lock()
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS searches (key TEXT PRIMARY KEY, body TEXT NOT NULL, expires_at REAL NOT NULL)")
+            self._db.execute("DELETE FROM searches WHERE expires_at < ?", (time.time(),))
+            self._db.commit()
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(query: str, type: str, limit: int, market: str | None) -> Tuple[str, str, int, str]:
+        return (normalize_query(query), type, limit, market or "")
+
+    async def get(self, key: Tuple[str, str, int, str]) -> Dict | None:
+        """
+        :param key: A key built with `SearchCache.key`
+        :returns: The cached search result, or `None` on a miss
+        """
+
+        entry = self._memory.get(key)
+        if entry is not None:
+            body, _, empty = entry
+            if empty:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return body
+
+        if self._db is not None:
+            row = await asyncio.to_thread(self._load, key)
+            if row is not None:
+                body, expires_at = row
+                self.disk_hits += 1
+                self._memory[key] = (body, expires_at, is_empty(body))
+                return body
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: Tuple[str, str, int, str], body: Dict):
+        """
+        Caches a search result. Results where every section is empty are cached for `negative_ttl`
+
+        :param key: A key built with `SearchCache.key`
+        :param body: The json body Spotify returned for the search
+        """
+
+        empty = is_empty(body)
+        expires_at = time.time() + (self.negative_ttl if empty else self.ttl)
+        self._memory[key] = (body, expires_at, empty)
+
+        if self._db is not None:
+            await asyncio.to_thread(self._store, key, body, expires_at)
+
+    def _load(self, key: Tuple[str, str, int, str]) -> Tuple[Dict, float] | None:
+        with self._db_lock:
+            row = self._db.execute("SELECT body, expires_at FROM searches WHERE key = ?", (json.dumps(key),)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return json.loads(row[0]), row[1]
+
+    def _store(self, key: Tuple[str, str, int, str], body: Dict, expires_at: float):
+        with self._db_lock:
+            self._db.execute("INSERT OR REPLACE INTO searches (key, body, expires_at) VALUES (?, ?, ?)", (json.dumps(key), json.dumps(body), expires_at))
+            self._db.commit()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :returns: Hit and miss counters along with how many searches are held in memory
+        """
+
+        return {
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "size": len(self._memory),
+        }
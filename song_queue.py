@@ -0,0 +1,151 @@
+from collections import deque
+from typing import Dict, Iterator, List
+import os
+
+
+# How many previously played songs to remember for each guild
+HISTORY_SIZE = int(os.getenv("MUSIC_HISTORY_SIZE", "50"))
+
+
+class Track:
+    """
+    The few details the bot needs about a Spotify track. Uses `__slots__` since a queue filled from
+    a large playlist can hold thousands of these
+
+    :param uri: The Spotify URI of the track
+    :param title: The track name
+    :param artists: The track's artists, comma separated
+    :param duration_ms: The track length in milliseconds
+    :param image_url: The album art, if known
+    """
+
+    __slots__ = ("uri", "title", "artists", "duration_ms", "image_url")
+
+    def __init__(self, uri: str, title: str, artists: str = "", duration_ms: int = 0, image_url: str | None = None) -> None:
+        self.uri = uri
+        self.title = title
+        self.artists = artists
+        self.duration_ms = duration_ms
+        self.image_url = image_url
+
+    @classmethod
+    def from_spotify(cls, track: Dict) -> "Track":
+        """
+        :param track: A track object from any Spotify Web API response
+        :returns: The track's details. Simplified track objects without an album just have no image
+        """
+
+        images = track.get("album", {}).get("images") or []
+        return cls(
+            uri=track["uri"],
+            title=track.get("name") or track["uri"],
+            artists=", ".join(artist["name"] for artist in track.get("artists", [])),
+            duration_ms=track.get("duration_ms", 0),
+            image_url=images[0]["url"] if images else None,
+        )
+
+    def __repr__(self) -> str:
+        return f"Track({self.uri!r}, {self.title!r})"
+
+
+class GuildQueue:
+    """
+    One guild's queue, current song and capped history, kept in memory so queue views never have to
+    ask Spotify. Every operation on either end is O(1). `sync` is fed each new playback state, which
+    catches songs that ended or were skipped from another Spotify client.
+
+    :param history_size: How many previously played songs to remember
+    """
+
+    def __init__(self, history_size: int = HISTORY_SIZE) -> None:
+        self.upcoming: deque[Track] = deque()
+        self.history: deque[Track] = deque(maxlen=history_size)
+        self.current: Track | None = None
+
+    def __len__(self) -> int:
+        return len(self.upcoming)
+
+    def __iter__(self) -> Iterator[Track]:
+        return iter(self.upcoming)
+
+    def push(self, track: Track):
+        """
+        Adds a song to the end of the queue
+        """
+
+        self.upcoming.append(track)
+
+    def advance(self) -> Track | None:
+        """
+        Moves on to the next song, pushing the current one onto the history
+
+        :returns: The new current song, or `None` if the queue is empty
+        """
+
+        if self.current is not None:
+            self.history.append(self.current)
+        self.current = self.upcoming.popleft() if self.upcoming else None
+        return self.current
+
+    def back(self) -> Track | None:
+        """
+        Returns to the previous song, putting the current one back at the front of the queue
+
+        :returns: The new current song, or `None` if there is no history
+        """
+
+        if not self.history:
+            return None
+        if self.current is not None:
+            self.upcoming.appendleft(self.current)
+        self.current = self.history.pop()
+        return self.current
+
+    def rotate(self, steps: int = 1):
+        """
+        Rotates the upcoming songs `steps` places to the left, moving the next song to the back
+        """
+
+        self.upcoming.rotate(-steps)
+
+    def clear(self):
+        self.upcoming.clear()
+
+    def clear_history(self):
+        self.history.clear()
+
+    def sync(self, currently_playing: Track | None):
+        """
+        Brings the local queue in line with what Spotify is actually playing. If the playing song is
+        further along in the queue, the songs before it are moved to the history. If it isn't in the
+        queue at all, e.g. Spotify moved on to a recommendation, it becomes the current song
+
+        :param currently_playing: The track Spotify reports as playing
+        """
+
+        if currently_playing is None:
+            return
+        uri = currently_playing.uri
+        if self.current is not None and self.current.uri == uri:
+            return
+
+        if self.history and self.history[-1].uri == uri:
+            self.back()
+            return
+
+        for index, track in enumerate(self.upcoming):
+            if track.uri == uri:
+                for _ in range(index + 1):
+                    self.advance()
+                return
+
+        if self.current is not None:
+            self.history.append(self.current)
+        self.current = currently_playing
+
+    def peek(self, count: int) -> List[Track]:
+        """
+        :returns: Up to the next `count` songs without removing them
+        """
+
+        return [track for _, track in zip(range(count), self.upcoming)]
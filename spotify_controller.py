@@ -1,29 +1,286 @@
-from typing import Dict
+from typing import AsyncIterator, Callable, Dict, List, Tuple
 import urllib.parse
-import requests
+import re
+import aiohttp
+import asyncio
 import json
 import os
-import subprocess
-import threading
 import time
+from librespot_supervisor import LibrespotProcess, LibrespotPool, LibrespotWorker, PoolFullError, READY_TIMEOUT
+import audio
+from request_scheduler import RequestScheduler, INTERACTIVE, BULK
+from search_cache import SearchCache
+from playback_state import PlaybackPoller, PlaybackState
+from track_cache import TrackCache
+from song_queue import Track
+from librespot_cache import LibrespotCache
+
+
+# One librespot worker per guild, each with its own device, process and audio feed
+workers = LibrespotPool()
+# How often librespot is restarted with a fresh access token
+LIBRESPOT_REFRESH_INTERVAL = int(os.getenv("LIBRESPOT_REFRESH_INTERVAL", "3590"))
+# How long to wait before retrying a failed librespot rollover. Doubles with every failure in a row
+LIBRESPOT_RETRY_DELAY = int(os.getenv("LIBRESPOT_RETRY_DELAY", "30"))
+# The longest to wait between rollover retries, kept well below an access token's lifetime
+LIBRESPOT_MAX_RETRY_DELAY = int(os.getenv("LIBRESPOT_MAX_RETRY_DELAY", "300"))
+# Where to send Spotify Web API requests. Pointed at a local stand-in by the benchmarks
+SPOTIFY_API_PREFIX = os.getenv("SPOTIFY_API_PREFIX", "https://api.spotify.com/v1")
+
+# One pooled keep-alive session shared by every call to Spotify and the auth server 
+_session: aiohttp.ClientSession | None = None
+
+# Admits Spotify requests by priority and holds them back while Spotify is rate limiting us
+scheduler = RequestScheduler()
+# How many times a request is retried after a 429 before giving up
+RATE_LIMIT_RETRIES = int(os.getenv("SPOTIFY_RATE_LIMIT_RETRIES", "3"))
+
+# Recent search results, so repeated `.play` requests skip the search round trip
+search_cache = SearchCache()
+
+# The audio cache shared by every librespot worker
+librespot_cache = LibrespotCache()
+
+# Details of every track the bot has seen, so embeds never have to look a track up
+track_cache = TrackCache()
+
+# The last known state of Spotify's player, polled in the background while any librespot is running
+playback = PlaybackPoller(lambda: _fetch_playback(), active=lambda: bool(workers.workers))
+
+# How many tracks from a playlist, album or artist may be queued at the same time. Spotify queues 
+# tracks in the order the requests arrive, so set this to 1 to keep the exact order
+ENQUEUE_CONCURRENCY = int(os.getenv("SPOTIFY_ENQUEUE_CONCURRENCY", "4"))
+# Matches `spotify:album:<id>` URIs as well as `https://open.spotify.com/album/<id>` links
+SPOTIFY_LINK_PATTERN = re.compile(r"(?:spotify:|open\.spotify\.com/(?:intl-[\w-]+/)?)(track|album|playlist|artist)[:/]([A-Za-z0-9]+)")
+
+# Refresh the cached access token this many seconds before it actually expires
+TOKEN_REFRESH_MARGIN = int(os.getenv("SPOTIFY_TOKEN_REFRESH_MARGIN", "60"))
+# How long to trust a token when the auth server does not say when it expires
+DEFAULT_TOKEN_LIFETIME = int(os.getenv("SPOTIFY_DEFAULT_TOKEN_LIFETIME", "600"))
+
+# The cached tokens from the auth server and the `time.time()` at which the access token expires
+_tokens: Dict[str, str] | None = None
+_tokens_expire_at: float = 0
+# Held while fetching or refreshing tokens so that only one refresh is ever in flight
+_token_lock = asyncio.Lock()
+# How long to wait before reconnecting to the auth server's token stream. Doubles after each failed attempt
+TOKEN_STREAM_RETRY_DELAY = float(os.getenv("SPOTIFY_TOKEN_STREAM_RETRY_DELAY", "5"))
+TOKEN_STREAM_MAX_RETRY_DELAY = 300
+# The auth server sends a keepalive every 15 seconds, so a stream silent for this long has died
+TOKEN_STREAM_TIMEOUT = 60
+# Follows the auth server's token stream, replacing the cached tokens the moment the auth server rotates them
+_token_stream: asyncio.Task | None = None
+# Cleared if the auth server turns out to be too old to stream tokens
+_token_stream_supported = True
+
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    Returns the shared `aiohttp` session, creating it the first time it is needed. Reusing a 
+    single session keeps connections to Spotify and the auth server open between commands 
+    instead of paying for a new TCP/TLS handshake on every request
 
+    :returns: The shared client session
+    """
 
-librespot = None
-SPOTIFY_API_PREFIX="https://api.spotify.com/v1"
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=10),
+        )
+    return _session
 
 
-def is_valid_token(token: str) -> bool:
-    response = requests.get(f"{SPOTIFY_API_PREFIX}/tracks/2TpxZ7JUBn3uw46aR7qd6V", headers={
-        "Authorization": f"Bearer {token}"
-    })
-    if 300 > response.status_code >= 200:
-        return True 
-    elif response.status_code == 401:
-        return False
-    raise ValueError(f"is_valid_token received unexpected response from Spotify: code {response.status_code} and text {response.text}")
+async def close_session():
+    """
+    Closes the shared `aiohttp` session if it is open and writes out tracks `track_cache` has yet to save. 
+    Should be called when the music cog is unloaded
+    """
+
+    global _session, _token_stream
+    if _token_stream is not None:
+        _token_stream.cancel()
+        _token_stream = None
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+    await track_cache.flush()
+
+
+async def _request(method: str, url: str, **kwargs) -> Tuple[int, str]:
+    """
+    Sends a request on the shared session and reads the full response body before the 
+    connection is handed back to the pool
+
+    :param method: The HTTP method to use
+    :param url: The full url to send the request to
+    :returns: A tuple of the response status code and the response text
+    """
+
+    async with get_session().request(method, url, **kwargs) as response:
+        return response.status, await response.text()
+
+
+async def _scheduled_request(method: str, url: str, priority: int, **kwargs) -> Tuple[int, str]:
+    """
+    Sends a Spotify request once `scheduler` admits it. A 429 tells the scheduler to hold back every 
+    request for Spotify's `Retry-After`, after which this request is retried up to `RATE_LIMIT_RETRIES` times
+
+    :param method: The HTTP method to use
+    :param url: The full url to send the request to
+    :param priority: `INTERACTIVE` or `BULK`
+    :returns: A tuple of the response status code and the response text
+    """
+
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        async with scheduler.slot(priority):
+            async with get_session().request(method, url, **kwargs) as response:
+                status, text = response.status, await response.text()
+                retry_after = response.headers.get("Retry-After", "1")
+
+        if status != 429:
+            break
+
+        try:
+            wait = float(retry_after)
+        except ValueError:
+            wait = 1.0
+        print(f"Spotify rate limited {method} {url}. Retrying in {wait:g} seconds")
+        scheduler.rate_limited(wait)
+
+    return status, text
+
+
+async def _spotify_request(method: str, url: str, headers: Dict[str, str] | None = None, priority: int = INTERACTIVE, **kwargs) -> Tuple[int, str]:
+    """
+    Sends an authorized request to the Spotify Web API using the cached access token. If Spotify 
+    rejects the token with a 401, the token is refreshed and the request is retried once
+
+    :param method: The HTTP method to use
+    :param url: The full url to send the request to
+    :param headers: Any extra headers to send along with the authorization header
+    :param priority: `INTERACTIVE` for requests a user is waiting on, `BULK` for background work
+    :returns: A tuple of the response status code and the response text
+    """
+
+    tokens = await get_access_token()
+    access_token = tokens["access_token"] if tokens else None
+    status, text = await _scheduled_request(method, url, priority, headers={**(headers or {}), "Authorization": f"Bearer {access_token}"}, **kwargs)
+    if status != 401:
+        return status, text
 
+    tokens = await _refresh_rejected_token(access_token)
+    if tokens is None or tokens["access_token"] == access_token:
+        return status, text
+    return await _scheduled_request(method, url, priority, headers={**(headers or {}), "Authorization": f"Bearer {tokens['access_token']}"}, **kwargs)
 
-def logout() -> bool: 
+
+async def _device_request(guild_id: int, method: str, url: str, priority: int = INTERACTIVE, **kwargs) -> Tuple[int, str]:
+    """
+    Sends an authorized request that targets a guild's librespot device by appending its cached 
+    `device_id` to `url`. If Spotify responds with a 404 the cached id is dropped, resolved again, 
+    and the request is retried once
+
+    :param guild_id: The guild whose librespot worker the request is for
+    :param method: The HTTP method to use
+    :param url: The full url to send the request to, without a `device_id` query parameter
+    :param priority: `INTERACTIVE` or `BULK`
+    :returns: A tuple of the response status code and the response text
+    """
+
+    separator = "&" if "?" in url else "?"
+    status, text = await _spotify_request(method, f"{url}{separator}device_id={await get_bot_device_id(guild_id)}", priority=priority, **kwargs)
+    if status != 404:
+        return status, text
+
+    invalidate_bot_device_id(guild_id)
+    return await _spotify_request(method, f"{url}{separator}device_id={await get_bot_device_id(guild_id)}", priority=priority, **kwargs)
+
+
+def _store_tokens(body: Dict[str, str]) -> Dict[str, str] | None:
+    """
+    Caches tokens returned by the auth server along with the time they expire. Uses `expires_at` 
+    or `expires_in` if the auth server sent one, otherwise assumes `DEFAULT_TOKEN_LIFETIME`
+
+    :param body: The json body of an auth server response
+    :returns: The cached tokens, or `None` if `body` did not contain an access token
+    """
+
+    global _tokens, _tokens_expire_at
+    if not body or body.get("access_token") in (None, ""):
+        return None
+
+    if body.get("expires_at"):
+        expires_at = float(body["expires_at"])
+    elif body.get("expires_in"):
+        expires_at = time.time() + float(body["expires_in"])
+    else:
+        expires_at = time.time() + DEFAULT_TOKEN_LIFETIME
+
+    refresh = body.get("refresh_token") or (_tokens or {}).get("refresh_token")
+    _tokens = {"access_token": body["access_token"], "refresh_token": refresh}
+    _tokens_expire_at = expires_at
+    return _tokens
+
+
+def _cached_tokens() -> Dict[str, str] | None:
+    """
+    :returns: The cached tokens if they will not expire within `TOKEN_REFRESH_MARGIN` seconds, otherwise `None`
+    """
+
+    if _tokens is not None and time.time() < _tokens_expire_at - TOKEN_REFRESH_MARGIN:
+        return _tokens
+    return None
+
+
+def clear_token_cache():
+    """
+    Forgets the cached tokens so that the next call fetches them from the auth server again
+    """
+
+    global _tokens, _tokens_expire_at
+    _tokens = None
+    _tokens_expire_at = 0
+
+
+async def _refresh_rejected_token(access_token: str | None) -> Dict[str, str] | None:
+    """
+    Replaces an access token that Spotify rejected with a 401. When several commands see the same 
+    rejected token at once, only the first one refreshes and the rest reuse its result
+
+    :param access_token: The access token that was rejected
+    :returns: The new tokens, or `None` if no valid token could be obtained
+    """
+
+    async with _token_lock:
+        if _tokens is not None and _tokens["access_token"] != access_token:
+            return _tokens
+
+        clear_token_cache()
+        tokens = await _fetch_tokens()
+        if tokens is not None and tokens["access_token"] == access_token and tokens.get("refresh_token"):
+            # The auth server handed back the same stale token, so make it refresh
+            tokens = _store_tokens(await refresh_token(tokens["refresh_token"]))
+        return tokens
+
+
+async def _fetch_tokens() -> Dict[str, str] | None:
+    """
+    Fetches tokens from the auth server and caches them, falling back to a refresh if the 
+    auth server does not have any. Must be called while holding `_token_lock`
+    """
+
+    status, text = await _request("GET", f"{os.getenv('AUTH_SERVER')}/access-token/{os.getenv('AUTH_SERVER_SECURITY')}")
+    if 300 > status >= 200:
+        body = json.loads(text)
+        if _store_tokens(body) is None:
+            return body
+        return _tokens
+    return _store_tokens(await refresh_token(os.getenv("SPOTIFY_REFRESH_TOKEN")))
+
+
+async def logout() -> bool: 
     """
     "Logs out" the user by removing all references to access tokens or refresh tokens both locally 
     as well as on the auth server
@@ -39,8 +296,9 @@ def logout() -> bool:
     if os.getenv("SPOTIFY_REFRESH_TOKEN"):
         del os.environ["SPOTIFY_REFRESH_TOKEN"]
 
-    response = requests.delete(f"{os.getenv('AUTH_SERVER')}/access-token/{os.getenv('AUTH_SERVER_SECURITY')}")
-    if 300 > response.status_code >= 200:
+    clear_token_cache()
+    status, _ = await _request("DELETE", f"{os.getenv('AUTH_SERVER')}/access-token/{os.getenv('AUTH_SERVER_SECURITY')}")
+    if 300 > status >= 200:
         print("Successfully logged out")
         return True 
 
@@ -48,163 +306,679 @@ def logout() -> bool:
     return False 
 
 
-def refresh_token(refresh_token: str) -> Dict[str, str] | None: 
-    response = requests.post(f"{os.getenv('AUTH_SERVER')}/refresh-token?state={os.getenv('AUTH_SERVER_SECURITY')}&refresh_token={refresh_token}")
-    if 300 > response.status_code >= 200:
-        body = json.loads(response.text)
+async def refresh_token(refresh_token: str) -> Dict[str, str] | None: 
+    status, text = await _request("POST", f"{os.getenv('AUTH_SERVER')}/refresh-token?state={os.getenv('AUTH_SERVER_SECURITY')}&refresh_token={refresh_token}")
+    if 300 > status >= 200:
+        body = json.loads(text)
+        _store_tokens({"refresh_token": refresh_token, **body})
         return body
 
-    print(f"refresh_token failed with code {response.status_code} and text {response.text}")
+    print(f"refresh_token failed with code {status} and text {text}")
     return None
 
 
-def get_spotify_headers(): 
+async def get_spotify_headers(): 
     return {
-        "Authorization": f"Bearer {get_access_token()['access_token']}",
+        "Authorization": f"Bearer {(await get_access_token())['access_token']}",
     }
 
 
-def get_access_token() -> Dict[str, str] | None:
-    response = requests.get(f"{os.getenv('AUTH_SERVER')}/access-token/{os.getenv('AUTH_SERVER_SECURITY')}")
-    if 300 > response.status_code >= 200:
-        return json.loads(response.text)
-    return refresh_token(os.getenv("SPOTIFY_REFRESH_TOKEN"))
+async def get_access_token() -> Dict[str, str] | None:
+    """
+    Returns the cached tokens, only asking the auth server for new ones when the cached access 
+    token is missing or about to expire. Concurrent callers share a single fetch
+
+    :returns: A dictionary with the keys "access_token" and "refresh_token"
+    """
+
+    watch_tokens()
+    tokens = _cached_tokens()
+    if tokens is not None:
+        return tokens
+
+    async with _token_lock:
+        # Another command may have fetched new tokens while we were waiting on the lock
+        tokens = _cached_tokens()
+        if tokens is not None:
+            return tokens
+        return await _fetch_tokens()
+
+
+def watch_tokens():
+    """
+    Starts following the auth server's token stream if it isn't already, so the cached tokens stay 
+    current without asking the auth server again
+    """
+
+    global _token_stream
+    if _token_stream_supported and (_token_stream is None or _token_stream.done()):
+        _token_stream = asyncio.create_task(_follow_token_stream())
 
 
-def is_playing():
-    response = requests.get(f"{SPOTIFY_API_PREFIX}/me/player", headers=get_spotify_headers())
-    if 300 > response.status_code >= 200: 
-        body = json.loads(response.text)
-        return body["is_playing"]
-    
-    print(f"is_playing failed with status {response.status_code} and text {response.text}")
+def _apply_pushed_tokens(body: Dict[str, str]):
+    if body.get("access_token"):
+        _store_tokens(body)
+        print("Received new tokens from the auth server")
+    else:
+        clear_token_cache()
+        print("The auth server logged out")
+
+
+async def _follow_token_stream():
+    """
+    Reads server-sent events from `/access-token/{state}/events`, reconnecting with backoff whenever 
+    the stream drops. Gives up if the auth server is too old to have the stream
+    """
+
+    global _token_stream_supported
+    url = f"{os.getenv('AUTH_SERVER')}/access-token/{os.getenv('AUTH_SERVER_SECURITY')}/events"
+    delay = TOKEN_STREAM_RETRY_DELAY
+    while True:
+        try:
+            async with get_session().get(url, timeout=aiohttp.ClientTimeout(total=None, sock_read=TOKEN_STREAM_TIMEOUT)) as response:
+                if response.status == 404:
+                    print("The auth server does not push tokens. Polling it instead")
+                    _token_stream_supported = False
+                    return
+                if response.status != 200:
+                    raise ValueError(f"status {response.status}")
+
+                delay = TOKEN_STREAM_RETRY_DELAY
+                data = []
+                async for line in response.content:
+                    line = line.decode("utf-8").rstrip("\r\n")
+                    if line.startswith("data:"):
+                        data.append(line[5:].strip())
+                    elif not line and data:
+                        _apply_pushed_tokens(json.loads("\n".join(data)))
+                        data = []
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Lost the auth server's token stream: {e!r}. Reconnecting in {delay:g} seconds")
+
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, TOKEN_STREAM_MAX_RETRY_DELAY)
+
+
+async def _fetch_playback() -> Dict | None:
+    status, text = await _spotify_request("GET", f"{SPOTIFY_API_PREFIX}/me/player", priority=BULK)
+    if status == 204:
+        return {}
+    if 300 > status >= 200:
+        body = json.loads(text)
+        if body.get("item"):
+            track_cache.remember(body["item"])
+        return body
 
+    print(f"Fetching playback state failed with status {status} and text {text}")
 
-def play():
-    response = requests.put(f"{SPOTIFY_API_PREFIX}/me/player/play?device_id={get_bot_device_id()}", headers=get_spotify_headers())
-    if 300 > response.status_code >= 200:
+
+async def get_playback() -> PlaybackState | None:
+    """
+    :returns: The cached playback state, only asking Spotify if nothing has been cached yet
+    """
+    return await playback.get()
+
+
+async def is_playing(guild_id: int | None = None) -> bool:
+    """
+    Answers from the cached playback state, so this usually costs no request
+
+    :param guild_id: Only count playback on this guild's librespot device
+    """
+    state = await playback.get()
+    if state is None:
+        return False
+    if guild_id is not None:
+        worker = workers.get(guild_id)
+        if worker is None or worker.device_id is None or worker.device_id != state.device_id:
+            return False
+    return state.is_playing
+
+
+def guild_for_device(device_id: str | None) -> int | None:
+    """
+    :returns: The guild whose librespot registered the Spotify Connect device `device_id`, if any
+    """
+    for guild_id, worker in workers.workers.items():
+        if device_id is not None and worker.device_id == device_id:
+            return guild_id
+    return None
+
+
+async def play(guild_id: int):
+    status, text = await _device_request(guild_id, "PUT", f"{SPOTIFY_API_PREFIX}/me/player/play")
+    if 300 > status >= 200:
+        playback.invalidate(is_playing=True)
         print("Resuming playback")
     else:
-        print(f"Failed to resume playback with status {response.status_code} and text {response.text}")
+        print(f"Failed to resume playback with status {status} and text {text}")
 
 
-def pause():
-    response = requests.put(f"{SPOTIFY_API_PREFIX}/me/player/pause?device_id={get_bot_device_id()}", headers=get_spotify_headers())
-    if 300 > response.status_code >= 200:
+async def pause(guild_id: int):
+    status, text = await _device_request(guild_id, "PUT", f"{SPOTIFY_API_PREFIX}/me/player/pause")
+    if 300 > status >= 200:
+        playback.invalidate(is_playing=False)
         print("Pausing playback")
     else:
-        print(f"Failed to pause playback with status {response.status_code} and text {response.text}")
+        print(f"Failed to pause playback with status {status} and text {text}")
 
 
-def skip(dir: str):
+async def skip(guild_id: int, dir: str):
     """
+    :param guild_id: The guild whose librespot worker should skip
     :param dir: Either 'next' or 'previous'
     """
     if dir not in ("next", "previous"):
         raise ValueError("dir must either be 'next' or 'previous'")
         
-    response = requests.post(f"{SPOTIFY_API_PREFIX}/me/player/{dir}?device_id={get_bot_device_id()}", headers=get_spotify_headers())
-    if 300 > response.status_code >= 200:
+    status, text = await _device_request(guild_id, "POST", f"{SPOTIFY_API_PREFIX}/me/player/{dir}")
+    if 300 > status >= 200:
+        playback.invalidate(progress_ms=0)
         print(f"Skipping to {dir}")
     else:
-        print(f"Failed to skip with status {response.status_code} and text {response.text}")
+        print(f"Failed to skip with status {status} and text {text}")
 
 
-def search(query: str):
+async def search(query: str, type: str = "track", limit: int = 1, market: str | None = None):
+    """
+    Searches Spotify, answering from `search_cache` when the same search was made recently
+
+    :param query: The search query
+    :param type: A comma separated list of item types to search for
+    :param limit: The most results to return for each type
+    :param market: An optional ISO country code to limit results to
+    :returns: Spotify's json search results, or `None` if the search failed
+    """
+    key = SearchCache.key(query, type, limit, market)
+    cached = await search_cache.get(key)
+    if cached is not None:
+        track_cache.remember_all(cached.get("tracks", {}).get("items", []))
+        return cached
+
     encoded_query = urllib.parse.quote_plus(query)
-    response = requests.get(f"{SPOTIFY_API_PREFIX}/search?q={encoded_query}&type=track&limit=1", headers=get_spotify_headers())
-    if response.status_code == 200:
-        return json.loads(response.text)
+    url = f"{SPOTIFY_API_PREFIX}/search?q={encoded_query}&type={type}&limit={limit}"
+    if market:
+        url += f"&market={market}"
+    status, text = await _spotify_request("GET", url)
+    if status == 200:
+        body = json.loads(text)
+        await search_cache.put(key, body)
+        track_cache.remember_all(body.get("tracks", {}).get("items", []))
+        return body
     else: 
-        print(response.status_code)
-        print(response.text)
+        print(status)
+        print(text)
 
 
-def add_to_queue(uri: str): 
+async def add_to_queue(guild_id: int, uri: str, priority: int = INTERACTIVE): 
+    """
+    :param guild_id: The guild whose librespot worker should queue the track
+    :param uri: The Spotify URI of the track to queue
+    :param priority: `BULK` when queueing many tracks in the background
+    """
     encoded_uri = urllib.parse.quote(uri)
-    response = requests.post(f"{SPOTIFY_API_PREFIX}/me/player/queue?uri={encoded_uri}&device_id={get_bot_device_id()}", headers=get_spotify_headers())
-    if 300 > response.status_code >= 200:
-        return response
+    status, text = await _device_request(guild_id, "POST", f"{SPOTIFY_API_PREFIX}/me/player/queue?uri={encoded_uri}", priority=priority)
+    if 300 > status >= 200:
+        return status
     else:
-        print(f"add_to_queue failed with response {response.status_code} and text {response.text}")
+        print(f"add_to_queue failed with response {status} and text {text}")
+
+
+async def get_track(id: str) -> Track | None:
+    """
+    :param id: The Spotify id of a track
+    :returns: The track's details from `track_cache`, only asking Spotify if it hasn't been seen before. 
+              `None` if the request failed
+    """
+    cached = await track_cache.get(f"spotify:track:{id}")
+    if cached is not None:
+        return cached
 
+    status, text = await _spotify_request("GET", f"{SPOTIFY_API_PREFIX}/tracks/{id}")
+    if status == 200:
+        return track_cache.remember(json.loads(text))
+    print(f"get_track failed with status {status} and text {text}")
 
-def get_bot_device_id(): 
-    response = requests.get(f"{SPOTIFY_API_PREFIX}/me/player/devices", headers=get_spotify_headers())
-    if 300 > response.status_code >= 200:
-        body = json.loads(response.text)
+
+async def seek(guild_id: int, position_ms: int):
+    """
+    :param guild_id: The guild whose librespot worker should seek
+    :param position_ms: Where to seek to in the current track
+    """
+    status, text = await _device_request(guild_id, "PUT", f"{SPOTIFY_API_PREFIX}/me/player/seek?position_ms={position_ms}")
+    if 300 > status >= 200:
+        playback.invalidate(progress_ms=position_ms)
+        print(f"Seeking to {position_ms}ms")
+    else:
+        print(f"Failed to seek with status {status} and text {text}")
+
+
+def parse_spotify_link(query: str) -> Tuple[str, str] | None:
+    """
+    :param query: What the user asked to play
+    :returns: A tuple of the item type and Spotify id if `query` is a Spotify URI or link, otherwise `None`
+    """
+
+    match = SPOTIFY_LINK_PATTERN.search(query.strip())
+    if match is None:
+        return None
+    return match.group(1), match.group(2)
+
+
+async def iter_collection_tracks(kind: str, id: str) -> AsyncIterator[List[Dict]]:
+    """
+    Pages through the tracks of a playlist, album or artist. The next page is requested as soon as 
+    the current one arrives, so callers can work on a page while the next one is in flight
+
+    :param kind: One of "playlist", "album" or "artist"
+    :param id: The Spotify id of the playlist, album or artist
+    :returns: An async iterator of pages, each a list of Spotify track objects
+    """
+
+    if kind == "playlist":
+        url = f"{SPOTIFY_API_PREFIX}/playlists/{id}/tracks?limit=100"
+    elif kind == "album":
+        url = f"{SPOTIFY_API_PREFIX}/albums/{id}/tracks?limit=50"
+    elif kind == "artist":
+        url = f"{SPOTIFY_API_PREFIX}/artists/{id}/top-tracks"
+    else:
+        raise ValueError("kind must be 'playlist', 'album' or 'artist'")
+
+    next_page = asyncio.create_task(_spotify_request("GET", url))
+    while next_page is not None:
+        status, text = await next_page
+        next_page = None
+        if not 300 > status >= 200:
+            print(f"iter_collection_tracks failed with status {status} and text {text}")
+            return
+
+        body = json.loads(text)
+        if body.get("next"):
+            next_page = asyncio.create_task(_spotify_request("GET", body["next"], priority=BULK))
+
+        items = body.get("tracks") if kind == "artist" else body.get("items", [])
+        if kind == "playlist":
+            items = [item.get("track") for item in items]
+        # Playlists can contain removed tracks, podcast episodes and local files, none of which can be queued
+        tracks = [track for track in items if track and track.get("uri", "").startswith("spotify:track:")]
+        track_cache.remember_all(tracks)
+
+        try:
+            yield tracks
+        except GeneratorExit:
+            if next_page is not None:
+                next_page.cancel()
+            raise
+
+
+async def enqueue_collection(guild_id: int, kind: str, id: str, first_queued: asyncio.Event | None = None,
+                             on_queued: Callable[[Dict], None] | None = None) -> int:
+    """
+    Queues every track of a playlist, album or artist. The first track is queued on its own so 
+    playback can start right away, then the rest are queued in the background with at most 
+    `ENQUEUE_CONCURRENCY` requests in flight while further pages stream in
+
+    :param guild_id: The guild whose librespot worker should queue the tracks
+    :param kind: One of "playlist", "album" or "artist"
+    :param id: The Spotify id of the playlist, album or artist
+    :param first_queued: Set as soon as the first track has been queued, or when nothing could be queued
+    :param on_queued: Called with each track object once Spotify has accepted it
+    :returns: The number of tracks queued
+    """
+
+    limit = asyncio.Semaphore(ENQUEUE_CONCURRENCY)
+    pending = set()
+    queued = 0
+
+    def accepted(track: Dict):
+        nonlocal queued
+        queued += 1
+        if on_queued:
+            on_queued(track)
+
+    async def enqueue(track: Dict):
+        try:
+            if await add_to_queue(guild_id, track["uri"], priority=BULK) is not None:
+                accepted(track)
+        finally:
+            limit.release()
+
+    try:
+        async for tracks in iter_collection_tracks(kind, id):
+            for track in tracks:
+                if queued == 0 and not pending:
+                    if await add_to_queue(guild_id, track["uri"]) is not None:
+                        accepted(track)
+                        if first_queued:
+                            first_queued.set()
+                    continue
+
+                await limit.acquire()
+                task = asyncio.create_task(enqueue(track))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+
+        if pending:
+            await asyncio.gather(*pending)
+    finally:
+        if first_queued:
+            first_queued.set()
+
+    return queued
+
+
+async def _find_device(name: str) -> Dict | None:
+    """
+    Lists the user's devices and finds the one called `name`
+
+    :param name: The Spotify Connect device name a librespot process was started with
+    :returns: The Spotify device object, or `None` if no such device is registered
+    """
+
+    status, text = await _spotify_request("GET", f"{SPOTIFY_API_PREFIX}/me/player/devices")
+    if 300 > status >= 200:
+        body = json.loads(text)
         for device in body["devices"]: 
-            if device["name"] == os.getenv("BOT_NAME"): 
+            if device["name"] == name: 
                 print(f"found device {device['id']}")
-                return device["id"]
-        print("get_bot_device_id failed to find a device")
+                return device
+        print(f"failed to find a device named {name}")
     else:
-        print(f"get_bot_device_id failed with response {response.status_code} and text {response.text}")
+        print(f"listing devices failed with response {status} and text {text}")
 
     return None
 
 
-def switch_to_device():
-    bot_device_id = get_bot_device_id()
-    headers = get_spotify_headers()
-    response = requests.get(f"{SPOTIFY_API_PREFIX}/me/player/devices", headers=headers)
-    if 300 > response.status_code >= 200:
-        body = json.loads(response.text)
-        for device in body["devices"]:
-            if device["is_active"] and device["id"] == bot_device_id:
-                print("Bot is already the active device")
-                return
-
-    headers["Content-Type"] = "application/json"
-    response = requests.put(f"{SPOTIFY_API_PREFIX}/me/player", headers=headers, json={
-        "device_ids": [
-            bot_device_id,
-        ],
-        "play": True
+async def _find_bot_device(worker: LibrespotWorker) -> Dict | None:
+    """
+    Finds the device belonging to a worker's current librespot, caching its id for `get_bot_device_id`
+
+    :param worker: The librespot worker to find the device of
+    :returns: The Spotify device object for the worker, or `None` if it is not registered
+    """
+
+    device = await _find_device(worker.device_name)
+    if device is not None:
+        worker.device_id = device["id"]
+    return device
+
+
+async def get_bot_device_id(guild_id: int): 
+    """
+    Returns the device id of a guild's librespot. The id is only looked up once per librespot 
+    process and then served from memory until `invalidate_bot_device_id` is called
+
+    :param guild_id: The guild whose librespot worker to look up
+    :returns: The worker's Spotify device id, or `None` if librespot has not registered yet
+    """
+
+    worker = workers.get(guild_id)
+    if worker is None:
+        return None
+    if worker.device_id is not None:
+        return worker.device_id
+
+    device = await _find_bot_device(worker)
+    return device["id"] if device else None
+
+
+def invalidate_bot_device_id(guild_id: int):
+    """
+    Forgets a guild's cached librespot device id. Called whenever librespot starts or stops, or 
+    when Spotify no longer recognizes the cached id
+    """
+
+    worker = workers.get(guild_id)
+    if worker is not None:
+        worker.device_id = None
+
+
+async def _transfer_playback(device_id: str | None, play: bool) -> Tuple[int, str]:
+    """
+    Transfers the user's playback to a device
+
+    :param device_id: The Spotify device id to transfer to
+    :param play: Whether playback should continue on the device once it has been transferred
+    :returns: A tuple of the response status code and the response text
+    """
+
+    status, text = await _spotify_request("PUT", f"{SPOTIFY_API_PREFIX}/me/player", headers={"Content-Type": "application/json"}, json={
+        "device_ids": [device_id],
+        "play": play
     })
-    if 300 > response.status_code >= 200 :
-        print("Successfully transferred playback")
-    else:
-        print(f"switch_to_device failed with code {response.status_code} and text {response.text}")
+    if 300 > status >= 200:
+        playback.invalidate(device_id=device_id, is_playing=play)
+    return status, text
+
 
+async def switch_to_device(guild_id: int, force: bool = False, play: bool = True):
+    """
+    Transfers playback to a guild's librespot device. The device id is served from the worker's 
+    cache and the active device from `playback`, so this only lists the user's devices when the id 
+    isn't known yet, or when Spotify no longer recognizes it and the transfer is retried
 
-def set_volume_percent(percent: int): 
-    if percent < 0 or percent > 100:
-        raise ValueError("percent must be between 0 and 100 inclusive")
-    response = requests.put(f"{SPOTIFY_API_PREFIX}/me/player/volume?volume_percent={percent}", headers=get_spotify_headers())
-    if 300 > response.status_code >= 200:
-        print("Successfully set the volume")
+    :param guild_id: The guild whose librespot worker should take over playback
+    :param force: Transfer even if Spotify already reports the worker as the active device
+    :param play: Whether playback should continue on the worker once it has been transferred
+    """
+
+    device_id = await get_bot_device_id(guild_id)
+    if device_id is None:
+        print(f"switch_to_device couldn't find a librespot device for guild {guild_id}")
+        return
+
+    state = playback.state
+    if state is not None and state.device_id == device_id and not force:
+        print("Bot is already the active device")
+        return
+
+    status, text = await _transfer_playback(device_id, play)
+    if status == 404:
+        invalidate_bot_device_id(guild_id)
+        device_id = await get_bot_device_id(guild_id)
+        if device_id is not None:
+            status, text = await _transfer_playback(device_id, play)
+
+    if 300 > status >= 200 :
+        print("Successfully transferred playback")
     else:
-        print(f"set_volume_percent failed with status {response.status_code} and message {response.text}")
+        print(f"switch_to_device failed with code {status} and text {text}")
 
 
-def start_librespot():
-    global librespot 
-    print(get_access_token())
-    librespot = subprocess.Popen([
+def _librespot_args(access_token: str, device_name: str, slot: int) -> List[str]:
+    return [
         "librespot",
-        "--name", os.getenv("BOT_NAME"),
+        "--name", device_name,
         "--backend", "pipe",
         "--bitrate", "320",
-        "--access-token", get_access_token()["access_token"],
+        "--access-token", access_token,
         "--enable-volume-normalisation",
         "--initial-volume", "100",
-    ], stdout=subprocess.PIPE)
+        *librespot_cache.args(slot),
+    ]
 
 
-def stop_librespot():
-    global librespot 
-    if librespot:
-        librespot.terminate()
-        librespot = None
+def _new_librespot(worker: LibrespotWorker, access_token: str, device_name: str | None = None) -> LibrespotProcess:
+    """
+    :param worker: The worker the process will belong to
+    :param access_token: The access token librespot logs in with
+    :param device_name: The device name to register. Defaults to the worker's current one
+    """
+
+    return LibrespotProcess(
+        _librespot_args(access_token, device_name or worker.device_name, worker.slot),
+        env=librespot_cache.env(),
+        on_log=librespot_cache.observe,
+    )
+
+
+def get_worker(guild_id: int) -> LibrespotWorker | None:
+    """
+    :param guild_id: The guild to look up
+    :returns: The guild's librespot worker if librespot is running for it
+    """
+
+    worker = workers.get(guild_id)
+    if worker is None or worker.process is None:
+        return None
+    return worker
+
+
+async def start_librespot(guild_id: int):
+    """
+    Starts librespot for a guild, taking a worker from the pool
+
+    :param guild_id: The guild to start librespot for
+    :raises PoolFullError: If every librespot worker is already busy with another guild
+    """
+
+    worker = workers.acquire(guild_id)
+    tokens = await get_access_token()
+    worker.stop()
+    if librespot_cache.enabled:
+        await asyncio.to_thread(librespot_cache.prune)
+    worker.process = _new_librespot(worker, tokens["access_token"])
+    worker.process.start()
+    worker.pcm_feed.attach(worker.process.pcm)
+    worker.refresh_task = asyncio.create_task(_refresh_librespot(worker))
+    playback.start()
 
 
-def _refresh_librespot():
-    global librespot 
-    print(f"starting refresh thread: Librespot is '{librespot}'")
-    if librespot:
-        print("Waiting to refresh librespot in 1 hour")
-        time.sleep(3590)
+async def _wait_for_device(process: LibrespotProcess, name: str, deadline: float) -> Dict | None:
+    """
+    Waits for a librespot process to report that it is ready, then for Spotify to list its device. 
+    Spotify can take a moment to list a freshly announced device, so the lookup backs off briefly 
+    until `deadline`
+
+    :param process: The librespot process to wait for
+    :param name: The device name the process was started with
+    :param deadline: The `time.monotonic()` to give up at
+    :returns: The process's Spotify device object, or `None` if it never appeared
+    """
+
+    if not await process.wait_ready(max(0.0, deadline - time.monotonic())):
+        return None
+
+    delay = 0.1
+    while (device := await _find_device(name)) is None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or process.poll() is not None:
+            return None
+        await asyncio.sleep(min(delay, remaining))
+        delay *= 2
+    return device
+
+
+async def wait_for_librespot(guild_id: int, timeout: float = READY_TIMEOUT) -> bool:
+    """
+    Waits for a guild's librespot to report that it is ready, then resolves its device id
+
+    :param guild_id: The guild whose librespot to wait for
+    :param timeout: The maximum number of seconds to wait in total
+    :returns: `True` if librespot is ready and its device id is known. `False` otherwise
+    """
+
+    worker = workers.get(guild_id)
+    if worker is None or worker.process is None:
+        return False
+
+    device = await _wait_for_device(worker.process, worker.device_name, time.monotonic() + timeout)
+    if device is None:
+        return False
+    worker.device_id = device["id"]
+    return True
+
+
+def stop_librespot(guild_id: int):
+    """
+    Stops a guild's librespot and frees its worker for other guilds
+    """
+
+    workers.release(guild_id)
+
+
+def stop_all_librespot():
+    """
+    Stops librespot for every guild
+    """
+
+    workers.release_all()
+    playback.stop()
+
+
+async def rollover_librespot(worker: LibrespotWorker, timeout: float = READY_TIMEOUT) -> bool:
+    """
+    Replaces a worker's librespot process with one started from a fresh access token without an 
+    audible gap. The replacement registers under the worker's next device name, so it shows up as 
+    its own device while the old process keeps playing. Once Spotify lists it, playback is 
+    transferred to exactly that device, and only once it is producing audio is the old process 
+    stopped. The worker's `pcm_feed` drains the old process's last audio before handing over to 
+    the new one
+
+    :param worker: The librespot worker to refresh
+    :param timeout: The maximum number of seconds to wait for each step of the handover
+    :returns: `True` if playback was handed over. `False` if the old process was left running
+    """
+
+    old = worker.process
+    if old is None:
+        return False
+
+    playing = await is_playing(worker.key)
+    tokens = await get_access_token()
+    generation = worker.generation + 1
+    name = worker.device_name_for(generation)
+    replacement = _new_librespot(worker, tokens["access_token"], name)
+    replacement.start()
+
+    device = await _wait_for_device(replacement, name, time.monotonic() + timeout)
+    if device is None:
+        print("Replacement librespot never became ready. Keeping the old one")
+        replacement.terminate()
+        return False
+
+    status, text = await _transfer_playback(device["id"], playing)
+    if not 300 > status >= 200:
+        print(f"Transferring playback to the replacement librespot failed with code {status} and text {text}. Keeping the old one")
+        replacement.terminate()
+        return False
+
+    worker.process = replacement
+    worker.generation = generation
+    worker.device_id = device["id"]
+    worker.pcm_feed.queue(replacement.pcm)
+
+    if playing:
+        deadline = time.monotonic() + timeout
+        while replacement.pcm.available() == 0 and time.monotonic() < deadline:
+            await asyncio.sleep(audio.FRAME_DURATION)
+
+    old.terminate()
+    print(f"Handed playback for {worker.key} over to a refreshed librespot")
+    return True
+
+
+async def _refresh_librespot(worker: LibrespotWorker):
+    """
+    Rolls a worker's librespot over to a fresh access token every `LIBRESPOT_REFRESH_INTERVAL` 
+    seconds for as long as it is running. A failed rollover leaves the old process playing on a 
+    token that is about to expire, so it is retried after `LIBRESPOT_RETRY_DELAY` seconds, backing 
+    off up to `LIBRESPOT_MAX_RETRY_DELAY`, rather than a whole interval later
+    """
+
+    print(f"starting refresh task: Librespot is '{worker.process}'")
+    delay = LIBRESPOT_REFRESH_INTERVAL
+    failures = 0
+    while worker.process:
+        print(f"Waiting to refresh librespot in {delay} seconds")
+        await asyncio.sleep(delay)
         print("Refreshing librespot")
-        stop_librespot()
-        start_librespot()
+        if await rollover_librespot(worker):
+            failures = 0
+            delay = LIBRESPOT_REFRESH_INTERVAL
+        else:
+            failures += 1
+            delay = min(LIBRESPOT_RETRY_DELAY * 2 ** (failures - 1), LIBRESPOT_MAX_RETRY_DELAY)
+            print(f"Refreshing librespot for {worker.key} failed {failures} times. Retrying in {delay} seconds")
@@ -0,0 +1,160 @@
+from typing import Dict, List, Set
+import asyncio
+import os
+import sqlite3
+import threading
+from cachetools import LRUCache
+from song_queue import Track
+
+
+# How many tracks to keep in memory
+TRACK_CACHE_SIZE = int(os.getenv("TRACK_CACHE_SIZE", "4096"))
+# Where to persist track details between restarts. Leave unset to only cache in memory
+TRACK_CACHE_PATH = os.getenv("TRACK_CACHE_PATH")
+# How long to collect new tracks before writing them to disk in one transaction
+FLUSH_DELAY = 1.0
+
+
+class TrackCache:
+    """
+    A bounded LRU cache of track details keyed by Spotify URI. It is filled from the search, playlist
+    and player responses the bot already receives, so embeds can show a track without asking Spotify
+    for `/tracks/{id}`. Track details never change, so entries don't expire. If `path` is given, tracks
+    are also written to a SQLite file so the cache survives restarts.
+
+    :param maxsize: How many tracks to keep in memory
+    :param path: The SQLite file to persist tracks to, or `None` to only cache in memory
+    """
+
+    def __init__(self, maxsize: int = TRACK_CACHE_SIZE, path: str | None = TRACK_CACHE_PATH) -> None:
+        self._memory: LRUCache = LRUCache(maxsize)
+        self._pending: Dict[str, Track] = {}
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._flush_tasks: Set[asyncio.Task] = set()
+
+        self._db: sqlite3.Connection | None = None
+        self._db_lock = threading.Lock()
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS tracks (uri TEXT PRIMARY KEY, title TEXT NOT NULL, artists TEXT NOT NULL, duration_ms INTEGER NOT NULL, image_url TEXT)")
+            self._db.commit()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def remember(self, track: Dict) -> Track:
+        """
+        Caches a track object from any Spotify response. Simplified track objects, like those in album
+        listings, carry no album art, so details already known are kept rather than overwritten
+
+        :param track: A Spotify track object
+        :returns: The cached `Track`. The same instance is returned every time a track is remembered
+        """
+
+        new = Track.from_spotify(track)
+        existing = self._memory.get(new.uri)
+        if existing is None:
+            self._memory[new.uri] = new
+            self._queue_write(new)
+            return new
+
+        changed = False
+        for field in Track.__slots__:
+            if getattr(new, field) and getattr(new, field) != getattr(existing, field):
+                setattr(existing, field, getattr(new, field))
+                changed = True
+        if changed:
+            self._queue_write(existing)
+        return existing
+
+    def remember_all(self, tracks: List[Dict]):
+        for track in tracks:
+            if track and track.get("uri"):
+                self.remember(track)
+
+    def peek(self, uri: str) -> Track | None:
+        """
+        :returns: The track if it is held in memory, without touching the disk
+        """
+
+        return self._memory.get(uri)
+
+    async def get(self, uri: str) -> Track | None:
+        """
+        :param uri: The Spotify URI of a track
+        :returns: The cached track, or `None` on a miss
+        """
+
+        track = self._memory.get(uri)
+        if track is not None:
+            self.hits += 1
+            return track
+
+        if self._db is not None:
+            track = await asyncio.to_thread(self._load, uri)
+            if track is not None:
+                self.disk_hits += 1
+                self._memory[uri] = track
+                return track
+
+        self.misses += 1
+        return None
+
+    def _queue_write(self, track: Track):
+        if self._db is None:
+            return
+        self._pending[track.uri] = track
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(FLUSH_DELAY, self._flush)
+
+    def _flush(self):
+        self._flush_handle = None
+        batch, self._pending = list(self._pending.values()), {}
+        task = asyncio.create_task(asyncio.to_thread(self._store, batch))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_done)
+
+    def _flush_done(self, task: asyncio.Task):
+        self._flush_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Saving tracks to the track cache failed: {task.exception()!r}")
+
+    async def flush(self):
+        """
+        Writes tracks still waiting for the next batch right away and waits for every write in progress
+        to finish. Should be called on shutdown so the last second of tracks isn't lost
+        """
+
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._pending:
+            self._flush()
+        if self._flush_tasks:
+            # Failed writes are logged by `_flush_done`, so they are not raised here
+            await asyncio.wait(list(self._flush_tasks))
+
+    def _load(self, uri: str) -> Track | None:
+        with self._db_lock:
+            row = self._db.execute("SELECT uri, title, artists, duration_ms, image_url FROM tracks WHERE uri = ?", (uri,)).fetchone()
+        return Track(*row) if row is not None else None
+
+    def _store(self, tracks: List[Track]):
+        rows = [(track.uri, track.title, track.artists, track.duration_ms, track.image_url) for track in tracks]
+        with self._db_lock:
+            self._db.executemany("INSERT OR REPLACE INTO tracks (uri, title, artists, duration_ms, image_url) VALUES (?, ?, ?, ?, ?)", rows)
+            self._db.commit()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :returns: Hit and miss counters along with how many tracks are held in memory
+        """
+
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "size": len(self._memory),
+        }
@@ -0,0 +1,258 @@
+from typing import Callable, Dict, List, Tuple
+import bisect
+import math
+import threading
+import time
+import discord
+
+
+# Histogram bucket upper bounds in seconds, from well under a frame to several frames
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.015, 0.02, 0.025, 0.03, 0.04, 0.06, 0.08, 0.16, 0.32, 0.64, math.inf)
+# Discord expects one frame every 20 ms
+FRAME_INTERVAL = 0.02
+# A frame requested this long after the previous one is counted as late
+LATE_THRESHOLD = FRAME_INTERVAL * 1.5
+# A read that takes longer than a whole frame is counted as a stall of the source
+STALL_THRESHOLD = FRAME_INTERVAL
+# Longer gaps between frames are pauses rather than late frames
+PAUSE_THRESHOLD = 1.0
+
+
+class Histogram:
+    """
+    A fixed-bucket histogram cheap enough to update on every voice frame
+
+    :param buckets: Increasing bucket upper bounds, ending with infinity
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """
+        :returns: An estimate of the `q` quantile, interpolated within its bucket the way Prometheus'
+                  `histogram_quantile` does and capped at the largest value seen
+        """
+
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, self.counts):
+            if count and seen + count >= rank:
+                if math.isinf(bound):
+                    return self.max
+                return min(lower + (bound - lower) * (rank - seen) / count, self.max)
+            seen += count
+            lower = bound
+        return self.max
+
+    def cumulative(self) -> List[Tuple[float, int]]:
+        """
+        :returns: `(upper bound, count of values at or below it)` pairs, as Prometheus expects
+        """
+
+        total = 0
+        pairs = []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+
+class VoiceStats:
+    """
+    Frame timing for one kind of audio in one guild. Updated from discord.py's player thread and read
+    from the event loop, so every access goes through a lock.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.read_latency = Histogram()
+        self.frame_interval = Histogram()
+        self.stalls = Histogram()
+        self.frames = 0
+        self.late_frames = 0
+        self.dropped_frames = 0
+        self.underruns = 0
+
+    def record(self, read_seconds: float, interval: float | None, underruns: int):
+        """
+        :param read_seconds: How long the source took to produce the frame
+        :param interval: How long since the previous frame was requested, or `None` for the first frame
+        :param underruns: How many times the source ran out of buffered audio while producing the frame
+        """
+
+        with self.lock:
+            self.frames += 1
+            self.underruns += underruns
+            self.read_latency.observe(read_seconds)
+            if read_seconds > STALL_THRESHOLD:
+                self.stalls.observe(read_seconds)
+            if interval is None or interval > PAUSE_THRESHOLD:
+                return
+            self.frame_interval.observe(interval)
+            if interval > LATE_THRESHOLD:
+                self.late_frames += 1
+                # Each whole frame slot that passed without a frame is one Discord never received on time
+                self.dropped_frames += max(0, int(interval / FRAME_INTERVAL) - 1)
+
+    def summary(self) -> Dict[str, float]:
+        """
+        :returns: Counters along with read latency and frame interval percentiles in milliseconds
+        """
+
+        with self.lock:
+            return {
+                "frames": self.frames,
+                "late_frames": self.late_frames,
+                "dropped_frames": self.dropped_frames,
+                "underruns": self.underruns,
+                "stalls": self.stalls.count,
+                "longest_stall_ms": self.stalls.max * 1000,
+                "read_p50_ms": self.read_latency.quantile(0.5) * 1000,
+                "read_p99_ms": self.read_latency.quantile(0.99) * 1000,
+                "read_max_ms": self.read_latency.max * 1000,
+                "interval_p50_ms": self.frame_interval.quantile(0.5) * 1000,
+                "interval_p99_ms": self.frame_interval.quantile(0.99) * 1000,
+            }
+
+
+# Stats for every guild and kind of audio that has played since the bot started
+registry: Dict[Tuple[int, str], VoiceStats] = {}
+_registry_lock = threading.Lock()
+
+
+def get_stats(guild_id: int, kind: str) -> VoiceStats:
+    """
+    :param guild_id: The guild the audio is played in
+    :param kind: What is playing, e.g. "music" or "soundboard"
+    """
+
+    with _registry_lock:
+        stats = registry.get((guild_id, kind))
+        if stats is None:
+            stats = registry[(guild_id, kind)] = VoiceStats()
+        return stats
+
+
+def guild_stats(guild_id: int) -> Dict[str, VoiceStats]:
+    """
+    :returns: The stats for each kind of audio that has played in a guild
+    """
+
+    with _registry_lock:
+        return {kind: stats for (guild, kind), stats in registry.items() if guild == guild_id}
+
+
+class InstrumentedSource(discord.AudioSource):
+    """
+    Wraps an audio source to time every frame the voice player asks it for. Slow reads point at the
+    source (librespot, ffmpeg or the resampler), while late frames with fast reads point at the player
+    thread being starved, usually by event loop or GIL contention.
+
+    :param source: The audio source to time
+    :param stats: Where to record the timings
+    :param underruns: Returns a running count of the source's buffer underruns, if it has a buffer
+    """
+
+    def __init__(self, source: discord.AudioSource, stats: VoiceStats, underruns: Callable[[], int] | None = None) -> None:
+        self.source = source
+        self.stats = stats
+        self.underruns = underruns
+        self._last_underruns = underruns() if underruns else 0
+        self._last_read: float | None = None
+
+    def read(self) -> bytes:
+        start = time.perf_counter()
+        frame = self.source.read()
+        end = time.perf_counter()
+
+        underruns = 0
+        if self.underruns is not None:
+            total = self.underruns()
+            # The count starts over when librespot is replaced and the feed moves to a new buffer
+            underruns = total - self._last_underruns if total >= self._last_underruns else total
+            self._last_underruns = total
+        interval = start - self._last_read if self._last_read is not None else None
+        self._last_read = start
+        if frame:
+            self.stats.record(end - start, interval, underruns)
+        return frame
+
+    def is_opus(self) -> bool:
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.source.cleanup()
+
+
+def instrument(source: discord.AudioSource, guild_id: int, kind: str, underruns: Callable[[], int] | None = None) -> InstrumentedSource:
+    """
+    :param source: The audio source about to be played
+    :param guild_id: The guild it is played in
+    :param kind: What is playing, e.g. "music" or "soundboard"
+    :param underruns: Returns a running count of the source's buffer underruns, if it has a buffer
+    :returns: `source` wrapped so its frame timing is recorded
+    """
+
+    return InstrumentedSource(source, get_stats(guild_id, kind), underruns)
+
+
+def _format_bound(bound: float) -> str:
+    return "+Inf" if math.isinf(bound) else repr(bound)
+
+
+def render_prometheus() -> str:
+    """
+    :returns: Every guild's voice stats in the Prometheus text exposition format
+    """
+
+    with _registry_lock:
+        entries = sorted(registry.items())
+
+    histograms = (
+        ("voice_frame_read_seconds", "Time the audio source took to produce each 20 ms frame", "read_latency"),
+        ("voice_frame_interval_seconds", "Time between consecutive frames requested by the voice player", "frame_interval"),
+        ("voice_source_stall_seconds", "Reads that took longer than a whole frame", "stalls"),
+    )
+    counters = (
+        ("voice_frames_total", "Frames sent to Discord", "frames"),
+        ("voice_late_frames_total", "Frames requested later than 1.5 frame intervals after the previous one", "late_frames"),
+        ("voice_dropped_frames_total", "Frame slots that passed without a frame", "dropped_frames"),
+        ("voice_underruns_total", "Times the audio buffer ran dry", "underruns"),
+    )
+
+    lines = []
+    for name, help, attribute in histograms:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} histogram")
+        for (guild_id, kind), stats in entries:
+            labels = f'guild="{guild_id}",source="{kind}"'
+            with stats.lock:
+                histogram = getattr(stats, attribute)
+                for bound, count in histogram.cumulative():
+                    lines.append(f'{name}_bucket{{{labels},le="{_format_bound(bound)}"}} {count}')
+                lines.append(f"{name}_sum{{{labels}}} {histogram.sum}")
+                lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+
+    for name, help, attribute in counters:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} counter")
+        for (guild_id, kind), stats in entries:
+            with stats.lock:
+                value = getattr(stats, attribute)
+            lines.append(f'{name}{{guild="{guild_id}",source="{kind}"}} {value}')
+
+    return "\n".join(lines) + "\n"